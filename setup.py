@@ -9,7 +9,7 @@ setup(name='vmbuilder',
       author_email='asheplyakov@yandex.ru',
       url='https://github.com/asheplyakov/vmbuilder',
       packages=['vmbuilder'],
-      scripts=['bin/vmbuilder'],
+      scripts=['bin/vmbuilder', 'bin/vmbuilder-privhelper'],
       package_data={
           'vmbuilder': [
               'templates/altlinux/config-drive/meta-data',
@@ -2,18 +2,18 @@
 
 from __future__ import absolute_import
 
-import copy
-import jinja2
 import os
 import sys
-import tempfile
 
 from codecs import utf_8_encode
 from . import TEMPLATE_DIR
-from .mtools import Mtools
-from .py3compat import subprocess
+from .fatimage import MEDIA_FLOPPY, FatImage
+from .layered import LayeredDict
+from .miscutils import mkdir_p, template_env
 
 BUILD_DIR = os.path.expanduser('~/.cache/vmbuilder/autounattend')
+FLOPPY_SIZE = 1440 * 1024
+FLOPPY_ROOT_ENTRIES = 224
 
 
 class Woe2008Autounattend(object):
@@ -26,49 +26,54 @@ class Woe2008Autounattend(object):
         self._files = []
         img_name = '%s-autounattend.img' % vm_name
         self._img_path = os.path.join(BUILD_DIR, img_name)
-        self._mtools = Mtools(self._img_path)
-        self._env = None
+        self._img = None
 
     def _write(self, strdat, rel_path):
         strdat = strdat.replace('\n', '\r\n')
         strdat = utf_8_encode(strdat)[0]
-        with tempfile.NamedTemporaryFile() as f:
-            f.write(strdat)
-            f.flush()
-            self._mtools.cp(f.name, rel_path)
+        self._img.add_file(rel_path, strdat)
 
-    def _process(self, data):
+    def render(self, data):
+        """Rendered templates as a list of (file name, content) tuples"""
+        self._find_files()
+        env = template_env(self.template_dir)
+        rendered = []
         for rel_path in self._files:
-            template = self._env.get_or_select_template(rel_path)
-            out = template.render(data)
-            self._write(out, rel_path)
+            template = env.get_or_select_template(rel_path)
+            rendered.append((rel_path, template.render(data)))
+        return rendered
 
     def _find_files(self):
+        self._files = []
         for subdir, dirs, files in os.walk(self.template_dir):
             rel_subdir = os.path.relpath(subdir, self.template_dir)
             for f in files:
                 rel_file_path = os.path.join(rel_subdir, f)
                 self._files.append(rel_file_path)
 
-    def generate(self, data):
-        self._find_files()
-        self._env = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(self.template_dir))
-        self._mtools.blank()
-        self._process(data)
-        return self._img_path
+    def generate(self, data, in_memory=False):
+        """Make the floppy image with the rendered templates
+
+        The image is attached to the VM as a file, so it's always saved
+        (atomically: libvirt might have chowned the previous one).
+        """
+        self._img = FatImage(FLOPPY_SIZE, fat_bits=12, media=MEDIA_FLOPPY,
+                             root_entries=FLOPPY_ROOT_ENTRIES)
+        for rel_path, out in self.render(data):
+            self._write(out, rel_path)
+        mkdir_p(BUILD_DIR)
+        return self._img.write(self._img_path)
 
 
 def generate_autounattend(dat, vm_name=None, template_dir=TEMPLATE_DIR):
-    data = copy.deepcopy(dat)
     extra_data = {
         'vm_name': vm_name,
     }
-    data.update(extra_data)
+    data = LayeredDict(extra_data, dat)
     distro = dat.get('distro', 'woe2008')
     gen = Woe2008Autounattend(vm_name=vm_name,
                               distro=distro,
-                              template_dir=os.path.join(template_dir, distro))
+                              template_dir=template_dir)
     return gen.generate(data)
 
 
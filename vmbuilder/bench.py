@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+# Purpose: measure the orchestration overhead of rebuild_vms (threads,
+# external commands, cloud-init callback, inventory writes) without
+# a hypervisor and LVM
+
+from __future__ import absolute_import
+
+import json
+import optparse
+import os
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+try:
+    from urllib import urlencode
+    from urllib2 import Request, urlopen
+except ImportError:
+    from urllib.parse import urlencode
+    from urllib.request import Request, urlopen
+
+from collections import Counter, OrderedDict
+from .py3compat import subprocess
+
+PACKAGE_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_FILE = os.path.join(PACKAGE_PARENT, 'tests', 'bench-baseline.json')
+
+DEFAULT_SIZES = (10, 100, 500)
+
+# commands replaced by shims, sudo runs the shims too
+SHIMMED_COMMANDS = (
+    'chgrp',
+    'chmod',
+    'debugfs',
+    'dig',
+    'dmsetup',
+    'e2fsck',
+    'e2image',
+    'kpartx',
+    'lvchange',
+    'lvcreate',
+    'lvremove',
+    'lvrename',
+    'lvs',
+    'mkswap',
+    'pvs',
+    'qemu-img',
+    'resize2fs',
+    'ssh-keygen',
+    'sudo',
+    'tune2fs',
+    'udevadm',
+    'vgs',
+    'virsh',
+)
+
+SHIM = r'''#!/bin/sh
+name=${0##*/}
+dir="$VMBUILDER_BENCH_DIR"
+echo "$name $*" >> "$dir/commands.log"
+if [ -f "$dir/latency/$name" ]; then
+    read lat < "$dir/latency/$name"
+else
+    read lat < "$dir/latency/default"
+fi
+[ "$lat" = "0" ] || sleep "$lat"
+case "$name" in
+sudo)
+    while [ $# -gt 0 ]; do
+        case "$1" in -*) shift ;; *) break ;; esac
+    done
+    [ $# -eq 0 ] && exit 0
+    exec "$@"
+    ;;
+virsh)
+    [ "$1" = "-c" ] && shift 2
+    case "$1" in
+    domstate|dumpxml)
+        echo "error: failed to get domain '$2'" >&2
+        exit 1
+        ;;
+    net-dumpxml)
+        echo "<network><name>$2</name><ip address='127.0.0.1'/></network>"
+        ;;
+    define)
+        cat > /dev/null
+        ;;
+    start)
+        "$VMBUILDER_BENCH_PYTHON" -m vmbuilder.bench --phone-home "$2" \
+            --workdir "$dir" > /dev/null 2>&1 &
+        ;;
+    esac
+    ;;
+lvs)
+    case "$*" in
+    *chunk_size*) echo "  65536" ;;
+    *lv_name*) ;;
+    *) exit 5 ;;
+    esac
+    ;;
+pvs)
+    echo "  benchvg;$VMBUILDER_BENCH_PV"
+    ;;
+ssh-keygen)
+    case "$*" in *-F*) exit 1 ;; esac
+    ;;
+esac
+exit 0
+'''
+
+HELPER_SHIM = r'''#!/bin/sh
+exec "$VMBUILDER_BENCH_PYTHON" -m vmbuilder.privhelper "$@"
+'''
+
+
+def find_pv():
+    """Find a block device for IOThrottler to check (SSD preferred)"""
+    candidates = []
+    for name in sorted(os.listdir('/sys/block')):
+        rotational = '/sys/block/{0}/queue/rotational'.format(name)
+        if os.path.exists('/dev/' + name) and os.path.isfile(rotational):
+            with open(rotational, 'r') as f:
+                candidates.append((int(f.read()), '/dev/' + name))
+    if not candidates:
+        raise RuntimeError("no block devices found")
+    return min(candidates)[1]
+
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+
+def make_cluster_def(vm_count, port):
+    return {
+        'cluster_name': 'bench',
+        'distro': 'ubuntu',
+        'distro_release': 'bionic',
+        'admin_password': 'r00tme',
+        'source_image': {'path': '/dev/null'},
+        'machine': {
+            'drives': {
+                'os': {'vg': 'benchvg', 'thin_pool': 'vmpool',
+                       'disk_size': 4096},
+            },
+            'interfaces': {
+                'default': {'source_net': 'bench'},
+            },
+        },
+        'net_conf': {
+            'web_callback_url': 'http://127.0.0.1:{0}'.format(port),
+        },
+        'hosts': {
+            'servers': [{'name': 'bench{0:04d}'.format(n),
+                         'instance_id': 'bench-{0:04d}'.format(n)}
+                        for n in range(vm_count)],
+        },
+    }
+
+
+def setup_workdir(workdir, vm_count, latency=0.0, latencies=None,
+                  cloud_init_latency=0.0):
+    """Make shims, fake $HOME, and the cluster definition"""
+    shim_dir = os.path.join(workdir, 'bin')
+    latency_dir = os.path.join(workdir, 'latency')
+    home = os.path.join(workdir, 'home')
+    for d in (shim_dir, latency_dir, os.path.join(home, '.ssh')):
+        os.makedirs(d)
+    shim = os.path.join(workdir, 'shim')
+    with open(shim, 'w') as f:
+        f.write(SHIM)
+    os.chmod(shim, 0o755)
+    for cmd in SHIMMED_COMMANDS:
+        os.symlink(shim, os.path.join(shim_dir, cmd))
+    # the privileged helper is not installed, nor counted as a command
+    helper = os.path.join(shim_dir, 'vmbuilder-privhelper')
+    with open(helper, 'w') as f:
+        f.write(HELPER_SHIM)
+    os.chmod(helper, 0o755)
+    with open(os.path.join(latency_dir, 'default'), 'w') as f:
+        f.write('{0}\n'.format(latency))
+    for cmd, value in (latencies or {}).items():
+        with open(os.path.join(latency_dir, cmd), 'w') as f:
+            f.write('{0}\n'.format(value))
+    with open(os.path.join(home, '.ssh', 'authorized_keys'), 'w') as f:
+        f.write('ssh-rsa AAAAB3NzaC1yc2E bench@localhost\n')
+    open(os.path.join(workdir, 'commands.log'), 'w').close()
+
+    port = free_port()
+    cluster_def = make_cluster_def(vm_count, port)
+    config = {
+        'url': cluster_def['net_conf']['web_callback_url'],
+        'cloud_init_latency': cloud_init_latency,
+        'instance_ids': dict((vm['name'], vm['instance_id']) for vm in
+                             cluster_def['hosts']['servers']),
+        'cluster_def': cluster_def,
+    }
+    with open(os.path.join(workdir, 'config.json'), 'w') as f:
+        json.dump(config, f)
+    return config
+
+
+def phone_home(workdir, vm_name):
+    """Pretend to be cloud-init of the given VM"""
+    with open(os.path.join(workdir, 'config.json'), 'r') as f:
+        config = json.load(f)
+    time.sleep(config['cloud_init_latency'])
+    data = urlencode({
+        'hostname': vm_name,
+        'instance_id': config['instance_ids'][vm_name],
+        'pub_key_rsa': 'ssh-rsa AAAAB3NzaC1yc2E root@{0}'.format(vm_name),
+    })
+    req = Request(config['url'], data=data.encode('utf-8'),
+                  headers={'User-Agent': 'Cloud-Init/bench'})
+    urlopen(req).read()
+
+
+def _count_commands(workdir):
+    counts = Counter()
+    with open(os.path.join(workdir, 'commands.log'), 'r') as f:
+        for line in f:
+            counts[line.split(None, 1)[0]] += 1
+    return counts
+
+
+def run_one(workdir, provision_latency=0.0):
+    """Run rebuild_vms against the shims (in a dedicated process)"""
+    with open(os.path.join(workdir, 'config.json'), 'r') as f:
+        config = json.load(f)
+    cluster_def = config['cluster_def']
+    vm_count = len(cluster_def['hosts']['servers'])
+    os.environ.update({
+        'HOME': os.path.join(workdir, 'home'),
+        'USER': 'bench',
+        'PATH': os.path.join(workdir, 'bin') + ':' + os.environ['PATH'],
+        'VMBUILDER_BENCH_DIR': workdir,
+        'VMBUILDER_BENCH_PV': find_pv(),
+        'VMBUILDER_BENCH_PYTHON': sys.executable,
+        # shims replace virsh, not libvirtd
+        'VMBUILDER_VIRT_BACKEND': 'virsh',
+        'PYTHONPATH': PACKAGE_PARENT,
+    })
+    # paths in $HOME are computed on import
+    from . import vmbuilder
+    from .privhelper import privileged_helper
+    os.chdir(workdir)
+
+    def provision_stub(vdisks, **kwargs):
+        time.sleep(provision_latency)
+
+    vmbuilder.get_provision_method = lambda distro, golden=False: \
+        provision_stub
+
+    max_threads = [threading.active_count()]
+    done = threading.Event()
+
+    def sample_threads():
+        while not done.wait(0.05):
+            max_threads[0] = max(max_threads[0], threading.active_count())
+
+    sampler = threading.Thread(target=sample_threads)
+    sampler.daemon = True
+    sampler.start()
+    start = time.time()
+    with privileged_helper():
+        vmbuilder.rebuild_vms(None, cluster_def=cluster_def, redefine=True)
+    wall = time.time() - start
+    done.set()
+    sampler.join()
+
+    commands = _count_commands(workdir)
+    total = sum(commands.values())
+    return OrderedDict([
+        ('vms', vm_count),
+        ('wall', round(wall, 3)),
+        ('max_rss_kb', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss),
+        # without the sampler
+        ('max_threads', max_threads[0] - 1),
+        ('commands', total),
+        ('commands_per_vm', round(float(total) / vm_count, 2)),
+        ('by_command', OrderedDict(sorted(commands.items()))),
+    ])
+
+
+def run_benchmark(vm_count, latency=0.0, latencies=None,
+                  cloud_init_latency=0.0, provision_latency=0.0,
+                  keep=False):
+    workdir = tempfile.mkdtemp(prefix='vmbuilder-bench-')
+    try:
+        setup_workdir(workdir, vm_count, latency=latency,
+                      latencies=latencies,
+                      cloud_init_latency=cloud_init_latency)
+        cmd = [sys.executable, '-m', 'vmbuilder.bench',
+               '--run-one', '--workdir', workdir,
+               '--provision-latency', str(provision_latency)]
+        env = dict(os.environ, PYTHONPATH=PACKAGE_PARENT)
+        with open(os.path.join(workdir, 'output.log'), 'w') as log:
+            rc = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT,
+                                 env=env)
+        if rc != 0:
+            raise RuntimeError("benchmark of {0} VMs failed, see {1}".format(
+                vm_count, os.path.join(workdir, 'output.log')))
+        with open(os.path.join(workdir, 'result.json'), 'r') as f:
+            return json.load(f, object_pairs_hook=OrderedDict)
+    except Exception:
+        keep = True
+        raise
+    finally:
+        if not keep:
+            shutil.rmtree(workdir)
+
+
+def print_results(results, out=sys.stdout):
+    fmt = '{0:>6} {1:>10} {2:>12} {3:>8} {4:>10} {5:>8}'
+    out.write(fmt.format('vms', 'wall', 'max rss, MB', 'threads',
+                         'commands', 'per vm') + '\n')
+    for r in results:
+        out.write(fmt.format(r['vms'], '%.2f' % r['wall'],
+                             '%.1f' % (r['max_rss_kb'] / 1024.0),
+                             r['max_threads'], r['commands'],
+                             '%.2f' % r['commands_per_vm']) + '\n')
+    out.flush()
+
+
+def check_baseline(results, baseline):
+    """Return the list of regressions (more commands per VM than before)"""
+    regressions = []
+    for r in results:
+        expected = baseline.get(str(r['vms']))
+        if expected is not None and r['commands_per_vm'] > expected:
+            regressions.append("{0} VMs: {1} commands per VM (was {2})".
+                               format(r['vms'], r['commands_per_vm'],
+                                      expected))
+    return regressions
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--vms', dest='sizes',
+                      default=','.join(str(n) for n in DEFAULT_SIZES),
+                      help='comma separated numbers of VMs (%default)')
+    parser.add_option('-l', '--latency', dest='latency', type=float,
+                      default=0.0,
+                      help='latency of external commands, seconds')
+    parser.add_option('-L', '--command-latency', dest='latencies',
+                      action='append', default=[],
+                      help='per command latency, i.e. virsh=0.05')
+    parser.add_option('--cloud-init-latency', dest='cloud_init_latency',
+                      type=float, default=0.0,
+                      help='delay between VM start and phone home')
+    parser.add_option('--provision-latency', dest='provision_latency',
+                      type=float, default=0.0,
+                      help='time to provision a VM drive')
+    parser.add_option('-b', '--baseline', dest='baseline',
+                      default=BASELINE_FILE,
+                      help='commands per VM baseline (%default)')
+    parser.add_option('--check', dest='check', action='store_true',
+                      default=False,
+                      help='fail if a VM needs more commands than before')
+    parser.add_option('--save-baseline', dest='save_baseline',
+                      action='store_true', default=False,
+                      help='save commands per VM as the new baseline')
+    parser.add_option('-k', '--keep', dest='keep', action='store_true',
+                      default=False,
+                      help='keep the working directories')
+    # internal
+    parser.add_option('--run-one', dest='run_one', action='store_true',
+                      default=False, help=optparse.SUPPRESS_HELP)
+    parser.add_option('--phone-home', dest='phone_home',
+                      help=optparse.SUPPRESS_HELP)
+    parser.add_option('--workdir', dest='workdir',
+                      help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    if options.phone_home:
+        phone_home(options.workdir, options.phone_home)
+        return 0
+    if options.run_one:
+        result = run_one(options.workdir,
+                         provision_latency=options.provision_latency)
+        with open(os.path.join(options.workdir, 'result.json'), 'w') as f:
+            json.dump(result, f, indent=1)
+        return 0
+
+    latencies = dict(entry.split('=', 1) for entry in options.latencies)
+    results = []
+    for size in options.sizes.split(','):
+        results.append(run_benchmark(
+            int(size),
+            latency=options.latency,
+            latencies=latencies,
+            cloud_init_latency=options.cloud_init_latency,
+            provision_latency=options.provision_latency,
+            keep=options.keep))
+    print_results(results)
+
+    if options.save_baseline:
+        with open(options.baseline, 'w') as f:
+            json.dump(OrderedDict((str(r['vms']), r['commands_per_vm'])
+                                  for r in results), f, indent=1)
+            f.write('\n')
+    if options.check:
+        with open(options.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = check_baseline(results, baseline)
+        for msg in regressions:
+            print("REGRESSION: {0}".format(msg))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
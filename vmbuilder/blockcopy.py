@@ -0,0 +1,182 @@
+from __future__ import absolute_import
+
+# Copy data to thin LVs without allocating chunks for zeros
+
+import errno
+import os
+
+from .driveutils import pwrite_all, wipe_range
+
+# os.SEEK_DATA, os.SEEK_HOLE are missing in python 2.7
+SEEK_DATA = 3
+SEEK_HOLE = 4
+DEFAULT_BLOCK_SIZE = 64 * 1024
+READ_SIZE = 4 * 1024 * 1024
+
+
+class CopyStats(object):
+    """How many bytes have been written, skipped, discarded"""
+    def __init__(self):
+        self.written = 0
+        self.skipped = 0
+        self.discarded = 0
+        self.zeroed = 0
+
+    def add(self, other):
+        self.written += other.written
+        self.skipped += other.skipped
+        self.discarded += other.discarded
+        self.zeroed += other.zeroed
+        return self
+
+    __iadd__ = add
+
+    def __str__(self):
+        mb = 1024.0 * 1024
+        return 'written {0:.1f} MB, skipped {1:.1f} MB, ' \
+            'discarded {2:.1f} MB, zeroed {3:.1f} MB'.format(
+                self.written / mb, self.skipped / mb,
+                self.discarded / mb, self.zeroed / mb)
+
+
+def data_extents(fd, offset, length):
+    """(start, end) ranges of fd which might hold data, relative to offset
+
+    Uses SEEK_DATA/SEEK_HOLE, the whole range is reported if the
+    filesystem does not support them.
+    """
+    pos = 0
+    while pos < length:
+        try:
+            data = os.lseek(fd, offset + pos, SEEK_DATA) - offset
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # no data till the end of file
+                return
+            elif e.errno == errno.EINVAL:
+                yield pos, length
+                return
+            raise
+        if data >= length:
+            return
+        hole = os.lseek(fd, offset + data, SEEK_HOLE) - offset
+        yield data, min(hole, length)
+        pos = hole
+
+
+def _write_nonzero_blocks(dst_fd, buf, dst_offset, block_size):
+    """Write blocks of buf which are not all zeros, return bytes written"""
+    zero_block = b'\0' * block_size
+    written = 0
+    run_start = None
+    for pos in range(0, len(buf) + block_size, block_size):
+        block = buf[pos:pos + block_size]
+        if block and block != zero_block[:len(block)]:
+            if run_start is None:
+                run_start = pos
+            continue
+        if run_start is not None:
+            run = buf[run_start:pos]
+            pwrite_all(dst_fd, run, dst_offset + run_start)
+            written += len(run)
+            run_start = None
+    return written
+
+
+def copy_range(src, dst, src_offset=0, dst_offset=0, length=None,
+               wipe_length=None, block_size=DEFAULT_BLOCK_SIZE,
+               discard_granularity=None):
+    """Copy data from src to dst skipping holes and zero blocks
+
+    The destination range (wipe_length bytes, defaults to length) is
+    discarded (or zeroed) first, so holes and zero blocks of the source
+    need not be written. For thin LVs both block_size and
+    discard_granularity should be the thin pool chunk size, and
+    dst_offset should be aligned to it.
+    """
+    stats = CopyStats()
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        if length is None:
+            length = os.fstat(src_fd).st_size - src_offset
+        dst_fd = os.open(dst, os.O_WRONLY)
+        try:
+            stats.discarded, stats.zeroed = \
+                wipe_range(dst_fd, dst_offset, wipe_length or length,
+                           discard_granularity=discard_granularity)
+            read_size = max(READ_SIZE // block_size, 1) * block_size
+            copied_till = 0
+            for start, end in data_extents(src_fd, src_offset, length):
+                # copy whole blocks (thin pool chunks)
+                start = max(start // block_size * block_size, copied_till)
+                end = min(-(-end // block_size) * block_size, length)
+                while start < end:
+                    count = min(read_size, end - start)
+                    os.lseek(src_fd, src_offset + start, os.SEEK_SET)
+                    buf = os.read(src_fd, count)
+                    if not buf:
+                        break
+                    stats.written += _write_nonzero_blocks(
+                        dst_fd, buf, dst_offset + start, block_size)
+                    start += len(buf)
+                copied_till = end
+            os.fsync(dst_fd)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    stats.skipped = length - stats.written
+    return stats
+
+
+def copy_stream(stream, dst, skip=0, dst_offset=0, length=None,
+                wipe_length=None, block_size=DEFAULT_BLOCK_SIZE,
+                discard_granularity=None):
+    """Copy length bytes (after skipping skip ones) of stream to dst
+
+    Like copy_range, but the source is read sequentially (i.e. a pipe
+    from a decompressor), so only zero blocks can be skipped.
+    """
+    stats = CopyStats()
+    read_size = max(READ_SIZE // block_size, 1) * block_size
+    while skip > 0:
+        buf = stream.read(min(skip, READ_SIZE))
+        if not buf:
+            raise RuntimeError('unexpected end of the source stream')
+        skip -= len(buf)
+    dst_fd = os.open(dst, os.O_WRONLY)
+    try:
+        stats.discarded, stats.zeroed = \
+            wipe_range(dst_fd, dst_offset, wipe_length or length,
+                       discard_granularity=discard_granularity)
+        pos = 0
+        while pos < length:
+            buf = stream.read(min(read_size, length - pos))
+            if not buf:
+                raise RuntimeError('unexpected end of the source stream')
+            stats.written += _write_nonzero_blocks(
+                dst_fd, buf, dst_offset + pos, block_size)
+            pos += len(buf)
+        os.fsync(dst_fd)
+    finally:
+        os.close(dst_fd)
+    stats.skipped = length - stats.written
+    return stats
+
+
+def copy_buffer(buf, dst, dst_offset=0, wipe_length=None,
+                block_size=DEFAULT_BLOCK_SIZE, discard_granularity=None):
+    """Write an in-memory image to dst, wipe the rest of wipe_length"""
+    stats = CopyStats()
+    dst_fd = os.open(dst, os.O_WRONLY)
+    try:
+        stats.discarded, stats.zeroed = \
+            wipe_range(dst_fd, dst_offset, wipe_length or len(buf),
+                       discard_granularity=discard_granularity)
+        stats.written = _write_nonzero_blocks(dst_fd, buf, dst_offset,
+                                              block_size)
+        os.fsync(dst_fd)
+    finally:
+        os.close(dst_fd)
+    stats.skipped = len(buf) - stats.written
+    return stats
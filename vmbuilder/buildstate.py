@@ -0,0 +1,134 @@
+from __future__ import absolute_import
+
+# Remember what every VM was built from, so the next run can keep
+# the VMs whose inputs have not changed
+
+import hashlib
+import json
+import os
+import threading
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from .gen_cloud_conf import render_cc
+from .imageprobe import image_identity
+from .make_vm import render_vm_xml
+from .miscutils import mkdir_p, safe_save_file
+from .remotehost import get_host
+from .virtutils import LIBVIRT_CONNECTION, list_vms
+
+STATE_FILE = 'vmbuilder-state.json'
+STATE_VERSION = 1
+
+# instance_id is new for every build, so fingerprints are computed
+# with a fixed one
+FINGERPRINT_INSTANCE_ID = 'fingerprint'
+
+
+def vm_fingerprint(vm_def):
+    """Digest of the VM inputs
+
+    Covers the merged definition, the source image identity, the rendered
+    domain XML, and the rendered config drive (autounattend) templates.
+    """
+    vm_def = vm_def.new_child(instance_id=FINGERPRINT_INSTANCE_ID)
+    digest = hashlib.sha256()
+
+    def feed(value):
+        digest.update(json.dumps(value, sort_keys=True,
+                                 default=str).encode('utf-8'))
+
+    feed(vm_def.to_dict())
+    feed(image_identity(vm_def['drives']['install_image']))
+    feed(render_vm_xml(vm_def, template=vm_def['vm_template']))
+    feed(sorted(render_cc(vm_def)))
+    return digest.hexdigest()
+
+
+def vm_lvs(vm_def):
+    """(vg, lv) tuples of the VM drives backed by LVs"""
+    return [(drive['vg'], '%s-%s' % (vm_def['vm_name'], group))
+            for group, drive in vm_def['drives'].items()
+            if isinstance(drive, Mapping) and 'vg' in drive]
+
+
+class BuildState(object):
+    """Fingerprints of the VMs built so far
+
+    Along with the data the VMs reported via cloud-init phone home
+    (to regenerate the inventory without rebuilding them).
+    """
+    def __init__(self, path):
+        self.path = path
+        self._mutex = threading.Lock()
+        self._vms = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                state = json.load(f)
+            if state.get('version') == STATE_VERSION:
+                self._vms = state['vms']
+
+    def get(self, vm_name):
+        return self._vms.get(vm_name)
+
+    def record(self, vm_name, fingerprint, ready_info, hypervisor=None):
+        with self._mutex:
+            self._vms[vm_name] = {
+                'fingerprint': fingerprint,
+                'ready_info': ready_info,
+            }
+            if hypervisor is not None:
+                self._vms[vm_name]['hypervisor'] = hypervisor
+            self._save()
+
+    def placement(self):
+        """{vm_name: hypervisor} of the VMs placed onto a hypervisor"""
+        return dict((vm_name, entry['hypervisor'])
+                    for vm_name, entry in self._vms.items()
+                    if 'hypervisor' in entry)
+
+    def forget(self, vm_names):
+        with self._mutex:
+            forgotten = [self._vms.pop(name) for name in vm_names
+                         if name in self._vms]
+            if forgotten:
+                self._save()
+
+    def _save(self):
+        mkdir_p(os.path.dirname(os.path.abspath(self.path)))
+        with safe_save_file(self.path) as f:
+            json.dump({'version': STATE_VERSION, 'vms': self._vms}, f,
+                      indent=1, sort_keys=True)
+
+    def unchanged_vms(self, vm_list, fingerprints):
+        """VMs with the recorded fingerprint, existing domain and LVs
+        (on the hypervisor the VM is placed on)
+
+        Returns {vm_name: is_running} dict.
+        """
+        candidates = [vm for vm in vm_list
+                      if (self.get(vm['vm_name']) or {}).get('fingerprint')
+                      == fingerprints[vm['vm_name']]]
+        by_uri = {}
+        for vm in candidates:
+            uri = vm.get('libvirt_uri', LIBVIRT_CONNECTION)
+            by_uri.setdefault(uri, []).append(vm)
+        unchanged = {}
+        for uri, vms in by_uri.items():
+            domains = list_vms(conn=uri)
+            running = list_vms(inactive=False, conn=uri)
+            host = get_host(uri)
+            lvs = {}
+            for vg in set(vg for vm in vms for vg, _ in vm_lvs(vm)):
+                lvs[vg] = set(host.run('list_lvs', vg=vg) or [])
+            for vm in vms:
+                vm_name = vm['vm_name']
+                if vm_name not in domains:
+                    continue
+                if any(lv not in lvs[vg] for vg, lv in vm_lvs(vm)):
+                    continue
+                unchanged[vm_name] = vm_name in running
+        return unchanged
@@ -4,6 +4,7 @@
 
 from __future__ import absolute_import
 
+import json
 import os
 try:
     import Queue
@@ -18,6 +19,7 @@ from collections import OrderedDict
 from optparse import OptionParser
 from threading import Thread, Event
 
+from .runstatus import format_metrics
 from .sshutils import update_known_hosts, SshConfigGenerator
 from .miscutils import (
     safe_save_file,
@@ -44,6 +46,22 @@ class VMRegister(object):
         cb(**kwargs)
 
 
+class Status(object):
+    """GET handler: progress of the run as JSON"""
+
+    def GET(self):
+        web.header('Content-Type', 'application/json')
+        return json.dumps(web.ctx.globals.status(), indent=2) + '\n'
+
+
+class Metrics(object):
+    """GET handler: progress of the run for Prometheus"""
+
+    def GET(self):
+        web.header('Content-Type', 'text/plain; version=0.0.4')
+        return format_metrics(web.ctx.globals.status())
+
+
 class InventoryGenerator(object):
     """Generate ansible inventory from data reported by cloud-init
     """
@@ -82,7 +100,11 @@ class InventoryGenerator(object):
         host = self._get_host(entry)
         entry.update(self._copy_extra_info(host, entry))
         role = host.get('role', 'all')
-        self._inventory[role].append(entry)
+        # a VM might call back more than once
+        hosts = [h for h in self._inventory[role]
+                 if h['short_hostname'] != short_hostname]
+        hosts.append(entry)
+        self._inventory[role] = hosts
 
     def _make_host_entry(self, host):
         if host['os'] == 'windows':
@@ -128,12 +150,17 @@ class CloudInitWebCallback(object):
     Does two useful things
     - waits for specified VMs to be configured by cloud-init
     - manages VMs' ssh public keys in the local ~/.ssh/known_hosts file
+    Serves the progress of the run (as returned by the status callable,
+    see RunStatus.snapshot) at /status and /metrics.
     """
     def __init__(self, httpd_args, vms2wait=None, vm_ready_hooks=None,
                  async_hooks=[],
-                 inventory_filename=None):
+                 inventory_filename=None,
+                 status=None):
         self.vms2wait = vms2wait if vms2wait else {}
         self._stop_event = Event()
+        self._status = status
+        self._seen_vms = set()
 
         self._ssh_keys_queue = Queue.Queue()
         self._async_hooks_thread = Thread(target=self._async_worker)
@@ -154,7 +181,9 @@ class CloudInitWebCallback(object):
         self._async_hooks.extend(async_hooks)
         self._async_hooks.append(self._report_vm_ready)
 
-        urls = ('/', 'VMRegister')
+        urls = ('/', 'VMRegister',
+                '/status', 'Status',
+                '/metrics', 'Metrics')
         self._app = web.application(urls, globals())
         self._install_callback()
         self._webapp_thread = Thread(target=self._app.run)
@@ -174,9 +203,11 @@ class CloudInitWebCallback(object):
         print("vm {0} ready, ssh_key: {1}".format(hostname, ssh_key))
 
     def _async_worker(self):
-        seen_vms = set()
+        seen_vms = self._seen_vms
         vms2wait = set(name.lower() for name in self.vms2wait.keys())
-        while seen_vms != vms2wait:
+        # VMs not being waited for (i.e. restarted unchanged ones) might
+        # call back too
+        while not vms2wait <= seen_vms:
             vm_dat = self._ssh_keys_queue.get()
             if self._stop_event.is_set():
                 break
@@ -194,10 +225,22 @@ class CloudInitWebCallback(object):
         for f in self._hooks:
             f(**kwargs)
 
+    def status(self):
+        status = OrderedDict(self._status() if self._status else {})
+        vms2wait = set(name.lower() for name in self.vms2wait.keys())
+        seen_vms = frozenset(self._seen_vms)
+        status['callback'] = OrderedDict([
+            ('queue', self._ssh_keys_queue.qsize()),
+            ('ready', len(seen_vms)),
+            ('waiting', len(vms2wait - seen_vms)),
+        ])
+        return status
+
     def _install_callback(self):
         def _install_callback():
             g = web.storage({
-                'callback': self._vm_called_back
+                'callback': self._vm_called_back,
+                'status': self.status,
             })
 
             def _wrapper(handler):
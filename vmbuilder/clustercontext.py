@@ -0,0 +1,81 @@
+from __future__ import absolute_import
+
+# Cluster wide facts (hypervisor IPs, network domains, authorized keys,
+# callback URL) resolved once per run instead of once per VM
+
+import os
+import threading
+
+from .sshutils import get_authorized_keys
+from .virtutils import (
+    LIBVIRT_CONNECTION,
+    net_dumpxml,
+    net_domain_from_xml,
+    net_host_ip_from_xml,
+)
+
+WEB_CALLBACK_URL = 'http://{hypervisor_ip}:8080'
+
+
+class ClusterContext(object):
+    """Cluster wide facts, as seen from the hypervisor of the given URI
+
+    web_callback_url overrides the cluster wide one (i.e. VMs on remote
+    hypervisors can't reach the bridge of the local one).
+    """
+    def __init__(self, cluster_def, conn=LIBVIRT_CONNECTION,
+                 web_callback_url=None):
+        self.cluster_def = cluster_def
+        self.conn = conn
+        self.web_callback_url = web_callback_url
+        self._mutex = threading.Lock()
+        self._net_xmls = {}
+        self._facts = None
+
+    def _net_xml(self, net_name):
+        with self._mutex:
+            if net_name not in self._net_xmls:
+                self._net_xmls[net_name] = net_dumpxml(net_name,
+                                                       conn=self.conn)
+            return self._net_xmls[net_name]
+
+    def net_host_ip(self, net_name):
+        return net_host_ip_from_xml(self._net_xml(net_name))
+
+    def net_domain(self, net_name):
+        return net_domain_from_xml(self._net_xml(net_name))
+
+    def vm_facts(self):
+        """Parameters which are the same for all VMs of the cluster"""
+        with self._mutex:
+            facts = self._facts
+        if facts is not None:
+            return facts
+        cluster_def = self.cluster_def
+        interfaces = cluster_def['machine']['interfaces']
+        bridge_ip = self.net_host_ip(interfaces['default']['source_net'])
+
+        net_conf = cluster_def.get('net_conf', {})
+        http_proxy_tpl = net_conf.get('http_proxy')
+        http_proxy = http_proxy_tpl.format(hypervisor_ip=bridge_ip) \
+            if http_proxy_tpl else None
+
+        web_callback_url = self.web_callback_url or \
+            net_conf.get('web_callback_url', WEB_CALLBACK_URL)
+        web_callback_url = web_callback_url.format(hypervisor_ip=bridge_ip)
+        web_callback_addr = web_callback_url.split('http://', 1)[1]
+        facts = {
+            'ssh_authorized_keys': get_authorized_keys(),
+            'whoami': os.environ['USER'],
+            'hypervisor_ip': bridge_ip,
+            'http_proxy': http_proxy,
+            'web_callback_url': web_callback_url,
+            'web_callback_addr': web_callback_addr,
+        }
+        with self._mutex:
+            self._facts = facts
+        return facts
+
+    @property
+    def web_callback_addr(self):
+        return self.vm_facts()['web_callback_addr']
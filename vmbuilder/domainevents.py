@@ -0,0 +1,143 @@
+from __future__ import absolute_import
+
+# Track the state of all domains via libvirt lifecycle events, so waiting
+# for a state change needs neither polling nor a process per domain
+
+import threading
+import time
+import traceback
+
+from collections import defaultdict
+from contextlib import contextmanager
+from .virtbackend import LIBVIRT_CONNECTION, get_backend
+
+# ask libvirtd for the state if no event has arrived for that long
+# (events might be lost, i.e. when libvirtd restarts)
+RESYNC_INTERVAL = 5.0
+
+# domain state after the event, None: the domain is gone
+EVENT_STATES = {
+    'Undefined': None,
+    'Started': 'running',
+    'Suspended': 'paused',
+    'Resumed': 'running',
+    'Stopped': 'shut off',
+    'Shutdown': 'in shutdown',
+    'PMSuspended': 'pmsuspended',
+    'Crashed': 'crashed',
+}
+
+_LISTENERS = {}
+_LISTENERS_MUTEX = threading.Lock()
+
+
+class WaitTimeout(RuntimeError):
+    pass
+
+
+class DomainEvents(object):
+    """States of all domains, kept up to date by lifecycle events
+
+    hooks are invoked as hook(domain_name, event) on every event.
+    """
+    def __init__(self, conn=LIBVIRT_CONNECTION):
+        self.conn = conn
+        self._backend = get_backend(conn)
+        self._cond = threading.Condition()
+        self._states = {}
+        # number of events per domain, to detect state queries racing
+        # with events
+        self._events = defaultdict(int)
+        self._hooks = []
+        self._stop = None
+
+    def add_hook(self, hook):
+        self._hooks.append(hook)
+
+    def start(self):
+        self._stop = self._backend.listen_lifecycle(self._on_event)
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop()
+            self._stop = None
+
+    def _on_event(self, name, event):
+        with self._cond:
+            self._events[name] += 1
+            if event in EVENT_STATES:
+                self._states[name] = EVENT_STATES[event]
+            elif event == 'Defined' and self._states.get(name) is None:
+                self._states[name] = 'shut off'
+            self._cond.notify_all()
+        for hook in self._hooks:
+            try:
+                hook(name, event)
+            except Exception:
+                traceback.print_exc()
+
+    def _query(self, name):
+        """Ask libvirtd for the state, unless an event arrives meanwhile"""
+        with self._cond:
+            events = self._events[name]
+        state = self._backend.dom_state(name)
+        with self._cond:
+            if self._events[name] == events:
+                self._states[name] = state
+            return self._states[name]
+
+    def state(self, name):
+        with self._cond:
+            if name in self._states:
+                return self._states[name]
+        return self._query(name)
+
+    def wait_for_state(self, name, state, timeout=None):
+        """Wait until the domain gets into the given state (as virsh
+        domstate names it), raise WaitTimeout after timeout seconds"""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            self._query(name)
+            resync_at = time.time() + RESYNC_INTERVAL
+            with self._cond:
+                while self._states.get(name) != state:
+                    now = time.time()
+                    if deadline is not None and now >= deadline:
+                        raise WaitTimeout("{0} is {1}, not {2} after {3}s"
+                                          .format(name,
+                                                  self._states.get(name),
+                                                  state, timeout))
+                    if now >= resync_at:
+                        break
+                    self._cond.wait(min(resync_at, deadline or resync_at)
+                                    - now)
+                else:
+                    return
+
+
+def get_listener(conn=LIBVIRT_CONNECTION):
+    """The running DomainEvents for the given URI (if any)"""
+    with _LISTENERS_MUTEX:
+        return _LISTENERS.get(conn)
+
+
+@contextmanager
+def lifecycle_events(conn=LIBVIRT_CONNECTION):
+    """Listen to lifecycle events of all domains within the block
+
+    Nested blocks share the listener.
+    """
+    with _LISTENERS_MUTEX:
+        events = _LISTENERS.get(conn)
+        owner = events is None
+        if owner:
+            events = DomainEvents(conn)
+            events.start()
+            _LISTENERS[conn] = events
+    try:
+        yield events
+    finally:
+        if owner:
+            with _LISTENERS_MUTEX:
+                del _LISTENERS[conn]
+            events.stop()
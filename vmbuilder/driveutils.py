@@ -1,7 +1,12 @@
 
 from __future__ import absolute_import
+import ctypes
+import ctypes.util
+import errno
+import fcntl
 import os
 import stat
+import struct
 
 from .thinpool import vgs as lvm_vgs, NoSuchVG
 from .py3compat import subprocess
@@ -24,19 +29,43 @@ def partition_base_device(dev, abspath=False):
     raise ValueError("no base device for {}".format(dev))
 
 
+def sysfs_block_dir(dev):
+    """The /sys/dev/block/M:m directory of the block device"""
+    dev = os.path.realpath(dev)
+    st = os.lstat(dev)
+    if not stat.S_ISBLK(st.st_mode):
+        raise ValueError("{}: not a block device".format(dev))
+    M, m = os.major(st.st_rdev), os.minor(st.st_rdev)
+    sysfs_dir = '/sys/dev/block/{M}:{m}'.format(M=M, m=m)
+    if not os.path.exists(sysfs_dir):
+        raise RuntimeError("device {0}: no sysfs entry {1}"
+                           .format(dev, sysfs_dir))
+    return sysfs_dir
+
+
+def physical_drives(dev):
+    """Whole drives the block device (a partition, dm-crypt, md array,
+    etc) resides on
+    Example: physical_drives('/dev/mapper/nvme_crypt') == ['/dev/nvme0n1']
+    """
+    dev = os.path.realpath(dev)
+    slaves_dir = os.path.join(sysfs_block_dir(dev), 'slaves')
+    slaves = os.listdir(slaves_dir) if os.path.isdir(slaves_dir) else []
+    if not slaves:
+        return [partition_base_device(dev, abspath=True)]
+    drives = set()
+    for slave in slaves:
+        # cciss!c0d0 -> /dev/cciss/c0d0
+        drives.update(physical_drives('/dev/' + slave.replace('!', '/')))
+    return sorted(drives)
+
+
 def drive_is_ssd(orig_dev):
     """Check if device (whole drive or a partition) is an SSD"""
     dev = orig_dev
     while True:
         dev = os.path.realpath(dev)
-        st = os.lstat(dev)
-        if not stat.S_ISBLK(st.st_mode):
-            raise ValueError("{}: not a block device".format(dev))
-        M, m = os.major(st.st_rdev), os.minor(st.st_rdev)
-        sysfs_dir = '/sys/dev/block/{M}:{m}'.format(M=M, m=m)
-        if not os.path.exists(sysfs_dir):
-            raise RuntimeError("device {0}: no sysfs entry {1}"
-                               .format(dev, sysfs_dir))
+        sysfs_dir = sysfs_block_dir(dev)
         rotational = '{}/queue/rotational'.format(sysfs_dir)
         if os.path.isfile(rotational):
             break
@@ -50,14 +79,156 @@ def drive_is_ssd(orig_dev):
         return int(f.read()) == 0
 
 
+def udev_settle():
+    """Wait until udev has processed all queued events"""
+    subprocess.check_call(['udevadm', 'settle'])
+
+
+# <linux/fs.h>: _IOR(0x12, 114, size_t)
+BLKGETSIZE64 = 0x80081272
+# <linux/fs.h>: _IO(0x12, 119), _IO(0x12, 127)
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127f
+# <linux/falloc.h>
+FALLOC_FL_KEEP_SIZE = 0x1
+FALLOC_FL_PUNCH_HOLE = 0x2
+ZAP_SIZE = 1024 * 1024
+ZERO_BUF_SIZE = 1024 * 1024
+# /sys/block/<dev>/stat, see Documentation/block/stat.rst (times in ms)
+DISK_STAT_FIELDS = ('read_ios', 'read_merges', 'read_sectors', 'read_ticks',
+                    'write_ios', 'write_merges', 'write_sectors',
+                    'write_ticks', 'in_flight', 'io_ticks', 'time_in_queue')
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+_libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                            ctypes.c_int64, ctypes.c_int64]
+
+
+def device_size(path):
+    """Size of a block device (or a regular file) in bytes"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        st = os.fstat(fd)
+        if not stat.S_ISBLK(st.st_mode):
+            return st.st_size
+        buf = fcntl.ioctl(fd, BLKGETSIZE64, b'\0' * 8)
+        return struct.unpack('Q', buf)[0]
+    finally:
+        os.close(fd)
+
+
+def pwrite_all(fd, data, offset):
+    """Write all data at the given offset of the file"""
+    view = memoryview(data)
+    while len(view) > 0:
+        os.lseek(fd, offset, os.SEEK_SET)
+        written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
+
+def write_at(path, chunks, fsync=True):
+    """Write (offset, data) chunks to the file, fsync just once"""
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        for offset, data in chunks:
+            pwrite_all(fd, data, offset)
+        if fsync:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _range_ioctl(fd, request, offset, length):
+    fcntl.ioctl(fd, request, struct.pack('QQ', offset, length))
+
+
+def _write_zeros(fd, offset, length):
+    zeros = b'\0' * min(length, ZERO_BUF_SIZE)
+    end = offset + length
+    while offset < end:
+        pwrite_all(fd, zeros[:end - offset], offset)
+        offset += len(zeros)
+
+
+def _discard(fd, offset, length):
+    """Discard the range, zero it if the drive doesn't support discards
+    Returns True if discarded
+    """
+    try:
+        _range_ioctl(fd, BLKDISCARD, offset, length)
+        return True
+    except (IOError, OSError) as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY):
+            raise
+    _range_ioctl(fd, BLKZEROOUT, offset, length)
+    return False
+
+
+def _punch_hole(fd, offset, length):
+    mode = FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE
+    if _libc.fallocate(fd, mode, offset, length) != 0:
+        err = ctypes.get_errno()
+        if err not in (errno.EOPNOTSUPP, errno.ENOSYS):
+            raise OSError(err, os.strerror(err))
+        _write_zeros(fd, offset, length)
+
+
+def wipe_range(fd, offset, length, discard_granularity=None):
+    """Make the range of a drive (or a file) read as zeros
+
+    Avoids writing zeros. If discard_granularity (i.e. the thin pool chunk
+    size) is given the aligned part of the range is discarded (unmapped
+    chunks of thin LVs read as zeros), the rest is zeroed by BLKZEROOUT.
+    Drives which don't support discards are zeroed altogether. Holes are punched in regular files.
+    Returns (discarded, zeroed) number of bytes.
+    """
+    if length <= 0:
+        return 0, 0
+    if not stat.S_ISBLK(os.fstat(fd).st_mode):
+        _punch_hole(fd, offset, length)
+        return length, 0
+    end = offset + length
+    discarded = 0
+    if discard_granularity:
+        gran = discard_granularity
+        aligned_start = -(-offset // gran) * gran
+        aligned_end = end // gran * gran
+        if aligned_end > aligned_start:
+            if _discard(fd, aligned_start, aligned_end - aligned_start):
+                discarded = aligned_end - aligned_start
+            for zstart, zend in ((offset, aligned_start), (aligned_end, end)):
+                if zend > zstart:
+                    _range_ioctl(fd, BLKZEROOUT, zstart, zend - zstart)
+            return discarded, length - discarded
+    _range_ioctl(fd, BLKZEROOUT, offset, length)
+    return 0, length
+
+
 def zap_partition_table(vdisk):
-    subprocess.check_call(['dd', 'if=/dev/zero', 'of=%s' % vdisk,
-                           'bs=1M', 'count=1', 'conv=fsync'])
+    fd = os.open(vdisk, os.O_WRONLY)
+    try:
+        wipe_range(fd, 0, ZAP_SIZE)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
-def vg_is_ssd(vg_name):
-    """Check if the drive backing the volume group is an SSD"""
+def disk_stats(dev):
+    """I/O counters of the block device (see DISK_STAT_FIELDS)"""
+    with open(os.path.join(sysfs_block_dir(dev), 'stat'), 'r') as f:
+        values = f.read().split()
+    return dict(zip(DISK_STAT_FIELDS, (int(value) for value in values)))
+
+
+def vg_pvs(vg_name):
+    """Physical volumes of the volume group"""
     vg = lvm_vgs().get(vg_name)
     if not vg:
         raise NoSuchVG(vg_name)
-    return all(drive_is_ssd(pv) for pv in vg)
+    return vg
+
+
+def vg_is_ssd(vg_name):
+    """Check if the drive backing the volume group is an SSD"""
+    return all(drive_is_ssd(pv) for pv in vg_pvs(vg_name))
@@ -1,12 +1,15 @@
-
 from __future__ import absolute_import
 
 import os
+import re
 import stat
 import tempfile
 
 from .py3compat import subprocess
 
+DEBUGFS = '/sbin/debugfs'
+DEBUGFS_PROMPT = 'debugfs: '
+
 
 def _check_image_exists(fsimage, writable=False):
     if not os.path.exists(fsimage):
@@ -23,69 +26,202 @@ def isblock(path):
     return stat.S_ISBLK(os.stat(path).st_mode)
 
 
-def _rm(path, fsimage):
-    cmd = ['/sbin/debugfs', '-R', 'rm %s' % path, '-w', fsimage]
-    with open(os.devnull, 'w') as null:
-        subprocess.check_call(cmd, stdout=null, stderr=null)
+def _quote(path):
+    if '"' in path or '\n' in path:
+        raise ValueError('unsupported file name: %s' % path)
+    return '"%s"' % path
+
+
+def _run_debugfs(commands, fsimage, writable=False):
+    """Run debugfs commands in a single session
+
+    Returns the output of every command (in the same order)
+    """
+    cmd = [DEBUGFS, '-f', '/dev/stdin']
+    if writable:
+        cmd.append('-w')
+    cmd.append(fsimage)
+    debugfs = subprocess.Popen(cmd,
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    out, err = debugfs.communicate(''.join(c + '\n' for c in commands))
+    rc = debugfs.poll()
+    if rc != 0:
+        raise RuntimeError('debugfs: exit code %d, error %s' % (rc, err))
+    # debugfs echoes every command read from a file, use that to split
+    # the output into per command chunks
+    outputs = []
+    for line in out.split('\n'):
+        if line.startswith(DEBUGFS_PROMPT):
+            outputs.append([])
+        elif outputs:
+            outputs[-1].append(line)
+    return ['\n'.join(o) for o in outputs]
+
+
+def _dirsearch_cmd(path):
+    return 'dirsearch {0} {1}'.format(_quote(os.path.dirname(path)),
+                                      _quote(os.path.basename(path)))
 
 
-def make_empty_file(path, fsimage, mode=0644, force=False):
-    # XXX: unfortunately /dev/null is not good enough here since
-    # debugfs copies file mode along with the content
-    with tempfile.NamedTemporaryFile() as empty:
-        os.ftruncate(empty.file.fileno(), 0)
-        os.chmod(empty.name, mode)
-        copy_file_content(empty.name, path, fsimage, force=force)
+def _entry_found(dirsearch_out):
+    return dirsearch_out.lower().startswith('entry found')
+
+
+class Transaction(object):
+    """Batch of changes to an ext[234] filesystem image
+
+    All changes are applied in a single debugfs session, and verified
+    in another one:
+
+    tx = Transaction('/dev/mapper/vg-vm--os1')
+    tx.rm('/etc/machine-id')
+    tx.write('/etc/hostname', 'vm\\n', mode=0o644)
+    tx.commit()
+    """
+    def __init__(self, fsimage):
+        self.fsimage = fsimage
+        self._commands = []
+        self._files = []
+        # path -> None (should not exist) or expected mode
+        self._expected = {}
+
+    def _mkdir_parents(self, path):
+        parents = []
+        parent = os.path.dirname(path)
+        while parent not in ('/', ''):
+            parents.insert(0, parent)
+            parent = os.path.dirname(parent)
+        # mkdir fails for existing directories, that's harmless
+        self._commands.extend('mkdir %s' % _quote(d) for d in parents)
+
+    def _set_owner_mode(self, path, mode, uid, gid):
+        self._commands.extend([
+            'sif {0} mode 0{1:o}'.format(_quote(path), mode),
+            'sif {0} uid {1}'.format(_quote(path), uid),
+            'sif {0} gid {1}'.format(_quote(path), gid),
+        ])
+        self._expected[path] = mode
+
+    def rm(self, path):
+        self._commands.append('rm %s' % _quote(path))
+        self._expected[path] = None
+        return self
+
+    def mkdir(self, path, mode=0o755, uid=0, gid=0):
+        self._mkdir_parents(path)
+        self._commands.append('mkdir %s' % _quote(path))
+        self._set_owner_mode(path, stat.S_IFDIR | mode, uid, gid)
+        return self
+
+    def write(self, path, data, mode=0o644, uid=0, gid=0):
+        """Create the file with the given content, replace an existing one"""
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(data)
+        self._files.append(f.name)
+        return self.copy(f.name, path, mode=mode, uid=uid, gid=gid)
+
+    def copy(self, src, path, mode=0o644, uid=0, gid=0):
+        """Copy the local file src into the filesystem image"""
+        self._mkdir_parents(path)
+        self._commands.extend([
+            'rm %s' % _quote(path),
+            'cd %s' % _quote(os.path.dirname(path)),
+            'write {0} {1}'.format(_quote(src),
+                                   _quote(os.path.basename(path))),
+            'cd /',
+        ])
+        self._set_owner_mode(path, stat.S_IFREG | mode, uid, gid)
+        return self
+
+    def chmod(self, path, mode):
+        """Set permissions, mode must have type bits unless path is a file"""
+        if not stat.S_IFMT(mode):
+            mode |= stat.S_IFREG
+        self._commands.append('sif {0} mode 0{1:o}'.format(_quote(path),
+                                                           mode))
+        self._expected[path] = mode
+        return self
+
+    def symlink(self, path, target):
+        self._mkdir_parents(path)
+        self._commands.extend([
+            'rm %s' % _quote(path),
+            'symlink {0} {1}'.format(_quote(path), _quote(target)),
+        ])
+        self._expected[path] = stat.S_IFLNK | 0o777
+        return self
+
+    def verify(self):
+        """Check if all changes have been applied (single debugfs run)"""
+        paths = sorted(self._expected)
+        commands = []
+        for path in paths:
+            commands.append(_dirsearch_cmd(path))
+            if self._expected[path] is not None:
+                commands.append('stat %s' % _quote(path))
+        outputs = iter(_run_debugfs(commands, self.fsimage))
+        for path in paths:
+            found = _entry_found(next(outputs))
+            mode = self._expected[path]
+            if mode is None:
+                if found:
+                    raise RuntimeError('failed to remove %s from %s' %
+                                       (path, self.fsimage))
+                continue
+            stat_out = next(outputs)
+            if not found:
+                raise RuntimeError('failed to create %s in %s' %
+                                   (path, self.fsimage))
+            actual = re.search(r'Mode:\s+([0-7]+)', stat_out)
+            if actual is None or \
+                    int(actual.group(1), 8) != stat.S_IMODE(mode):
+                raise RuntimeError('%s: wrong mode of %s' %
+                                   (self.fsimage, path))
+
+    def commit(self):
+        _check_image_exists(self.fsimage, writable=True)
+        try:
+            if self._commands:
+                _run_debugfs(self._commands, self.fsimage, writable=True)
+        finally:
+            for name in self._files:
+                os.unlink(name)
+            self._files = []
+        self.verify()
+        self._commands = []
+        self._expected = {}
+
+
+def make_empty_file(path, fsimage, mode=0o644, force=False):
+    if (not force) and file_exists(path, fsimage):
+        raise ValueError('%s already exists in %s' % (path, fsimage))
+    Transaction(fsimage).write(path, b'', mode=mode).commit()
 
 
 def copy_file_content(src, dest, fsimage, force=False):
     """ copy content of a local file into the filesystem image
 
         Nothing is written if the destination file already exists.
-        Destination directory must exist.
     """
-
     _check_image_exists(fsimage, writable=True)
     if (not force) and file_exists(dest, fsimage):
         raise ValueError('%s already exists in %s' % (dest, fsimage))
-
-    commands = """
-    rm {dest}
-    cd {dir}
-    write {src} {fname}
-    """.format(src=src,
-               dest=dest,
-               dir=os.path.dirname(dest),
-               fname=os.path.basename(dest))
-
-    debugfs = subprocess.Popen(['/sbin/debugfs', '-f', '/dev/stdin',
-                                '-w', fsimage],
-                                stdin=subprocess.PIPE,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-    out, err = debugfs.communicate(commands)
-    rc = debugfs.poll()
-    if rc != 0:
-        raise RuntimeError('debugfs: exit code %d, error %s' % (rc, err))
+    mode = stat.S_IMODE(os.stat(src).st_mode)
+    Transaction(fsimage).copy(src, dest, mode=mode).commit()
 
 
 def file_exists(path, fsimage):
     """ check if a file exists in the filesystem image """
     _check_image_exists(fsimage)
-    fname = os.path.basename(path)
-    dir = os.path.dirname(path)
-    request = 'dirsearch {dir} {fname}'.format(dir=dir, fname=fname)
-    cmd = ['/sbin/debugfs', '-R', request, fsimage]
-    with open(os.devnull, 'w') as null:
-        out = subprocess.check_output(cmd, stderr=null)
-    return out.lower().startswith('entry found')
+    out, = _run_debugfs([_dirsearch_cmd(path)], fsimage)
+    return _entry_found(out)
 
 
 def rm(path, fsimage):
     """ remove a file from the ext[234] filesystem image """
-    _check_image_exists(fsimage, writable=True)
-    if file_exists(path, fsimage):
-        _rm(path, fsimage)
-    if file_exists(path, fsimage):
-        raise RuntimeError('failed to remove %s from %s' % (path, fsimage))
+    Transaction(fsimage).rm(path).commit()
     return path
@@ -0,0 +1,373 @@
+from __future__ import absolute_import
+
+# Build small FAT12/FAT16 images (config drives, floppies) in memory
+
+import os
+import posixpath
+import re
+import struct
+import time
+
+from collections import OrderedDict
+from .miscutils import safe_save_file
+
+SECTOR_SIZE = 512
+DIR_ENTRY_SIZE = 32
+RESERVED_SECTORS = 1
+FAT_COUNT = 2
+# the cluster count determines the FAT type, see the FAT specification
+MAX_CLUSTERS = {12: 4084, 16: 65524}
+MIN_CLUSTERS = {12: 1, 16: 4085}
+EOC = {12: 0xfff, 16: 0xffff}
+
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LFN = 0x0f
+LFN_CHARS = 13
+LFN_LAST = 0x40
+
+MEDIA_DISK = 0xf8
+MEDIA_FLOPPY = 0xf0
+
+# sectors per track and heads of the standard floppy formats (by the total
+# number of sectors), other images get the usual hard disk geometry
+FLOPPY_GEOMETRY = {
+    720: (9, 2),
+    1440: (9, 2),
+    2400: (15, 2),
+    2880: (18, 2),
+    5760: (36, 2),
+}
+DISK_GEOMETRY = (32, 64)
+
+# characters allowed in short (8.3) names
+SHORT_NAME_RE = re.compile(r"^[A-Z0-9!#$%&'()@^_`{}~-]+$")
+SHORT_NAME_INVALID_RE = re.compile(r"[^A-Z0-9!#$%&'()@^_`{}~-]")
+
+
+def _fat_date_time(timestamp):
+    tm = time.localtime(timestamp)
+    year = min(max(tm.tm_year, 1980), 2107)
+    date = ((year - 1980) << 9) | (tm.tm_mon << 5) | tm.tm_mday
+    ftime = (tm.tm_hour << 11) | (tm.tm_min << 5) | (tm.tm_sec // 2)
+    return date, ftime
+
+
+def _short_name(name):
+    """11 bytes 8.3 name if name is a valid uppercase 8.3 one, else None"""
+    if name in ('.', '..'):
+        return name.ljust(11).encode('ascii')
+    base, dot, ext = name.rpartition('.')
+    if not dot:
+        base, ext = name, ''
+    if not base or len(base) > 8 or len(ext) > 3:
+        return None
+    if not SHORT_NAME_RE.match(base) or \
+            (ext and not SHORT_NAME_RE.match(ext)):
+        return None
+    return (base.ljust(8) + ext.ljust(3)).encode('ascii')
+
+
+def _short_alias(name, taken):
+    """Unique 8.3 alias (like USER-D~1) of a long name"""
+    base, dot, ext = name.upper().lstrip('.').rpartition('.')
+    if not dot:
+        base, ext = name.upper().lstrip('.'), ''
+    base = SHORT_NAME_INVALID_RE.sub('_', base.replace(' ', '')) or '_'
+    ext = SHORT_NAME_INVALID_RE.sub('_', ext.replace(' ', ''))[:3]
+    for n in range(1, 1000000):
+        tail = '~{0}'.format(n)
+        alias = (base[:8 - len(tail)] + tail).ljust(8) + ext.ljust(3)
+        alias = alias.encode('ascii')
+        if alias not in taken:
+            return alias
+    raise ValueError("{0}: too many similar names".format(name))
+
+
+def _lfn_checksum(short_name):
+    csum = 0
+    for c in bytearray(short_name):
+        csum = (((csum & 1) << 7) + (csum >> 1) + c) & 0xff
+    return csum
+
+
+def _lfn_entries(name, short_name):
+    """VFAT long name entries (in on disk order) for the name"""
+    chars = name.encode('utf-16-le')
+    if len(chars) > 255 * 2:
+        raise ValueError("{0}: name is too long".format(name))
+    count = (len(chars) // 2 + LFN_CHARS - 1) // LFN_CHARS
+    # the name is NUL terminated (unless it fills the last entry exactly)
+    # and padded with 0xffff
+    chars += b'\0\0'
+    chars = chars[:count * LFN_CHARS * 2]
+    chars += b'\xff' * (count * LFN_CHARS * 2 - len(chars))
+    csum = _lfn_checksum(short_name)
+    entries = []
+    for seq in range(count, 0, -1):
+        part = chars[(seq - 1) * LFN_CHARS * 2:seq * LFN_CHARS * 2]
+        order = seq | (LFN_LAST if seq == count else 0)
+        entries.append(struct.pack('<B10sBBB12sH4s', order, part[:10],
+                                   ATTR_LFN, 0, csum, part[10:22], 0,
+                                   part[22:26]))
+    return entries
+
+
+class _Node(object):
+    def __init__(self, name, data=None, is_dir=False):
+        self.name = name
+        self.data = data
+        self.is_dir = is_dir
+        self.children = OrderedDict()
+        self.cluster = 0
+        self.short_name = None
+        self.lfn = False
+
+
+class FatImage(object):
+    """FAT12/FAT16 filesystem with long (VFAT) names built in memory
+
+    Files are kept in memory until the image is serialized. The image is
+    laid out contiguously, so everything past data() is zeros.
+    """
+    def __init__(self, size, label=None, fat_bits=None, root_entries=512,
+                 media=MEDIA_DISK, volume_id=None, timestamp=None):
+        if size % SECTOR_SIZE != 0:
+            raise ValueError("image size must be a multiple of sector size")
+        self.size = size
+        # not uppercased: older cloud-init looks for LABEL=cidata only
+        self.label = label or None
+        if label and len(label) > 11:
+            raise ValueError("{0}: label is too long".format(label))
+        self.media = media
+        self.timestamp = timestamp if timestamp is not None else time.time()
+        if volume_id is None:
+            volume_id = int(self.timestamp * 1000) & 0xffffffff
+        self.volume_id = volume_id
+        self.root_entries = root_entries
+        self._root = _Node('', is_dir=True)
+        self._layout(fat_bits)
+
+    def _layout(self, fat_bits):
+        total_sectors = self.size // SECTOR_SIZE
+        self.root_sectors = (self.root_entries * DIR_ENTRY_SIZE +
+                             SECTOR_SIZE - 1) // SECTOR_SIZE
+        candidates = [fat_bits] if fat_bits else [12, 16]
+        for bits in candidates:
+            # clusters up to 4KB for FAT12, otherwise up to 32KB
+            spc = 1
+            while spc <= (8 if bits == 12 and not fat_bits else 64):
+                fat_sectors = 1
+                while True:
+                    data_sectors = total_sectors - RESERVED_SECTORS - \
+                        FAT_COUNT * fat_sectors - self.root_sectors
+                    clusters = data_sectors // spc
+                    fat_bytes = (clusters + 2) * bits // 8 + 1
+                    need = (fat_bytes + SECTOR_SIZE - 1) // SECTOR_SIZE
+                    if need <= fat_sectors:
+                        break
+                    fat_sectors = need
+                if MIN_CLUSTERS[bits] <= clusters <= MAX_CLUSTERS[bits]:
+                    self.fat_bits = bits
+                    self.sectors_per_cluster = spc
+                    self.fat_sectors = fat_sectors
+                    self.clusters = clusters
+                    self.cluster_size = spc * SECTOR_SIZE
+                    self.data_offset = (RESERVED_SECTORS +
+                                        FAT_COUNT * fat_sectors +
+                                        self.root_sectors) * SECTOR_SIZE
+                    return
+                spc *= 2
+        raise ValueError("can't make FAT{0} filesystem of {1} bytes".format(
+                         fat_bits or '12/16', self.size))
+
+    def _lookup(self, path, create_dirs=False):
+        node = self._root
+        for part in [p for p in path.split('/') if p not in ('', '.')]:
+            child = node.children.get(part.upper())
+            if child is None:
+                if not create_dirs:
+                    raise ValueError("{0}: no such directory".format(path))
+                child = _Node(part, is_dir=True)
+                node.children[part.upper()] = child
+            elif not child.is_dir:
+                raise ValueError("{0}: not a directory".format(path))
+            node = child
+        return node
+
+    def mkdir(self, path):
+        """Create a directory (and missing parents)"""
+        self._lookup(path, create_dirs=True)
+
+    def add_file(self, path, data):
+        """Add (or replace) a file, missing directories are created"""
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        dirname, name = posixpath.split(posixpath.normpath(path))
+        if name in ('', '.', '..'):
+            raise ValueError("{0}: invalid file name".format(path))
+        parent = self._lookup(dirname, create_dirs=True)
+        existing = parent.children.get(name.upper())
+        if existing is not None and existing.is_dir:
+            raise ValueError("{0}: is a directory".format(path))
+        parent.children[name.upper()] = _Node(name, data=data)
+
+    def _assign_names(self, node):
+        taken = set()
+        for child in node.children.values():
+            child.short_name = _short_name(child.name)
+            child.lfn = child.short_name is None
+        taken.update(c.short_name for c in node.children.values()
+                     if c.short_name)
+        for child in node.children.values():
+            if child.short_name is None:
+                child.short_name = _short_alias(child.name, taken)
+                taken.add(child.short_name)
+
+    def _entries_count(self, node):
+        if node is self._root:
+            count = 1 if self.label else 0
+        else:
+            count = 2  # . and ..
+        for child in node.children.values():
+            count += 1
+            if child.lfn:
+                count += len(_lfn_entries(child.name, child.short_name))
+        return count
+
+    def _clusters_for(self, length):
+        return (length + self.cluster_size - 1) // self.cluster_size
+
+    def _allocate(self):
+        """Assign contiguous clusters, return [(node, first, count)]"""
+        extents = []
+        next_cluster = 2
+        pending = [self._root]
+        while pending:
+            node = pending.pop(0)
+            self._assign_names(node)
+            if node is not self._root:
+                length = self._entries_count(node) * DIR_ENTRY_SIZE
+                count = self._clusters_for(length)
+                node.cluster = next_cluster
+                extents.append((node, next_cluster, count))
+                next_cluster += count
+            elif self._entries_count(node) > self.root_entries:
+                raise ValueError("too many files in the root directory")
+            for child in node.children.values():
+                if child.is_dir:
+                    pending.append(child)
+                elif child.data:
+                    count = self._clusters_for(len(child.data))
+                    child.cluster = next_cluster
+                    extents.append((child, next_cluster, count))
+                    next_cluster += count
+        if next_cluster - 2 > self.clusters:
+            raise ValueError("files don't fit into {0} bytes image".format(
+                             self.size))
+        return extents, next_cluster
+
+    def _dir_entry(self, short_name, attr, cluster=0, size=0):
+        date, ftime = _fat_date_time(self.timestamp)
+        return struct.pack('<11sBBBHHHHHHHI', short_name, attr, 0, 0,
+                           ftime, date, date, 0, ftime, date, cluster, size)
+
+    def _dir_data(self, node, parent):
+        entries = []
+        if node is self._root:
+            if self.label:
+                label = self.label.ljust(11).encode('ascii')
+                entries.append(self._dir_entry(label, ATTR_VOLUME_ID))
+        else:
+            parent_cluster = 0 if parent is self._root else parent.cluster
+            entries.append(self._dir_entry(_short_name('.'), ATTR_DIRECTORY,
+                                           node.cluster))
+            entries.append(self._dir_entry(_short_name('..'), ATTR_DIRECTORY,
+                                           parent_cluster))
+        for child in node.children.values():
+            if child.lfn:
+                entries.extend(_lfn_entries(child.name, child.short_name))
+            if child.is_dir:
+                entries.append(self._dir_entry(child.short_name,
+                                               ATTR_DIRECTORY, child.cluster))
+            else:
+                entries.append(self._dir_entry(child.short_name, ATTR_ARCHIVE,
+                                               child.cluster,
+                                               len(child.data)))
+        return b''.join(entries)
+
+    def _fat(self, extents):
+        table = [0] * (self.clusters + 2)
+        table[0] = (EOC[self.fat_bits] & ~0xff) | self.media
+        table[1] = EOC[self.fat_bits]
+        for _, first, count in extents:
+            for cluster in range(first, first + count - 1):
+                table[cluster] = cluster + 1
+            table[first + count - 1] = EOC[self.fat_bits]
+        if self.fat_bits == 16:
+            fat = struct.pack('<{0}H'.format(len(table)), *table)
+        else:
+            fat = bytearray()
+            table.append(0)
+            for n in range(0, len(table) - 1, 2):
+                pair = table[n] | (table[n + 1] << 12)
+                fat.extend(struct.pack('<I', pair)[:3])
+            fat = bytes(fat)
+        return fat.ljust(self.fat_sectors * SECTOR_SIZE, b'\0')
+
+    def _boot_sector(self):
+        total_sectors = self.size // SECTOR_SIZE
+        small, large = (total_sectors, 0) if total_sectors < 0x10000 \
+            else (0, total_sectors)
+        sectors_per_track, heads = FLOPPY_GEOMETRY.get(total_sectors,
+                                                       DISK_GEOMETRY)
+        bpb = struct.pack('<3s8sHBHBHHBHHHII', b'\xeb\x3c\x90', b'MSWIN4.1',
+                          SECTOR_SIZE, self.sectors_per_cluster,
+                          RESERVED_SECTORS, FAT_COUNT, self.root_entries,
+                          small, self.media, self.fat_sectors,
+                          sectors_per_track, heads, 0, large)
+        drive = 0x80 if self.media == MEDIA_DISK else 0
+        ebpb = struct.pack('<BBBI11s8s', drive, 0, 0x29, self.volume_id,
+                           (self.label or 'NO NAME').ljust(11).
+                           encode('ascii'),
+                           'FAT{0}'.format(self.fat_bits).ljust(8).
+                           encode('ascii'))
+        sector = bpb + ebpb
+        return sector.ljust(SECTOR_SIZE - 2, b'\0') + b'\x55\xaa'
+
+    def data(self):
+        """The image up to the end of the last used cluster"""
+        extents, next_cluster = self._allocate()
+        parents = {}
+        for node, _, _ in [(self._root, 0, 0)] + extents:
+            for child in node.children.values():
+                parents[id(child)] = node
+        image = bytearray(self.data_offset +
+                          (next_cluster - 2) * self.cluster_size)
+        image[0:SECTOR_SIZE] = self._boot_sector()
+        fat = self._fat(extents)
+        for n in range(FAT_COUNT):
+            offset = (RESERVED_SECTORS + n * self.fat_sectors) * SECTOR_SIZE
+            image[offset:offset + len(fat)] = fat
+        root_offset = (RESERVED_SECTORS + FAT_COUNT * self.fat_sectors) * \
+            SECTOR_SIZE
+        root = self._dir_data(self._root, None)
+        image[root_offset:root_offset + len(root)] = root
+        for node, first, _ in extents:
+            if node.is_dir:
+                content = self._dir_data(node, parents[id(node)])
+            else:
+                content = node.data
+            offset = self.data_offset + (first - 2) * self.cluster_size
+            image[offset:offset + len(content)] = content
+        return bytes(image)
+
+    def write(self, path, mode=0o644):
+        """Save the image to a (sparse) file, atomically"""
+        data = self.data()
+        with safe_save_file(path, mode='wb') as f:
+            f.write(data)
+            f.truncate(self.size)
+            os.fchmod(f.fileno(), mode)
+        return path
@@ -2,20 +2,21 @@
 
 from __future__ import absolute_import
 
-import copy
-import jinja2
 import optparse
 import os
-import shutil
 import sys
 import uuid
 
 from . import TEMPLATE_DIR
 from .autounattend import Woe2008Autounattend
-from .py3compat import subprocess
+from .fatimage import FatImage
+from .layered import LayeredDict
+from .miscutils import mkdir_p, template_env
+from .provision_vm import CONFIG_DRIVE_MB
 
 
 BUILD_DIR = os.path.expanduser('~/.cache/vmbuilder/config-drive')
+CONFIG_DRIVE_LABEL = 'cidata'
 
 
 class NoCloudGenerator(object):
@@ -23,40 +24,36 @@ class NoCloudGenerator(object):
         self.vm_name = vm_name or 'vm'
         self.distro = distro or 'ubuntu'
         self.template_dir = template_dir or TEMPLATE_DIR
-        self._base_dir = os.path.join(BUILD_DIR, vm_name)
-        self._iso_path = os.path.join(BUILD_DIR, '%s-config.iso' % vm_name)
+        self._img_path = os.path.join(BUILD_DIR, '%s-config.img' % vm_name)
 
-    def _write(self, strdat, name):
-        if not os.path.exists(self._base_dir):
-            os.makedirs(self._base_dir)
-        with open(os.path.join(self._base_dir, name), 'w') as f:
-            f.write(strdat)
-            f.flush()
-
-    def _prepare(self, data):
-        env = jinja2.Environment(loader=jinja2.FileSystemLoader(self.template_dir))
+    def render(self, data):
+        """Rendered templates as a list of (file name, content) tuples"""
+        env = template_env(self.template_dir)
+        rendered = []
         for what in ('user-data', 'meta-data'):
             template_path = '{0}/config-drive/{1}'.format(self.distro, what)
             template = env.get_or_select_template(template_path)
-            out = template.render(data)
-            self._write(out, what)
-
-    def _make_iso(self):
-        tmp_iso = '%s.tmp' % self._iso_path
-        subprocess.check_call(['genisoimage',
-                               '-quiet',
-                               '-input-charset', 'utf-8',
-                               '-volid', 'cidata',
-                               '-joliet',
-                               '-rock',
-                               '-output', tmp_iso,
-                               self._base_dir])
-        shutil.move(tmp_iso, self._iso_path)
-
-    def generate(self, data):
-        self._prepare(data)
-        self._make_iso()
-        return self._iso_path
+            rendered.append((what, template.render(data)))
+        return rendered
+
+    def _prepare(self, data):
+        img = FatImage(CONFIG_DRIVE_MB * 1024 * 1024,
+                       label=CONFIG_DRIVE_LABEL)
+        for what, content in self.render(data):
+            img.add_file(what, content)
+        return img
+
+    def generate(self, data, in_memory=False):
+        """Make the NoCloud (VFAT, labeled cidata) seed image
+
+        Returns the FatImage if in_memory, otherwise saves the image
+        and returns its path.
+        """
+        img = self._prepare(data)
+        if in_memory:
+            return img
+        mkdir_p(BUILD_DIR)
+        return img.write(self._img_path)
 
 
 def pick_generator(distro):
@@ -67,16 +64,28 @@ def pick_generator(distro):
     return generators.get(distro, NoCloudGenerator)
 
 
-def generate_cc(vm_def, template_dir=TEMPLATE_DIR):
-    vm_name = vm_def['vm_name']
-    data = copy.deepcopy(vm_def)
+def _make_generator(vm_def, template_dir=TEMPLATE_DIR):
+    generatorClass = pick_generator(vm_def['distro'])
+    return generatorClass(vm_name=vm_def['vm_name'], distro=vm_def['distro'],
+                          template_dir=template_dir)
+
+
+def generate_cc(vm_def, template_dir=TEMPLATE_DIR, in_memory=False):
+    data = vm_def
     if 'instance_id' not in data:
-        data['instance_id'] = uuid.uuid4()
+        data = LayeredDict({'instance_id': uuid.uuid4()}, vm_def)
 
-    generatorClass = pick_generator(vm_def['distro'])
-    gen = generatorClass(vm_name=vm_name, distro=vm_def['distro'],
-                         template_dir=template_dir)
-    return gen.generate(data)
+    gen = _make_generator(vm_def, template_dir=template_dir)
+    return gen.generate(data, in_memory=in_memory)
+
+
+def render_cc(vm_def, template_dir=TEMPLATE_DIR):
+    """Render the config drive templates without making an image
+
+    Returns a list of (file name, content) tuples.
+    """
+    gen = _make_generator(vm_def, template_dir=template_dir)
+    return gen.render(vm_def)
 
 
 def main():
@@ -106,8 +115,7 @@ def main():
         'web_callback_url': options.web_callback_url,
     }
     for vm_name in args:
-        vm_def = copy.deepcopy(data)
-        vm_def['vm_name'] = vm_name
+        vm_def = LayeredDict({'vm_name': vm_name}, data)
         generate_cc(vm_def, template_dir=options.template_dir)
 
 
@@ -0,0 +1,242 @@
+from __future__ import absolute_import
+
+# Find out the partition layout and filesystems of a drive image without
+# sudo, loop devices, and conversion to raw format
+
+import json
+import os
+import struct
+import threading
+
+from collections import namedtuple
+from .miscutils import mkdir_p, safe_save_file
+from .parttable import (
+    MBR_SIGNATURE,
+    SECTOR_SIZE,
+    Partition,
+    parse_mbr,
+)
+from .sourceimage import detect_format, open_image
+
+CACHE_FILE = os.path.expanduser('~/.cache/vmbuilder/image-probe.json')
+# bump whenever the format of cached data changes
+PROBE_VERSION = 3
+
+# MBR, GPT header and partition entries
+PARTITION_TABLE_SIZE = 34 * SECTOR_SIZE
+GPT_SIGNATURE = b'EFI PART'
+GPT_PROTECTIVE_MBR_TYPE = 0xee
+
+EXT_SUPERBLOCK_OFFSET = 1024
+EXT_SUPERBLOCK_SIZE = 1024
+EXT_MAGIC = 0xef53
+EXT_FEATURE_COMPAT_HAS_JOURNAL = 0x4
+EXT_FEATURE_INCOMPAT_64BIT = 0x80
+# features supported by ext3, anything else means ext4
+EXT3_FEATURE_INCOMPAT_SUPP = 0x2 | 0x4 | 0x10
+EXT3_FEATURE_RO_COMPAT_SUPP = 0x1 | 0x2 | 0x4
+
+FsInfo = namedtuple('FsInfo', ['type', 'block_size', 'blocks_count',
+                               'uuid', 'label'])
+
+
+class ImageInfo(object):
+    """Partitions and filesystems of a drive image"""
+    def __init__(self, format='raw', size=0, partitions=None,
+                 filesystems=None, clean_filesystems=None):
+        self.format = format
+        self.size = size
+        self.partitions = partitions or []
+        # partition number -> FsInfo
+        self.filesystems = filesystems or {}
+        # numbers of partitions holding filesystems which passed fsck
+        self.clean_filesystems = set(clean_filesystems or [])
+
+    def first_partition(self):
+        if not self.partitions:
+            return None
+        return min(self.partitions, key=lambda p: p.number)
+
+    def to_json(self):
+        return {
+            'format': self.format,
+            'size': self.size,
+            'partitions': [p._asdict() for p in self.partitions],
+            'filesystems': dict((str(n), fs._asdict())
+                                for n, fs in self.filesystems.items()),
+            'clean_filesystems': sorted(self.clean_filesystems),
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(format=data['format'],
+                   size=data['size'],
+                   partitions=[Partition(**p) for p in data['partitions']],
+                   filesystems=dict((int(n), FsInfo(**fs)) for n, fs in
+                                    data['filesystems'].items()),
+                   clean_filesystems=data.get('clean_filesystems'))
+
+
+def image_identity(img):
+    """(path, inode, size, mtime) tuple which changes with the image"""
+    path = os.path.realpath(img)
+    st = os.stat(path)
+    return (path, st.st_ino, st.st_size, int(st.st_mtime))
+
+
+def _format_uuid(raw):
+    h = ''.join('%02x' % c for c in bytearray(raw))
+    return '-'.join((h[0:8], h[8:12], h[12:16], h[16:20], h[20:32]))
+
+
+def parse_ext_superblock(sb):
+    """Parse ext[234] superblock, return None if there's none"""
+    if len(sb) < EXT_SUPERBLOCK_SIZE:
+        return None
+    magic, = struct.unpack_from('<H', sb, 0x38)
+    if magic != EXT_MAGIC:
+        return None
+    blocks_lo, = struct.unpack_from('<I', sb, 0x4)
+    log_block_size, = struct.unpack_from('<I', sb, 0x18)
+    compat, incompat, ro_compat = struct.unpack_from('<III', sb, 0x5c)
+    blocks_hi = 0
+    if incompat & EXT_FEATURE_INCOMPAT_64BIT:
+        blocks_hi, = struct.unpack_from('<I', sb, 0x150)
+    if (incompat & ~EXT3_FEATURE_INCOMPAT_SUPP) or \
+            (ro_compat & ~EXT3_FEATURE_RO_COMPAT_SUPP):
+        fstype = 'ext4'
+    elif compat & EXT_FEATURE_COMPAT_HAS_JOURNAL:
+        fstype = 'ext3'
+    else:
+        fstype = 'ext2'
+    label = sb[0x78:0x88].split(b'\0', 1)[0].decode('utf-8', 'replace')
+    return FsInfo(type=fstype,
+                  block_size=1024 << log_block_size,
+                  blocks_count=(blocks_hi << 32) | blocks_lo,
+                  uuid=_format_uuid(sb[0x68:0x78]),
+                  label=label)
+
+
+def parse_gpt(data, sector_size=SECTOR_SIZE):
+    """Parse GPT, data should contain the header and partition entries"""
+    hdr = data[sector_size:2 * sector_size]
+    if hdr[:8] != GPT_SIGNATURE:
+        raise ValueError('no valid GPT found')
+    entries_lba, entries_count, entry_size = \
+        struct.unpack_from('<QII', hdr, 0x48)
+    partitions = []
+    for n in range(entries_count):
+        offset = entries_lba * sector_size + n * entry_size
+        entry = data[offset:offset + entry_size]
+        if len(entry) < 0x38:
+            break
+        type_guid = entry[0:16]
+        if type_guid == b'\0' * 16:
+            continue
+        first_lba, last_lba = struct.unpack_from('<QQ', entry, 0x20)
+        partitions.append(Partition(number=n + 1,
+                                    start=first_lba,
+                                    size=last_lba - first_lba + 1,
+                                    type=_format_uuid(type_guid),
+                                    bootable=False))
+    return partitions
+
+
+def _probe_content(src, info):
+    """Find partitions and filesystems of the (guest visible) content"""
+    data = src.read(0, PARTITION_TABLE_SIZE)
+    if data[SECTOR_SIZE - 2:SECTOR_SIZE] != MBR_SIGNATURE:
+        return info
+    partitions = parse_mbr(data[:SECTOR_SIZE])
+    if any(p.type == GPT_PROTECTIVE_MBR_TYPE for p in partitions):
+        partitions = parse_gpt(data)
+    info.partitions = partitions
+    # compressed images can be read only sequentially
+    for part in sorted(partitions, key=lambda p: p.start):
+        offset = part.start * SECTOR_SIZE + EXT_SUPERBLOCK_OFFSET
+        fs = parse_ext_superblock(src.read(offset, EXT_SUPERBLOCK_SIZE))
+        if fs:
+            info.filesystems[part.number] = fs
+    return info
+
+
+def _probe(img):
+    fmt = detect_format(img)
+    with open_image(img, fmt=fmt) as src:
+        info = ImageInfo(format=fmt, size=src.size)
+        if src.size == 0:
+            return info
+        return _probe_content(src, info)
+
+
+class ProbeCache(object):
+    """Persistent cache of image probe results
+
+    Entries are keyed by the image identity (path, inode, size, mtime),
+    so the image gets probed again whenever it changes.
+    """
+    def __init__(self, path=CACHE_FILE):
+        self._path = path
+        self._mutex = threading.Lock()
+        self._entries = None
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        try:
+            with open(self._path, 'r') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if data.get('version') == PROBE_VERSION:
+            self._entries = data.get('images', {})
+
+    def _save(self):
+        mkdir_p(os.path.dirname(self._path))
+        with safe_save_file(self._path) as f:
+            json.dump({'version': PROBE_VERSION, 'images': self._entries},
+                      f, indent=1, sort_keys=True)
+
+    @staticmethod
+    def _key(identity):
+        return '{0}:{1}:{2}:{3}'.format(*identity)
+
+    def get(self, identity):
+        with self._mutex:
+            self._load()
+            data = self._entries.get(self._key(identity))
+            return ImageInfo.from_json(data) if data else None
+
+    def put(self, identity, info):
+        with self._mutex:
+            self._load()
+            path = identity[0]
+            # forget the previous versions of the image
+            for key in list(self._entries):
+                if key.startswith(path + ':'):
+                    del self._entries[key]
+            self._entries[self._key(identity)] = info.to_json()
+            self._save()
+
+
+_PROBE_CACHE = ProbeCache()
+
+
+def probe_image(img, cache=_PROBE_CACHE):
+    """Get partitions and filesystems info of the image"""
+    identity = image_identity(img)
+    info = cache.get(identity) if cache else None
+    if info is None:
+        info = _probe(identity[0])
+        if cache:
+            cache.put(identity, info)
+    return info
+
+
+def mark_fs_clean(img, number, cache=_PROBE_CACHE):
+    """Remember the filesystem in the given partition has passed fsck"""
+    info = probe_image(img, cache=cache)
+    info.clean_filesystems.add(number)
+    if cache:
+        cache.put(image_identity(img), info)
@@ -1,36 +1,408 @@
-
 from __future__ import absolute_import
 
-from threading import Semaphore
-from .driveutils import vg_is_ssd
+# Limit the number of VMs provisioning/booting concurrently per physical
+# drive. A VM takes a slot on every drive its LVs reside on (whatever VGs
+# they belong to). The limit (concurrency level) starts from the
+# calibrated storage profile (see calibrate) and follows the observed
+# latency and utilization of the drive during the run: it grows by one
+# slot while the drive keeps up, and is halved as soon as the latency
+# gets too high (AIMD).
+#
+# Slots are leased: a VM which does not phone home by the deadline, or
+# whose own disk I/O has died down, gives them up.
+
+import json
+import os
+import threading
+import time
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from .miscutils import mkdir_p, safe_save_file
+from .remotehost import get_host
+from .virtbackend import LIBVIRT_CONNECTION, get_backend
+
+PROFILE_FILE = os.path.expanduser('~/.cache/vmbuilder/storage-profile.json')
+# bump whenever the format of the profile changes
+PROFILE_VERSION = 2
+
+# seconds between samples of the drives' I/O statistics
+SAMPLE_INTERVAL = 2.0
+# average I/O latency (ms) above which the level is halved, unless the
+# drive has been calibrated
+SSD_TARGET_LATENCY = 10.0
+HDD_TARGET_LATENCY = 50.0
+# the latency allowed for a calibrated drive, relative to the probed one
+LATENCY_SLACK = 2.0
+# a device busier than this gets more slots only if the latency is
+# well below the target (i.e. it serves many requests in parallel)
+BUSY_UTILIZATION = 0.95
+# samples skipped after halving the level (slots are held until VMs
+# phone home, so the effect is not immediate)
+DECREASE_HOLDOFF = 2
+# calibrated level: the lowest one giving this share of the best
+# probed throughput
+KNEE_SHARE = 0.9
+
+# seconds a VM may hold its slots (until it phones home), per distro,
+# unless the VM definition says otherwise (io_lease: seconds, or
+# {distro: seconds, default: seconds})
+DEFAULT_IO_LEASES = {
+    'default': 1800,
+    # Windows setup reboots several times before calling back
+    'woe2008': 4 * 3600,
+    'woe10': 4 * 3600,
+}
+# a VM running for IDLE_PERIOD seconds whose drives have been doing less
+# than IDLE_RATE bytes/s during that time gives up its slots early
+IDLE_PERIOD = 60.0
+IDLE_RATE = 512 * 1024
+# seconds between samples of a running VM's block stats
+DOMAIN_SAMPLE_INTERVAL = 10.0
+
+
+def _vm_vgs(vm):
+    """(libvirt URI, vg) of all the VM's LVs"""
+    # VGs of different hypervisors are different ones
+    uri = vm.get('libvirt_uri', LIBVIRT_CONNECTION)
+    return set((uri, drive['vg']) for drive in vm['drives'].values()
+               if isinstance(drive, Mapping) and 'vg' in drive)
+
+
+def lease_timeout(vm):
+    """Seconds the VM may hold its I/O throttler slots"""
+    lease = vm.get('io_lease', DEFAULT_IO_LEASES)
+    if isinstance(lease, Mapping):
+        lease = lease.get(vm['distro'], lease.get(
+            'default', DEFAULT_IO_LEASES['default']))
+    return float(lease)
+
+
+def _profile_key(uri, drive):
+    return '{0} {1}'.format(uri, drive)
+
+
+def load_profile(path=PROFILE_FILE):
+    """Calibrated drives: {'<libvirt URI> <drive>': {'level',
+    'latency_ms', 'vg'}}"""
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    if data.get('version') != PROFILE_VERSION:
+        return {}
+    return data.get('drives', {})
+
 
+def save_profile(entries, path=PROFILE_FILE):
+    mkdir_p(os.path.dirname(path))
+    with safe_save_file(path) as f:
+        json.dump({'version': PROFILE_VERSION, 'drives': entries},
+                  f, indent=1, sort_keys=True)
 
-def _os_vg(vm):
-    return vm['drives']['os']['vg']
 
+def pick_level(results):
+    """The probe result (see storageprobe) of the lowest concurrency level
+    which gives nearly the best throughput"""
+    best = max(r['mb_per_sec'] for r in results)
+    return min((r for r in results if r['mb_per_sec'] >= KNEE_SHARE * best),
+               key=lambda r: r['level'])
 
-def _concurrency_level(vg, max_concurrency_level=8):
-    return max_concurrency_level if vg_is_ssd(vg) else 1
+
+def calibrate(targets, max_level=16, path=PROFILE_FILE):
+    """Probe the storage of (libvirt URI, vg, thin_pool) targets, save
+    the concurrency levels of the drives later runs start from"""
+    entries = load_profile(path)
+    for uri, vg, thin_pool in targets:
+        print("calibrating {0}/{1} ({2})".format(vg, thin_pool, uri))
+        host = get_host(uri)
+        results = host.run('probe_thin_pool', vg=vg, thin_pool=thin_pool,
+                           max_level=max_level)
+        for r in results:
+            print("  level {level:3d}: {mb_per_sec:8.1f} MiB/s, latency "
+                  "{latency}, utilization {utilization:.0%}".format(
+                      latency='n/a' if r['latency_ms'] is None
+                      else '{0:.1f} ms'.format(r['latency_ms']), **r))
+        knee = pick_level(results)
+        for drive in sorted(host.run('vg_drives', vg=vg)):
+            print("{0} ({1}): concurrency level {2}".format(drive, uri,
+                                                           knee['level']))
+            entries[_profile_key(uri, drive)] = {
+                'level': knee['level'],
+                'latency_ms': knee['latency_ms'],
+                'vg': vg,
+                'calibrated_at': time.time(),
+                'probe': results,
+            }
+    save_profile(entries, path)
+    return entries
 
 
 class IOThrottler(object):
     """ Prevent provisioning/initial setup from thrashing hard drives """
-    def __init__(self, vm_list, max_concurrency_level=8):
-        backing_vgs = set(_os_vg(vm) for vm in vm_list)
-        self._all_io_throttlers = dict((vg, Semaphore(_concurrency_level(vg, max_concurrency_level)))
-                                       for vg in backing_vgs)
-        self._io_throttlers = dict((str(vm['instance_id']),
-                                    self._all_io_throttlers[_os_vg(vm)])
-                                   for vm in vm_list)
+    def __init__(self, vm_list, max_concurrency_level=8,
+                 profile_path=PROFILE_FILE, interval=SAMPLE_INTERVAL):
+        profile = load_profile(profile_path)
+        self._max_level = max(int(max_concurrency_level), 1)
+        self._interval = interval
+        self._cond = threading.Condition()
+        # (libvirt URI, drive) -> is it an SSD
+        ssd = {}
+        vg_drives = {}
+        for uri, vg in sorted(set().union(*[_vm_vgs(vm) for vm in vm_list])):
+            drives = get_host(uri).run('vg_drives', vg=vg)
+            vg_drives[(uri, vg)] = [(uri, drive) for drive in drives]
+            ssd.update(((uri, drive), is_ssd)
+                       for drive, is_ssd in drives.items())
+        # drives are always taken in the same (sorted) order
+        self._keys = dict((str(vm['instance_id']),
+                           sorted(set(key for uri_vg in _vm_vgs(vm)
+                                      for key in vg_drives[uri_vg])))
+                          for vm in vm_list)
+        self._levels = {}
+        self._targets = {}
+        self._holders = {}
+        self._pending = {}
+        self._holdoff = {}
+        self._samples = {}
+        for key, is_ssd in ssd.items():
+            calibrated = profile.get(_profile_key(*key), {})
+            if 'level' in calibrated:
+                level = calibrated['level']
+            else:
+                level = self._max_level if is_ssd else 1
+            if calibrated.get('latency_ms'):
+                target = calibrated['latency_ms'] * LATENCY_SLACK
+            else:
+                target = SSD_TARGET_LATENCY if is_ssd \
+                    else HDD_TARGET_LATENCY
+            self._levels[key] = max(min(level, self._max_level), 1)
+            self._targets[key] = target
+            self._holders[key] = set()
+            self._pending[key] = set()
+            self._holdoff[key] = 0
+        for instance_id, keys in self._keys.items():
+            for key in keys:
+                self._pending[key].add(instance_id)
+        self._vms = dict((str(vm['instance_id']),
+                          (vm['vm_name'],
+                           vm.get('libvirt_uri', LIBVIRT_CONNECTION),
+                           lease_timeout(vm)))
+                         for vm in vm_list)
+        # instance_id -> {'acquired', 'started', 'io': [(time, bytes)]}
+        self._leases = {}
+        # (vm_name, seconds held) of leases given up before phoning home
+        self.expired = []
+        self.idle = []
+        self._hooks = []
+        self._release_hooks = []
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def add_hook(self, hook):
+        """hook(uri=, drive=, level=) is called whenever a level changes"""
+        self._hooks.append(hook)
+
+    def add_release_hook(self, hook):
+        """hook(instance_id=) is called whenever a lease expires or is
+        given up by an idle VM"""
+        self._release_hooks.append(hook)
+
+    def drives(self, instance_id):
+        """Drives the VM takes slots on"""
+        return [drive for _, drive in self._keys[str(instance_id)]]
 
-    def _semaphore(self, instance_id):
-        return self._io_throttlers[str(instance_id)]
+    def concurrency_level(self, drive, uri=LIBVIRT_CONNECTION):
+        return self._levels[(uri, drive)]
 
     def release(self, **kwargs):
-        """ called after provisioning has finished """
-        self._semaphore(kwargs['instance_id']).release()
+        """ called after provisioning has finished (more calls, i.e.
+        after the lease has expired, are no-ops) """
+        self._release(str(kwargs['instance_id']))
+
+    def _release(self, instance_id):
+        """End the lease, return it (None if there's none)"""
+        keys = self._keys.get(instance_id)
+        if keys is None:
+            return None
+        with self._cond:
+            for key in keys:
+                self._holders[key].discard(instance_id)
+            self._cond.notify_all()
+            return self._leases.pop(instance_id, None)
+
+    def vm_started(self, instance_id):
+        """The VM has been started: watch its own disk I/O"""
+        with self._cond:
+            lease = self._leases.get(str(instance_id))
+            if lease is not None:
+                lease['started'] = time.time()
 
     def acquire(self, instance_id):
         """ called before starting the provisioning """
-        self._semaphore(instance_id).acquire()
+        with self._cond:
+            while not self.try_acquire(instance_id):
+                self._cond.wait()
+
+    def try_acquire(self, instance_id):
+        """ non-blocking acquire of slots on all the VM's drives (or none),
+        returns True on success """
+        instance_id = str(instance_id)
+        keys = self._keys[instance_id]
+        with self._cond:
+            for key in keys:
+                if len(self._holders[key]) >= self._levels[key]:
+                    return False
+            for key in keys:
+                self._holders[key].add(instance_id)
+                self._pending[key].discard(instance_id)
+            self._leases[instance_id] = {'acquired': time.time(),
+                                         'started': None, 'io': []}
+            return True
+
+    def _idle(self, instance_id, lease, now):
+        """Sample the VM's block stats, check if it has been idle for
+        IDLE_PERIOD"""
+        vm_name, uri, _ = self._vms[instance_id]
+        samples = lease['io']
+        if lease['started'] is None or \
+                now - lease['started'] < DOMAIN_SAMPLE_INTERVAL or \
+                samples and now - samples[-1][0] < DOMAIN_SAMPLE_INTERVAL:
+            return False
+        try:
+            stats = get_backend(uri).block_stats(vm_name)
+        except Exception:
+            # the domain is gone or restarting, the deadline still holds
+            return False
+        samples.append((now, stats['rd_bytes'] + stats['wr_bytes']))
+        # keep the oldest sample within the period (and one before it)
+        while len(samples) > 1 and now - samples[1][0] >= IDLE_PERIOD:
+            samples.pop(0)
+        start, done = samples[0]
+        if now - start < IDLE_PERIOD:
+            return False
+        return (samples[-1][1] - done) / (now - start) < IDLE_RATE
+
+    def _check_leases(self):
+        now = time.time()
+        with self._cond:
+            leases = list(self._leases.items())
+        for instance_id, lease in leases:
+            vm_name, uri, timeout = self._vms[instance_id]
+            held = now - lease['acquired']
+            if held > timeout:
+                reason, ended = 'expired', self.expired
+            elif self._idle(instance_id, lease, now):
+                reason, ended = 'released (the VM is idle)', self.idle
+            else:
+                continue
+            if self._release(instance_id) is None:
+                # phoned home meanwhile
+                continue
+            ended.append((vm_name, held))
+            print("vm {0}: I/O throttler lease {1} after {2:.0f} "
+                  "seconds".format(vm_name, reason, held))
+            for hook in self._release_hooks:
+                hook(instance_id=instance_id)
+
+    def occupancy(self):
+        """Slots of every drive, and the number of leases"""
+        with self._cond:
+            drives = [{'uri': uri, 'drive': drive,
+                       'held': len(self._holders[(uri, drive)]),
+                       'level': self._levels[(uri, drive)],
+                       'waiting': len(self._pending[(uri, drive)])}
+                      for uri, drive in sorted(self._levels)]
+            leases = {'active': len(self._leases),
+                      'expired': len(self.expired),
+                      'idle': len(self.idle)}
+        return {'drives': drives, 'leases': leases}
+
+    def lease_summary(self):
+        """Leases given up before VMs phoned home, '' if none"""
+        lines = []
+        for title, ended in (('expired', self.expired),
+                             ('released early (idle)', self.idle)):
+            if ended:
+                lines.append("I/O throttler leases {0}: {1}".format(
+                    title, ', '.join('{0} ({1:.0f} s)'.format(vm, held)
+                                     for vm, held in sorted(ended))))
+        return '\n'.join(lines)
+
+    def _sample(self, uri, keys):
+        """Measure the hypervisor's drives since the previous sample,
+        adjust their levels accordingly"""
+        now = time.time()
+        stats = get_host(uri).run('disk_stats',
+                                  devices=[drive for _, drive in keys])
+        for key, new in zip(keys, stats):
+            previous = self._samples.get(key)
+            self._samples[key] = (now, new)
+            if previous is None:
+                continue
+            old = previous[1]
+            elapsed = (now - previous[0]) * 1000.0
+            ios = new['read_ios'] + new['write_ios'] - \
+                old['read_ios'] - old['write_ios']
+            ticks = new['read_ticks'] + new['write_ticks'] - \
+                old['read_ticks'] - old['write_ticks']
+            latency = float(ticks) / ios if ios else 0.0
+            utilization = (new['io_ticks'] - old['io_ticks']) / elapsed
+            self._adjust(key, latency, utilization)
+
+    def _adjust(self, key, latency, utilization):
+        uri, drive = key
+        target = self._targets[key]
+        with self._cond:
+            old_level = level = self._levels[key]
+            if self._holdoff[key] > 0:
+                self._holdoff[key] -= 1
+            elif latency > target:
+                level = max(level // 2, 1)
+                self._holdoff[key] = DECREASE_HOLDOFF
+            elif self._pending[key] and len(self._holders[key]) >= level \
+                    and (utilization < BUSY_UTILIZATION or
+                         latency < target / 2):
+                level = min(level + 1, self._max_level)
+            self._levels[key] = level
+            self._cond.notify_all()
+        if level != old_level:
+            print("drive {0} ({1}): concurrency level {2} -> {3} (latency "
+                  "{4:.1f} ms, utilization {5:.0%})".format(
+                      drive, uri, old_level, level, latency, utilization))
+            for hook in self._hooks:
+                hook(uri=uri, drive=drive, level=level)
+
+    def _sampler(self):
+        by_uri = {}
+        for key in sorted(self._levels):
+            by_uri.setdefault(key[0], []).append(key)
+        while not self._stopped.wait(self._interval):
+            for uri, keys in sorted(by_uri.items()):
+                try:
+                    self._sample(uri, keys)
+                except Exception as e:
+                    # keep the current levels
+                    print("{0}: failed to sample I/O stats: {1}".format(
+                          uri, e))
+            self._check_leases()
+
+    def start(self):
+        """Start adjusting the levels to the observed I/O, and watching
+        the leases"""
+        if self._thread is None and self._levels:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._sampler,
+                                            name='io-throttler')
+            self._thread.daemon = True
+            self._thread.start()
 
+    def stop(self):
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,60 @@
+from __future__ import absolute_import
+
+# Read-only layered mappings: VM definitions share the cluster wide
+# layers (builtin defaults, machine, host) instead of copying them
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+
+class LayeredDict(Mapping):
+    """Read-only ChainMap: the first layer having the key wins
+
+    Keys are ordered as if the layers were dict.update'd from the last
+    one to the first one.
+    """
+    def __init__(self, *layers):
+        self._layers = tuple(layer for layer in layers if layer is not None)
+
+    def __getitem__(self, key):
+        for layer in self._layers:
+            if key in layer:
+                return layer[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return any(key in layer for layer in self._layers)
+
+    def __iter__(self):
+        seen = set()
+        for layer in reversed(self._layers):
+            for key in layer:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(type(self).__name__, self.to_dict())
+
+    def new_child(self, **overrides):
+        """A view of this mapping with the given keys overridden"""
+        return type(self)(overrides, self)
+
+    def to_dict(self):
+        """Materialize as plain (nested) dicts"""
+        return dict((key, _materialize(value)) for key, value in self.items())
+
+
+def _materialize(value):
+    if isinstance(value, LayeredDict):
+        return value.to_dict()
+    elif isinstance(value, Mapping):
+        return dict((k, _materialize(v)) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        return [_materialize(v) for v in value]
+    return value
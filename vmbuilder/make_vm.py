@@ -2,49 +2,49 @@
 
 from __future__ import (absolute_import, division)
 
-import copy
-import jinja2
 import optparse
 import os
 import shutil
 import yaml
 from xml.etree import ElementTree
 
+from .layered import LayeredDict
+from .miscutils import template_env
 from .virtutils import get_vm_macs, define_vm
 from .virtutils import LIBVIRT_CONNECTION
-from .thinpool import create_thin_lv
+from .remotehost import get_host
 from . import TEMPLATE_DIR
 
 VM_TEMPLATE = 'vm.xml'
 
 
+def render_vm_xml(vm_params, template=VM_TEMPLATE,
+                  template_dir=TEMPLATE_DIR):
+    """Render the domain XML template (as a string)"""
+    env = template_env(template_dir)
+    tpl = env.get_or_select_template(template)
+    return tpl.render(vm_params)
+
+
 def make_vm_xml(vm_def,
                 template=VM_TEMPLATE,
                 template_dir=TEMPLATE_DIR,
                 conn=LIBVIRT_CONNECTION):
 
     vm_name = vm_def['vm_name']
-    env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir))
-    extra_functions = {
-        'ord': ord,
-        'chr': chr,
-    }
-    extra_filters = {
-        'hex': hex,
-    }
-    env.globals.update(extra_functions)
-    env.filters.update(extra_filters)
-
-    vm_params = copy.deepcopy(vm_def)
     # keep MAC addresses stable across VM re-definitions
     old_ifaces = get_vm_macs(vm_name, conn=conn)
-    for _, iface in vm_params['interfaces'].items():
+    macs = {}
+    for name, iface in vm_def['interfaces'].items():
         mac = old_ifaces.get(iface['source_net'])
         if mac:
-            iface.update(mac=mac)
+            macs[name] = LayeredDict({'mac': mac}, iface)
+    vm_params = LayeredDict({'interfaces': LayeredDict(macs,
+                                                       vm_def['interfaces'])},
+                            vm_def)
 
-    tpl = env.get_or_select_template(template)
-    raw_out = tpl.render(vm_params)
+    raw_out = render_vm_xml(vm_params, template=template,
+                            template_dir=template_dir)
     try:
         new_vm_xml = ElementTree.fromstring(raw_out)
     except:
@@ -58,15 +58,20 @@ def make_vm_xml(vm_def,
 def create_vm_lvs(vm_name=None,
                   role=None,
                   drives=None,
-                  template_dir=TEMPLATE_DIR):
+                  template_dir=TEMPLATE_DIR,
+                  conn=LIBVIRT_CONNECTION):
+
+    # LVs are made on the hypervisor
+    host = get_host(conn)
 
     def make_lvs(group, data, **kwargs):
         # data = {'vg': 'ssd-vg', 'thin_pool': 'vmpool'}
         lv_name = '%s-%s' % (vm_name, group)
-        create_thin_lv(vg=drives[group]['vg'],
-                       thin_pool=drives[group]['thin_pool'],
-                       size=drives[group]['disk_size'],
-                       name=lv_name)
+        host.run('create_thin_lv',
+                 vg=drives[group]['vg'],
+                 thin_pool=drives[group]['thin_pool'],
+                 size=drives[group]['disk_size'],
+                 name=lv_name)
 
     def make_nop(group, data, **kwargs):
         print('skipping group %s for vm %s' % (group, vm_name))
@@ -98,7 +103,8 @@ def redefine_vm(vm_def,
         define_vm(vm_xml=new_vm_xml, conn=conn)
         create_vm_lvs(vm_name=vm_name,
                       role=vm_def['role'],
-                      drives=vm_def['drives'])
+                      drives=vm_def['drives'],
+                      conn=conn)
 
 
 def main():
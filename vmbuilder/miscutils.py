@@ -3,9 +3,11 @@ from __future__ import absolute_import
 
 # encoding: utf-8
 import errno
+import jinja2
 import os
 import random
 import string
+import threading
 import time
 import traceback
 import sys
@@ -15,6 +17,9 @@ from collections import OrderedDict
 from contextlib import contextmanager
 from .py3compat import subprocess
 
+_TEMPLATE_ENVS = {}
+_TEMPLATE_ENVS_MUTEX = threading.Lock()
+
 
 def forward_thread_exceptions(queue):
     """Catch all exceptions and put exception info into the given queue"""
@@ -93,10 +98,10 @@ def make_temp_filename(filename, prefix_len=8):
 
 
 @contextmanager
-def safe_save_file(filename):
+def safe_save_file(filename, mode='w'):
     """Write all data to a new file, and rename it afterwards"""
     temp_filename = make_temp_filename(filename)
-    temp_file = open(temp_filename, 'w')
+    temp_file = open(temp_filename, mode)
     try:
         yield temp_file
         temp_file.flush()
@@ -107,6 +112,24 @@ def safe_save_file(filename):
         raise
 
 
+def template_env(template_dir):
+    """Jinja environment for the given template directory
+
+    The environment (along with compiled templates) is shared by all
+    callers, FileSystemLoader reloads templates changed on disk.
+    """
+    with _TEMPLATE_ENVS_MUTEX:
+        env = _TEMPLATE_ENVS.get(template_dir)
+        if env is None:
+            env = jinja2.Environment(
+                loader=jinja2.FileSystemLoader(template_dir))
+            # used by the domain XML templates
+            env.globals.update(ord=ord, chr=chr)
+            env.filters.update(hex=hex)
+            _TEMPLATE_ENVS[template_dir] = env
+        return env
+
+
 def padded(seq):
     """Pad the sequence with infinite None, None, None, ..."""
     try:
@@ -0,0 +1,78 @@
+from __future__ import absolute_import
+
+import struct
+
+from collections import namedtuple
+from .driveutils import write_at
+
+SECTOR_SIZE = 512
+MBR_SIGNATURE = b'\x55\xaa'
+MBR_TABLE_OFFSET = 446
+MBR_ENTRY_SIZE = 16
+MBR_BOOTABLE = 0x80
+# CHS address meaning "use LBA"
+MBR_LBA_ONLY_CHS = b'\xfe\xff\xff'
+
+Partition = namedtuple('Partition', ['number', 'start', 'size', 'type',
+                                     'bootable'])
+
+
+def parse_mbr(sector):
+    """Parse primary partitions of the MBR, start and size are in sectors"""
+    if len(sector) < SECTOR_SIZE or \
+            sector[SECTOR_SIZE - 2:SECTOR_SIZE] != MBR_SIGNATURE:
+        raise ValueError('no valid MBR found')
+    partitions = []
+    for n in range(4):
+        offset = MBR_TABLE_OFFSET + n * MBR_ENTRY_SIZE
+        entry = sector[offset:offset + MBR_ENTRY_SIZE]
+        status, ptype, start, size = struct.unpack('<B3xB3xII', entry)
+        if ptype == 0 or size == 0:
+            continue
+        partitions.append(Partition(number=n + 1, start=start, size=size,
+                                    type=ptype, bootable=(status == 0x80)))
+    return partitions
+
+
+def read_partitions(path):
+    """Read the partition table of a drive or a drive image"""
+    with open(path, 'rb') as f:
+        return parse_mbr(f.read(SECTOR_SIZE))
+
+
+def make_mbr(partitions, boot_code=None):
+    """Make MBR holding the given primary partitions
+
+    boot_code: the boot loader (first 446 bytes of the source MBR)
+    """
+    mbr = bytearray(SECTOR_SIZE)
+    if boot_code:
+        boot_code = boot_code[:MBR_TABLE_OFFSET]
+        mbr[:len(boot_code)] = boot_code
+    for part in partitions:
+        if not 1 <= part.number <= 4:
+            raise ValueError("invalid primary partition number: {0}".
+                             format(part.number))
+        offset = MBR_TABLE_OFFSET + (part.number - 1) * MBR_ENTRY_SIZE
+        entry = struct.pack('<B3sB3sII',
+                            MBR_BOOTABLE if part.bootable else 0,
+                            MBR_LBA_ONLY_CHS,
+                            part.type,
+                            MBR_LBA_ONLY_CHS,
+                            part.start,
+                            part.size)
+        mbr[offset:offset + MBR_ENTRY_SIZE] = entry
+    mbr[SECTOR_SIZE - 2:SECTOR_SIZE] = MBR_SIGNATURE
+    return bytes(mbr)
+
+
+def write_boot_area(path, partitions, boot_area=None, fsync=True):
+    """Write the partition table along with the source boot loader
+
+    boot_area: the first sectors of the source drive, its boot code and
+    post-MBR gap are kept, its partition table is replaced.
+    All data is written at once, and flushed just once.
+    """
+    boot_area = boot_area or b''
+    mbr = make_mbr(partitions, boot_code=boot_area[:MBR_TABLE_OFFSET])
+    write_at(path, [(0, mbr + boot_area[SECTOR_SIZE:])], fsync=fsync)
@@ -0,0 +1,210 @@
+from __future__ import absolute_import
+
+# Assign VMs to hypervisors (libvirt hosts) by free RAM, free thin pool
+# space and storage class
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from .clustercontext import ClusterContext
+from .layered import LayeredDict
+from .remotehost import get_host
+from .virtbackend import get_backend
+
+
+class PlacementError(ValueError):
+    pass
+
+
+def _is_lv_drive(drive):
+    return isinstance(drive, Mapping) and \
+        ('vg' in drive or 'storage_class' in drive)
+
+
+def vm_ram(vm_def):
+    """RAM the VM might use, MiB"""
+    return max(int(vm_def['base_ram']), int(vm_def.get('max_ram') or 0))
+
+
+class Hypervisor(object):
+    """A libvirt host VMs can be placed on
+
+    hypervisors:
+      - name: hv1
+        uri: qemu+ssh://root@hv1/system
+        # MiB available to VMs, free memory reported by libvirtd if omitted
+        ram: 65536
+        storage:
+          # storage class: thin pool, free space (MiB) is probed if omitted
+          ssd:
+            vg: nvme
+            thin_pool: vmpool
+        # VMs on remote hypervisors need a route to the callback
+        web_callback_url: http://10.0.0.1:8080
+
+    VM drives refer either to a storage class, or to a VG and thin pool
+    (which must be listed in storage, if given).
+    """
+    def __init__(self, name, uri, storage=None, ram=None,
+                 web_callback_url=None, cluster_def=None):
+        self.name = name
+        self.uri = uri
+        self.storage = storage
+        self.ram = ram
+        self.context = ClusterContext(cluster_def or {}, conn=uri,
+                                      web_callback_url=web_callback_url)
+        self._free_ram = None
+        self._free_storage = {}
+
+    @property
+    def host(self):
+        return get_host(self.uri)
+
+    def thin_pool(self, drive):
+        """(vg, thin_pool) the drive would use here, None if there's none
+        of the drive's storage class"""
+        if 'storage_class' in drive:
+            spec = (self.storage or {}).get(drive['storage_class'])
+            return (spec['vg'], spec['thin_pool']) if spec else None
+        pool = (drive['vg'], drive['thin_pool'])
+        if self.storage is None:
+            return pool
+        for spec in self.storage.values():
+            if (spec['vg'], spec['thin_pool']) == pool:
+                return pool
+        return None
+
+    def free_ram(self):
+        """MiB"""
+        if self._free_ram is None:
+            if self.ram is not None:
+                self._free_ram = int(self.ram)
+            else:
+                self._free_ram = get_backend(self.uri).node_free_memory() \
+                    // 1024
+        return self._free_ram
+
+    def free_storage(self, pool):
+        """Free space of the (vg, thin_pool), MiB"""
+        if pool not in self._free_storage:
+            free = None
+            for spec in (self.storage or {}).values():
+                if (spec['vg'], spec['thin_pool']) == pool:
+                    free = spec.get('free')
+            if free is None:
+                vg, thin_pool = pool
+                free = self.host.run('thin_pool_free', vg=vg,
+                                     thin_pool=thin_pool)
+            self._free_storage[pool] = float(free)
+        return self._free_storage[pool]
+
+    def demand(self, vm_def):
+        """{(vg, thin_pool): MiB} the VM needs here, None if it can't
+        be placed here at all"""
+        if vm_def['distro'].startswith('woe') and not self.host.local:
+            # install media and the floppy are files on this host
+            return None
+        demand = {}
+        for drive in vm_def['drives'].values():
+            if not _is_lv_drive(drive):
+                continue
+            pool = self.thin_pool(drive)
+            if pool is None:
+                return None
+            demand[pool] = demand.get(pool, 0) + int(drive['disk_size'])
+        return demand
+
+    def fits(self, vm_def, demand):
+        if vm_ram(vm_def) > self.free_ram():
+            return False
+        return all(size <= self.free_storage(pool)
+                   for pool, size in demand.items())
+
+    def take(self, vm_def, demand):
+        self._free_ram -= vm_ram(vm_def)
+        for pool, size in demand.items():
+            self._free_storage[pool] -= size
+
+    def place(self, vm_def):
+        """Layer the VM definition with this hypervisor's values"""
+        drives = {}
+        for group, drive in vm_def['drives'].items():
+            if _is_lv_drive(drive) and 'vg' not in drive:
+                vg, thin_pool = self.thin_pool(drive)
+                drives[group] = LayeredDict({'vg': vg,
+                                             'thin_pool': thin_pool}, drive)
+        overrides = dict(self.context.vm_facts())
+        overrides.update(hypervisor=self.name, libvirt_uri=self.uri,
+                         drives=LayeredDict(drives, vm_def['drives']))
+        return vm_def.new_child(**overrides)
+
+
+def load_hypervisors(cluster_def):
+    """Hypervisors of the cluster definition, [] if there's only
+    the local one"""
+    hypervisors = []
+    for spec in cluster_def.get('hypervisors') or []:
+        hypervisors.append(Hypervisor(
+            spec['name'], spec['uri'],
+            storage=spec.get('storage'),
+            ram=spec.get('ram'),
+            web_callback_url=spec.get('web_callback_url'),
+            cluster_def=cluster_def))
+    names = [hv.name for hv in hypervisors]
+    if len(set(names)) != len(names):
+        raise ValueError("hypervisor names must be unique: {0}".format(
+                         ', '.join(names)))
+    return hypervisors
+
+
+def place_vms(vm_list, hypervisors, previous=None):
+    """Assign VMs to hypervisors, return the VM definitions layered with
+    the hypervisor specific values (libvirt URI, VGs, facts)
+
+    Biggest VMs are placed first, each onto the hypervisor with the most
+    RAM left (the one it was placed onto before if it still fits there).
+    VMs pinned with `hypervisor: name` are placed onto that one only.
+    previous: {vm_name: hypervisor_name} of the last run
+    """
+    previous = previous or {}
+    by_name = dict((hv.name, hv) for hv in hypervisors)
+
+    def size(vm_def):
+        disk = sum(int(drive['disk_size'])
+                   for drive in vm_def['drives'].values()
+                   if _is_lv_drive(drive))
+        return (-vm_ram(vm_def), -disk, vm_def['vm_name'])
+
+    placement = {}
+    for vm_def in sorted(vm_list, key=size):
+        vm_name = vm_def['vm_name']
+        pinned = vm_def.get('hypervisor')
+        if pinned is not None and pinned not in by_name:
+            raise PlacementError("vm {0}: no such hypervisor: {1}".format(
+                                 vm_name, pinned))
+        candidates = [by_name[pinned]] if pinned else hypervisors
+        fitting = []
+        for hv in candidates:
+            demand = hv.demand(vm_def)
+            if demand is not None and hv.fits(vm_def, demand):
+                fitting.append((hv, demand))
+        if not fitting:
+            raise PlacementError(
+                "vm {0}: no hypervisor ({1}) has {2} MiB RAM and space "
+                "for its drives".format(vm_name,
+                                        ', '.join(hv.name
+                                                  for hv in candidates),
+                                        vm_ram(vm_def)))
+        sticky = [(hv, demand) for hv, demand in fitting
+                  if hv.name == previous.get(vm_name)]
+        hv, demand = (sticky or sorted(
+            fitting, key=lambda entry: (-entry[0].free_ram(),
+                                        entry[0].name)))[0]
+        hv.take(vm_def, demand)
+        placement[vm_name] = hv
+        print("vm {0}: placed on {1} ({2})".format(vm_name, hv.name,
+                                                   hv.uri))
+    return [placement[vm_def['vm_name']].place(vm_def)
+            for vm_def in vm_list]
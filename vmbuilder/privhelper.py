@@ -0,0 +1,585 @@
+#!/usr/bin/env python
+# Purpose: run privileged operations (LVM, device mapper, device nodes
+# ownership) in a single helper started by sudo once per run, instead of
+# forking sudo for every command
+
+from __future__ import absolute_import
+
+import json
+import optparse
+import os
+import re
+import shutil
+import socket
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+from contextlib import contextmanager
+from .miscutils import refresh_sudo_credentials
+from .py3compat import count_command, subprocess
+
+# installed entry point (bin/vmbuilder-privhelper), sudo looks it up in
+# its secure_path, so sudoers can allow running just the helper
+HELPER_COMMAND = 'vmbuilder-privhelper'
+START_TIMEOUT = 30
+# <asm-generic/socket.h>
+SO_PEERCRED = 17
+# <asm-generic/fcntl.h>, python 2 lacks os.O_PATH
+O_PATH = getattr(os, 'O_PATH', 0o10000000)
+# LVs made by vmbuilder are tagged, the helper removes, renames, etc
+# them only, and changes ownership of their device nodes (and of their
+# partition mappings)
+LV_TAG = 'vmbuilder'
+
+# LVM names and paths (VG, LV, VG/LV), device mapper names
+NAME_RE = re.compile(r'^[A-Za-z0-9+_.][A-Za-z0-9+_.-]*$')
+# device mapper name of an LV: <vg>-<lv>, dashes doubled
+DM_LV_NAME_RE = re.compile(r'^((?:[^-]|--)+)-((?:[^-]|--)+)$')
+LVM_FIELDS = (
+    'chunk_size',
+    'data_percent',
+    'lv_name',
+    'lv_size',
+    'lv_uuid',
+    'pool_lv',
+    'pv_name',
+    'vg_name',
+)
+
+
+class HelperError(RuntimeError):
+    pass
+
+
+def _name(value):
+    value = str(value)
+    if not NAME_RE.match(value):
+        raise HelperError("invalid name: {0!r}".format(value))
+    return value
+
+
+def _lv_path(value):
+    return '/'.join(_name(part) for part in str(value).split('/', 1))
+
+
+def _number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise HelperError("not a number: {0!r}".format(value))
+    return value
+
+
+def _one_of(value, choices):
+    if value not in choices:
+        raise HelperError("{0!r} is not one of {1}".format(value, choices))
+    return str(value)
+
+
+def _fields(fields):
+    return ','.join(_one_of(f, LVM_FIELDS) for f in fields)
+
+
+def _dm_major():
+    with open('/proc/devices', 'r') as f:
+        for line in f:
+            items = line.split()
+            if len(items) == 2 and items[1] == 'device-mapper':
+                return int(items[0])
+    raise HelperError("device-mapper is not available")
+
+
+def _dm_attrs(sysfs_dir):
+    """(name, uuid) of the device mapper device"""
+    attrs = []
+    for attr in ('name', 'uuid'):
+        with open(os.path.join(sysfs_dir, 'dm', attr), 'r') as f:
+            attrs.append(f.read().strip())
+    return tuple(attrs)
+
+
+def _tagged_lvs(vg):
+    """Names of the VG's LVs made by vmbuilder"""
+    rc, out, _ = _run(['lvs', '--noheadings', '--separator', '|',
+                       '-o', 'lv_name,lv_tags', _name(vg)])
+    if rc != 0:
+        return set()
+    tagged = set()
+    for line in out.strip().split('\n'):
+        fields = line.strip().split('|')
+        if len(fields) == 2 and LV_TAG in fields[1].split(','):
+            tagged.add(fields[0])
+    return tagged
+
+
+def _check_lvs(vg, lvs):
+    untagged = sorted(set(lvs) - _tagged_lvs(vg))
+    if untagged:
+        raise HelperError("{0}: not made by vmbuilder: {1}".format(
+                          vg, ', '.join(untagged)))
+
+
+def _is_vmbuilder_lv(sysfs_dir):
+    name, uuid = _dm_attrs(sysfs_dir)
+    match = DM_LV_NAME_RE.match(name)
+    if not uuid.startswith('LVM-') or not match:
+        return False
+    vg, lv = (part.replace('--', '-') for part in match.groups())
+    return lv in _tagged_lvs(vg)
+
+
+def _check_drive(st, path, kind=None):
+    """Check if the device node (stat result) is an LV made by vmbuilder
+    or a partition mapping of one (see activate_partitions), which is
+    found in /dev/mapper. kind: 'lv' or 'partition' to allow just these.
+    Returns the device mapper name."""
+    if not stat.S_ISBLK(st.st_mode) or os.major(st.st_rdev) != _dm_major():
+        raise HelperError("{0}: not a device mapper device".format(path))
+    sysfs_dir = '/sys/dev/block/{0}:{1}'.format(os.major(st.st_rdev),
+                                                os.minor(st.st_rdev))
+    name, uuid = _dm_attrs(sysfs_dir)
+    mapper_node = os.path.join('/dev/mapper', name)
+    if not os.path.exists(mapper_node) or \
+            os.stat(mapper_node).st_rdev != st.st_rdev:
+        raise HelperError("{0}: not in /dev/mapper".format(path))
+    if uuid.startswith('LVM-'):
+        allowed = kind != 'partition' and _is_vmbuilder_lv(sysfs_dir)
+    elif kind == 'lv':
+        allowed = False
+    else:
+        # <lv name>N mapping a part of the LV
+        slaves = os.listdir(os.path.join(sysfs_dir, 'slaves'))
+        allowed = False
+        if len(slaves) == 1:
+            lv_sysfs_dir = os.path.join('/sys/block', slaves[0])
+            lv_name = _dm_attrs(lv_sysfs_dir)[0] \
+                if os.path.isdir(os.path.join(lv_sysfs_dir, 'dm')) else ''
+            allowed = lv_name and name.startswith(lv_name) and \
+                name[len(lv_name):].isdigit() and \
+                _is_vmbuilder_lv(lv_sysfs_dir)
+    if not allowed:
+        raise HelperError("{0}: not a drive made by vmbuilder".format(path))
+    return name
+
+
+def _dm_node(path):
+    """Resolve the path to a device node in /dev or /dev/mapper"""
+    node = os.path.realpath(str(path))
+    if os.path.dirname(node) not in ('/dev', '/dev/mapper'):
+        raise HelperError("{0}: not a device node".format(path))
+    return node
+
+
+def _lvs(target=None, fields=(), units=None, separator=None):
+    argv = ['lvs', '--noheadings']
+    if units is not None:
+        argv.extend(['--nosuffix', '--units', _one_of(units, ('b', 'm'))])
+    if separator is not None:
+        argv.extend(['--separator', _one_of(separator, ('|', ';'))])
+    argv.extend(['-o', _fields(fields), _lv_path(target)])
+    return argv
+
+
+def _pvs(fields=(), separator=None):
+    argv = ['pvs', '--noheadings']
+    if separator is not None:
+        argv.extend(['--separator', _one_of(separator, ('|', ';'))])
+    argv.extend(['-o', _fields(fields)])
+    return argv
+
+
+def _lvcreate_thin(vg=None, thin_pool=None, name=None, size=None):
+    return ['lvcreate', '-T', '{0}/{1}'.format(_name(vg), _name(thin_pool)),
+            '-n', _name(name), '-V', '{0}M'.format(_number(size)),
+            '--addtag', LV_TAG]
+
+
+def _lvcreate_snapshot(vg=None, lv=None, name=None):
+    return ['lvcreate', '-s', '-n', _name(name), '--addtag', LV_TAG,
+            '{0}/{1}'.format(_name(vg), _name(lv))]
+
+
+def _lvchange_activate(vg=None, lv=None):
+    return ['lvchange', '-ay', '-K', '{0}/{1}'.format(_name(vg), _name(lv))]
+
+
+def _lvremove(vg=None, lv=None):
+    return ['lvremove', '-f', '{0}/{1}'.format(_name(vg), _name(lv))]
+
+
+def _lvremove_many(vg=None, lvs=()):
+    if not isinstance(lvs, (list, tuple)) or not lvs:
+        raise HelperError("not a list of LVs: {0!r}".format(lvs))
+    return ['lvremove', '-f'] + ['{0}/{1}'.format(_name(vg), _name(lv))
+                                 for lv in lvs]
+
+
+def _lvrename(vg=None, old_lv=None, lv=None):
+    return ['lvrename', '{0}/{1}'.format(_name(vg), _name(old_lv)),
+            '{0}/{1}'.format(_name(vg), _name(lv))]
+
+
+def _dmsetup_create_linear(name=None, dev=None, start=None, size=None):
+    table = '0 {0} linear {1} {2}'.format(int(_number(size)), _dm_node(dev),
+                                          int(_number(start)))
+    return ['dmsetup', 'create', _name(name), '--table', table]
+
+
+def _dmsetup_remove(name=None):
+    return ['dmsetup', 'remove', _name(name)]
+
+
+# allowed commands: operation name -> argv builder
+COMMANDS = {
+    'lvs': _lvs,
+    'pvs': _pvs,
+    'lvcreate_thin': _lvcreate_thin,
+    'lvcreate_snapshot': _lvcreate_snapshot,
+    'lvchange_activate': _lvchange_activate,
+    'lvremove': _lvremove,
+    'lvremove_many': _lvremove_many,
+    'lvrename': _lvrename,
+    'dmsetup_create_linear': _dmsetup_create_linear,
+    'dmsetup_remove': _dmsetup_remove,
+}
+
+
+def _check_tagged_lv(vg=None, lv=None, **kwargs):
+    _check_lvs(vg, [lv])
+
+
+def _check_tagged_lvs(vg=None, lvs=()):
+    _check_lvs(vg, lvs)
+
+
+def _check_renamed_lv(vg=None, old_lv=None, lv=None):
+    _check_lvs(vg, [old_lv])
+
+
+def _check_partition_map(name=None, dev=None, **kwargs):
+    if dev is None:
+        # an existing <lv>N mapping
+        node = os.path.join('/dev/mapper', _name(name))
+        if not os.path.exists(node):
+            raise HelperError("{0}: no such device".format(node))
+        _check_drive(os.stat(node), node, kind='partition')
+        return
+    # a new one, named after the LV it maps a part of
+    node = _dm_node(dev)
+    lv_name = _check_drive(os.stat(node), dev, kind='lv')
+    if not (name.startswith(lv_name) and name[len(lv_name):].isdigit()):
+        raise HelperError("{0}: not a partition of {1}".format(name, dev))
+
+
+# checks of the commands' targets done by the helper (not with sudo, the
+# caller can run anything with sudo anyway, and lvs needs root)
+CHECKS = {
+    'lvcreate_snapshot': _check_tagged_lv,
+    'lvchange_activate': _check_tagged_lv,
+    'lvremove': _check_tagged_lv,
+    'lvremove_many': _check_tagged_lvs,
+    'lvrename': _check_renamed_lv,
+    'dmsetup_create_linear': _check_partition_map,
+    'dmsetup_remove': _check_partition_map,
+}
+
+
+def _fix_ownership(paths=(), gid=None, mode=0o660):
+    """Make device nodes accessible by the given group, all at once"""
+    nodes = [(path, _dm_node(path)) for path in paths]
+    gid = int(_number(gid))
+    if mode not in (0o600, 0o660):
+        raise HelperError("mode {0:o} is not allowed".format(mode))
+    for path, node in nodes:
+        # check and change the very inode opened: a symlink swapped
+        # after the check is not followed
+        fd = os.open(node, O_PATH | os.O_NOFOLLOW)
+        try:
+            _check_drive(os.fstat(fd), path)
+            # fchown/fchmod reject O_PATH descriptors, the /proc link
+            # refers to the inode opened
+            fd_path = '/proc/self/fd/{0}'.format(fd)
+            os.chown(fd_path, -1, gid)
+            os.chmod(fd_path, mode)
+        finally:
+            os.close(fd)
+    return 0, '', ''
+
+
+def _fix_ownership_argvs(paths=(), gid=None, mode=0o660):
+    # the same with sudo: 2 commands for all nodes. The caller can run
+    # anything with sudo anyway, so the nodes are not checked for the tag
+    # (lvs needs root)
+    paths = [_dm_node(path) for path in paths]
+    if mode not in (0o600, 0o660):
+        raise HelperError("mode {0:o} is not allowed".format(mode))
+    if not paths:
+        return []
+    return [['chmod', '{0:o}'.format(mode)] + paths,
+            ['chgrp', str(int(_number(gid)))] + paths]
+
+
+# allowed operations done by the helper itself
+OPERATIONS = {
+    'fix_ownership': (_fix_ownership, _fix_ownership_argvs),
+}
+
+
+def _run(argv):
+    # PATH is already sanitized by sudo (secure_path)
+    env = dict(os.environ, LC_ALL='C')
+    proc = subprocess.Popen(argv, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, env=env)
+    out, err = proc.communicate()
+    if not isinstance(out, str):
+        out, err = out.decode('utf-8'), err.decode('utf-8')
+    return proc.returncode, out, err
+
+
+def execute(op, args):
+    """Validate and run the operation, return (rc, out, err)"""
+    if op in COMMANDS:
+        argv = COMMANDS[op](**args)
+        if op in CHECKS:
+            CHECKS[op](**args)
+        return _run(argv)
+    elif op in OPERATIONS:
+        return OPERATIONS[op][0](**args)
+    raise HelperError("operation {0} is not allowed".format(op))
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        creds = self.request.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                                        struct.calcsize('3i'))
+        _, uid, _ = struct.unpack('3i', creds)
+        if uid not in (0, self.server.owner):
+            return
+        try:
+            request = json.loads(self.rfile.readline())
+            if request['op'] == 'ping':
+                reply = {'rc': 0, 'out': '', 'err': ''}
+            elif request['op'] == 'shutdown':
+                threading.Thread(target=self.server.shutdown).start()
+                reply = {'rc': 0, 'out': '', 'err': ''}
+            else:
+                rc, out, err = execute(request['op'], request['args'])
+                reply = {'rc': rc, 'out': out, 'err': err}
+        except Exception as e:
+            reply = {'error': '{0}: {1}'.format(type(e).__name__, e)}
+        self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _owner():
+    """uid of the user who has started the helper (with sudo)"""
+    if os.getuid() == 0 and 'SUDO_UID' in os.environ:
+        return int(os.environ['SUDO_UID'])
+    return os.getuid()
+
+
+def _open_socket_dir(path, owner):
+    """Open the directory, which must be private to the owner"""
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+    st = os.fstat(fd)
+    if st.st_uid != owner or stat.S_IMODE(st.st_mode) != 0o700:
+        os.close(fd)
+        raise HelperError("{0}: not a private directory of uid {1}".format(
+                          path, owner))
+    return fd
+
+
+def serve(socket_path, parent_pid=None):
+    """Run the helper (as root) until asked to stop or the parent exits
+
+    The socket is made in a directory private to the invoking user, the
+    directory is referred to by a descriptor, so its path (controlled by
+    the user) is resolved just once. The directory and the socket are
+    removed by the client.
+    """
+    owner = _owner()
+    socket_dir, socket_name = os.path.split(socket_path)
+    dir_fd = _open_socket_dir(socket_dir, owner)
+    path = '/proc/self/fd/{0}/{1}'.format(dir_fd, _name(socket_name))
+    if os.path.lexists(path):
+        raise HelperError("{0} already exists".format(socket_path))
+    umask = os.umask(0o177)
+    try:
+        server = _Server(path, _RequestHandler)
+    finally:
+        os.umask(umask)
+    server.owner = owner
+    # doesn't follow the socket path even if it has been replaced
+    os.lchown(path, owner, -1)
+
+    def watch_parent():
+        while True:
+            time.sleep(1)
+            try:
+                os.kill(parent_pid, 0)
+            except OSError:
+                server.shutdown()
+                return
+
+    if parent_pid:
+        watcher = threading.Thread(target=watch_parent)
+        watcher.daemon = True
+        watcher.start()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.close(dir_fd)
+
+
+class PrivilegedHelper(object):
+    """Client of the helper, starts it via sudo"""
+    def __init__(self):
+        self._dir = None
+        self._socket_path = None
+        self._proc = None
+
+    def start(self):
+        refresh_sudo_credentials()
+        self._dir = tempfile.mkdtemp(prefix='vmbuilder-helper-')
+        self._socket_path = os.path.join(self._dir, 'helper.sock')
+        helper = os.environ.get('VMBUILDER_PRIVHELPER', HELPER_COMMAND)
+        cmd = ['sudo', '-n', helper,
+               '--socket', self._socket_path,
+               '--parent-pid', str(os.getpid())]
+        self._proc = subprocess.Popen(cmd)
+        deadline = time.time() + START_TIMEOUT
+        while True:
+            try:
+                self.call('ping')
+                break
+            except socket.error:
+                pass
+            if self._proc.poll() is not None or time.time() > deadline:
+                self.stop()
+                raise HelperError("failed to start the privileged helper")
+            time.sleep(0.05)
+
+    def stop(self):
+        if self._proc is not None:
+            if self._proc.poll() is None:
+                try:
+                    self.call('shutdown')
+                except (HelperError, socket.error):
+                    self._proc.terminate()
+            self._proc.wait()
+            self._proc = None
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+
+    def call(self, op, **args):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self._socket_path)
+            f = sock.makefile('rwb')
+            f.write((json.dumps({'op': op, 'args': args}) + '\n').
+                    encode('utf-8'))
+            f.flush()
+            line = f.readline()
+            f.close()
+        finally:
+            sock.close()
+        if not line:
+            raise HelperError("{0}: no reply from the helper".format(op))
+        reply = json.loads(line.decode('utf-8'))
+        if 'error' in reply:
+            raise HelperError("{0}: {1}".format(op, reply['error']))
+        return reply['rc'], str(reply['out']), str(reply['err'])
+
+
+_HELPER = None
+
+
+@contextmanager
+def privileged_helper():
+    """Route privileged operations through a single helper process"""
+    global _HELPER
+    helper = PrivilegedHelper()
+    helper.start()
+    _HELPER = helper
+    try:
+        yield helper
+    finally:
+        _HELPER = None
+        helper.stop()
+
+
+def _sudo_run(op, args, capture=False):
+    if op in COMMANDS:
+        argvs = [COMMANDS[op](**args)]
+    else:
+        argvs = OPERATIONS[op][1](**args)
+    out = ''
+    for argv in argvs:
+        cmd = ['sudo'] + argv
+        if capture:
+            try:
+                out += subprocess.check_output(cmd)
+            except subprocess.CalledProcessError as e:
+                return e.returncode, e.output, ''
+        else:
+            rc = subprocess.call(cmd)
+            if rc != 0:
+                return rc, '', ''
+    return 0, out, ''
+
+
+def run_privileged(op, capture=False, **args):
+    """Run the allowed operation via the helper, or sudo if not started
+
+    Returns (returncode, stdout, stderr)
+    """
+    if _HELPER is not None:
+        if op in COMMANDS:
+            count_command(COMMANDS[op](**args)[0])
+        rc, out, err = _HELPER.call(op, **args)
+        if not capture:
+            sys.stdout.write(out)
+            sys.stdout.flush()
+        sys.stderr.write(err)
+        return rc, out, err
+    return _sudo_run(op, args, capture=capture)
+
+
+def check_call(op, **args):
+    rc, _, _ = run_privileged(op, **args)
+    if rc != 0:
+        raise subprocess.CalledProcessError(rc, op)
+
+
+def check_output(op, **args):
+    rc, out, _ = run_privileged(op, capture=True, **args)
+    if rc != 0:
+        raise subprocess.CalledProcessError(rc, op, output=out)
+    return out
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--socket', dest='socket', help='listen here')
+    parser.add_option('--parent-pid', dest='parent_pid', type=int,
+                      help='exit when this process is gone')
+    options, args = parser.parse_args()
+    if not options.socket:
+        raise ValueError('socket path must be specified')
+    serve(options.socket, parent_pid=options.parent_pid)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
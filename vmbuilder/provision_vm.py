@@ -2,20 +2,48 @@
 
 from __future__ import absolute_import
 
+import hashlib
 import os
 import glob
+import re
 import stat
 import sys
 import threading
 from optparse import OptionParser
 
-from .driveutils import zap_partition_table
-from .e2fs import (
-    rm as e2fs_rm,
-    make_empty_file as e2fs_touch,
+from .blockcopy import (
+    DEFAULT_BLOCK_SIZE,
+    CopyStats,
+    copy_buffer,
+    copy_range,
+)
+from .driveutils import device_size, udev_settle, zap_partition_table
+from .imageprobe import image_identity, mark_fs_clean, probe_image
+from .e2fs import Transaction as E2fsTransaction
+from .fatimage import FatImage
+from .miscutils import padded
+from . import privhelper
+from .parttable import (
+    SECTOR_SIZE,
+    Partition,
+    read_partitions,
+    write_boot_area,
 )
-from .miscutils import padded, with_retries
 from .py3compat import subprocess
+from .sourceimage import SOURCE_FORMATS, copy_image, read_image
+from .thinpool import (
+    activate_lv,
+    create_thin_lv,
+    create_thin_snapshot,
+    list_lvs,
+    query_thin_lv,
+    remove_lv,
+    rename_lv,
+    thin_lv_exists,
+    thin_pool_chunk_size,
+    thin_pool_of,
+)
+from .timing import acquired, get_tracer, timed
 
 
 SWAP_MB = 4096
@@ -36,18 +64,27 @@ EXT_FSES = (
     'ext4',
 )
 
+GOLDEN_LV_PREFIX = 'vmbuilder-golden'
+
 
 def _fixup_path():
     if '/sbin' not in os.environ['PATH'].split(':'):
         os.environ['PATH'] = '/sbin:' + os.environ['PATH']
 
 
-# XXX: kpartx uses /dev/loop0, so concurrent kpartx can lock up
-# or give wrong results
-KPARTX_MUTEX = threading.RLock()
+ROOTFS_GROW_OFFLINE = 'offline'
+ROOTFS_GROW_ONLINE = 'online'
+ROOTFS_GROW_POLICIES = (ROOTFS_GROW_OFFLINE, ROOTFS_GROW_ONLINE)
+
+# serializes verification of source images
+_VERIFY_MUTEX = threading.Lock()
+# serializes creation of golden LVs shared by several VMs
+_GOLDEN_MUTEX = threading.Lock()
+_GOLDEN_LOCKS = {}
 _fixup_path()
 
 
+@timed('provision')
 def _provision(vdisk, img=None,
                config_drive_img=None,
                swap_size=None,
@@ -57,33 +94,52 @@ def _provision(vdisk, img=None,
                anonimize_rootfs=True,
                first_partition_offset=None,
                cleanup_files=CLEANUP_FILES,
-               touch_files=TOUCH_FILES):
+               touch_files=TOUCH_FILES,
+               inject_files=None,
+               source_clean=False,
+               rootfs_grow=ROOTFS_GROW_OFFLINE):
     # skip verification of the source image
+    chunk_size = guess_thin_chunk_size(vdisk)
+    stats = CopyStats()
     vdisk = get_dm_lv_name(vdisk)
     verify_blockdev(vdisk)
     fixup_vdisk_ownership(vdisk)
     deactivate_partitions(vdisk, permissive=True)
-    partition_vhd(vdisk,
-                  root_start=first_partition_offset,
-                  swap_size=swap_size,
-                  config_drive_size=CONFIG_DRIVE_MB * 1024 * 2,
-                  min_root_size=orig_size)
-    copy_boot_loader(vdisk, img=img,
-                     first_partition_offset=first_partition_offset)
+    partitions = partition_vhd(
+        vdisk,
+        root_start=first_partition_offset,
+        swap_size=swap_size,
+        config_drive_size=CONFIG_DRIVE_MB * 1024 * 2,
+        min_root_size=orig_size,
+        boot_area=read_image(img, 0, first_partition_offset * SECTOR_SIZE),
+        align=chunk_size // SECTOR_SIZE if chunk_size else 1)
     activate_partitions(vdisk)
     rootdev = '{0}1'.format(vdisk)
-    fstype = clone_rootfs(rootdev, img=img, offset=first_partition_offset)
+    fstype = clone_rootfs(rootdev, img=img, offset=first_partition_offset,
+                          size=orig_size,
+                          wipe_size=partitions[0].size,
+                          chunk_size=chunk_size,
+                          stats=stats)
     if optimize_rootfs:
-        optimize_fs(rootdev, fstype)
-    if anonimize_rootfs:
-        anonymize(rootdev, fstype, cleanup_files, touch_files)
+        optimize_fs(rootdev, fstype, source_clean=source_clean,
+                    rootfs_grow=rootfs_grow)
+    if not anonimize_rootfs:
+        cleanup_files, touch_files = (), ()
+    if cleanup_files or touch_files or inject_files:
+        customize_rootfs(rootdev, fstype,
+                         cleanup_files=cleanup_files,
+                         touch_files=touch_files,
+                         inject_files=inject_files)
     if config_drive_img:
         config_drive_dev = '{0}3'.format(vdisk)
-        copy_config_drive(config_drive_img, config_drive_dev)
+        copy_config_drive(config_drive_img, config_drive_dev,
+                          chunk_size=chunk_size, stats=stats)
 
     swapdev = '{0}2'.format(vdisk)
     run_mkswap(swapdev, '-f', '-L', swap_label)
     deactivate_partitions(vdisk)
+    print("{0}: {1}".format(vdisk, stats))
+    return stats
 
 
 def provision(vdisks,
@@ -94,9 +150,13 @@ def provision(vdisks,
               swap_size=SWAP_MB * 1024 * 2,
               swap_label=SWAP_LABEL,
               cleanup_files=CLEANUP_FILES,
-              touch_files=TOUCH_FILES):
-    verify_raw_image(img)
+              touch_files=TOUCH_FILES,
+              inject_files=None,
+              rootfs_grow=ROOTFS_GROW_OFFLINE):
+    verify_source_image(img)
     orig_size, first_partition_offset = guess_first_partition_size_offset(img)
+    source_clean = optimize_rootfs and \
+        verify_source_fs(img, offset=first_partition_offset * SECTOR_SIZE)
 
     for vdisk, config_drive_img in zip(vdisks, padded(config_drives)):
         _provision(vdisk, img=img,
@@ -108,104 +168,329 @@ def provision(vdisks,
                    optimize_rootfs=optimize_rootfs,
                    anonimize_rootfs=anonimize_rootfs,
                    cleanup_files=cleanup_files,
-                   touch_files=touch_files)
+                   touch_files=touch_files,
+                   inject_files=inject_files,
+                   source_clean=source_clean,
+                   rootfs_grow=rootfs_grow)
 
 
-def guess_fstype(bdev, offset=0):
-    """ Check if block device holds an ext[234] filesystem """
-    cmd = [
-        'blkid', '-p', '-O', str(offset), '-o', 'export', bdev
-    ]
-    out = subprocess.check_output(cmd).strip().split()
-    for l in out:
-        if l.startswith('TYPE='):
-            fstype = l.split('=')[1].strip()
-            return fstype
+def golden_lv_name(img, thin_pool=None, size=None,
+                   swap_size=None, swap_label=None):
+    """Name of the golden LV for the given image and disk layout
+
+    Returns (prefix, name) tuple. All golden LVs made from the same image
+    path for the same disk layout share the prefix, the rest of the name
+    identifies the image content (inode, size, mtime), so a golden LV
+    made from an outdated image can be found and removed.
+    """
+    def digest(*args):
+        return hashlib.sha1(repr(args).encode('utf-8')).hexdigest()[:8]
+
+    identity = image_identity(img)
+    layout = digest(identity[0], thin_pool, float(size),
+                    swap_size, swap_label)
+    identity = digest(*identity[1:])
+    prefix = '{0}-{1}-'.format(GOLDEN_LV_PREFIX, layout)
+    return prefix, prefix + identity
 
 
-def clone_rootfs(dst, img=None, offset=0):
-    bytes_offset = offset * 512
+def _golden_lock(vg, name):
+    with _GOLDEN_MUTEX:
+        return _GOLDEN_LOCKS.setdefault((vg, name), threading.Lock())
+
+
+@timed('make_golden_lv')
+def make_golden_lv(img, vg=None, thin_pool=None, size=None,
+                   swap_size=None, swap_label=None, orig_size=None,
+                   first_partition_offset=None, optimize_rootfs=True,
+                   source_clean=False, rootfs_grow=ROOTFS_GROW_OFFLINE):
+    """Provision the golden LV for the image unless it already exists
+
+    The golden LV is fully provisioned (partitioned, rootfs copied and
+    resized, swap formatted), but holds no per VM data (config drive).
+    Golden LVs made from the previous versions of the image are removed.
+    """
+    prefix, name = golden_lv_name(img, thin_pool=thin_pool, size=size,
+                                  swap_size=swap_size, swap_label=swap_label)
+    with acquired(_golden_lock(vg, name), 'golden_lock_wait'):
+        exists, matches, _ = thin_lv_exists(vg=vg, name=name,
+                                            thin_pool=thin_pool, size=size)
+        if exists and matches:
+            return name
+        if exists:
+            # in another thin pool or of another size, blocks the rename
+            print("removing mismatching golden LV '{0}/{1}'".format(vg, name))
+            remove_lv(vg=vg, lv=name)
+        for lv in list_lvs(vg=vg):
+            if lv.startswith(prefix) and lv != name:
+                print("removing outdated golden LV '{0}/{1}'".format(vg, lv))
+                remove_lv(vg=vg, lv=lv)
+        # provision under a temporary name so an interrupted run
+        # does not leave a half-baked golden LV behind
+        tmp_name = '{0}-tmp'.format(name)
+        create_thin_lv(name=tmp_name, thin_pool=thin_pool, size=size, vg=vg,
+                       force=True)
+        _provision('/dev/{0}/{1}'.format(vg, tmp_name), img=img,
+                   swap_size=swap_size,
+                   swap_label=swap_label,
+                   orig_size=orig_size,
+                   optimize_rootfs=optimize_rootfs,
+                   anonimize_rootfs=False,
+                   first_partition_offset=first_partition_offset,
+                   source_clean=source_clean,
+                   rootfs_grow=rootfs_grow)
+        rename_lv(vg=vg, old_lv=tmp_name, lv=name)
+    return name
+
+
+@timed('personalize')
+def _personalize(vdisk, fstype=None,
+                 config_drive_img=None,
+                 anonimize_rootfs=True,
+                 cleanup_files=CLEANUP_FILES,
+                 touch_files=TOUCH_FILES,
+                 inject_files=None,
+                 chunk_size=None):
+    stats = CopyStats()
+    vdisk = get_dm_lv_name(vdisk)
+    verify_blockdev(vdisk)
+    fixup_vdisk_ownership(vdisk)
+    deactivate_partitions(vdisk, permissive=True)
+    activate_partitions(vdisk)
+    if not anonimize_rootfs:
+        cleanup_files, touch_files = (), ()
+    if cleanup_files or touch_files or inject_files:
+        rootdev = '{0}1'.format(vdisk)
+        customize_rootfs(rootdev, fstype,
+                         cleanup_files=cleanup_files,
+                         touch_files=touch_files,
+                         inject_files=inject_files)
+    if config_drive_img:
+        config_drive_dev = '{0}3'.format(vdisk)
+        copy_config_drive(config_drive_img, config_drive_dev,
+                          chunk_size=chunk_size, stats=stats)
+    deactivate_partitions(vdisk)
+    print("{0}: {1}".format(vdisk, stats))
+    return stats
+
+
+def provision_golden(vdisks,
+                     img=None,
+                     config_drives=None,
+                     optimize_rootfs=True,
+                     anonimize_rootfs=True,
+                     swap_size=SWAP_MB * 1024 * 2,
+                     swap_label=SWAP_LABEL,
+                     cleanup_files=CLEANUP_FILES,
+                     touch_files=TOUCH_FILES,
+                     inject_files=None,
+                     rootfs_grow=ROOTFS_GROW_OFFLINE,
+                     thin_pool=None,
+                     size=None):
+    """Make VM drives thin snapshots of the golden LV
+
+    The golden LV is allocated from the given thin pool and has the given
+    size (MiB). If these are not given vdisks must be existing thin LVs,
+    their thin pool and size are used. Existing vdisks are replaced.
+    """
+    verify_source_image(img)
+    orig_size, first_partition_offset = guess_first_partition_size_offset(img)
+    fstype = guess_fstype(img, offset=first_partition_offset * SECTOR_SIZE)
+    source_clean = optimize_rootfs and \
+        verify_source_fs(img, offset=first_partition_offset * SECTOR_SIZE)
+
+    for vdisk, config_drive_img in zip(vdisks, padded(config_drives)):
+        # vdisk = /dev/as-ubuntu-vg/saceph-osd1-os
+        _, _, vg, lv = vdisk.strip().split('/')
+        if thin_pool is None or size is None:
+            params = query_thin_lv(vg=vg, lv=lv)
+            lv_pool, lv_size = params['pool_lv'], params['lv_size']
+        else:
+            lv_pool, lv_size = thin_pool, size
+        golden = make_golden_lv(img, vg=vg,
+                                thin_pool=lv_pool,
+                                size=lv_size,
+                                swap_size=swap_size,
+                                swap_label=swap_label,
+                                orig_size=orig_size,
+                                first_partition_offset=first_partition_offset,
+                                optimize_rootfs=optimize_rootfs,
+                                source_clean=source_clean,
+                                rootfs_grow=rootfs_grow)
+        deactivate_partitions(vdisk, permissive=True)
+        create_thin_snapshot(name=lv, vg=vg, lv=golden)
+        activate_lv(vg=vg, lv=lv)
+        _personalize(vdisk, fstype=fstype,
+                     config_drive_img=config_drive_img,
+                     anonimize_rootfs=anonimize_rootfs,
+                     cleanup_files=cleanup_files,
+                     touch_files=touch_files,
+                     inject_files=inject_files,
+                     chunk_size=thin_pool_chunk_size(
+                         vg=vg, thin_pool=lv_pool))
+
+
+def guess_fstype(img, offset=0):
+    """ Find out the type of filesystem at the given offset of the image """
+    info = probe_image(img)
+    for part in info.partitions:
+        if part.start * 512 == offset and part.number in info.filesystems:
+            return info.filesystems[part.number].type
+    return None
+
+
+def guess_thin_chunk_size(vdisk):
+    """Chunk size (in bytes) of the thin pool holding vdisk
+
+    Returns None if vdisk is not a thin LV
+    """
+    if vdisk.startswith('/dev/mapper/'):
+        return None
+    # vdisk = /dev/as-ubuntu-vg/saceph-osd1-os
+    _, _, vg, lv = vdisk.strip().split('/')
+    # data_percent of linear LVs is empty, so don't use query_thin_lv
+    thin_pool = thin_pool_of(vg=vg, lv=lv)
+    if thin_pool is None:
+        return None
+    return thin_pool_chunk_size(vg=vg, thin_pool=thin_pool)
+
+
+@timed('clone_rootfs')
+def clone_rootfs(dst, img=None, offset=0, size=None, wipe_size=None,
+                 chunk_size=None, stats=None):
+    """Copy the filesystem (size sectors at offset) from the image to dst
+
+    Zero blocks are not written, instead the whole dst (wipe_size sectors)
+    is discarded beforehand. The image can be raw, qcow2, or compressed
+    (xz, zstd) raw one.
+    """
+    bytes_offset = offset * SECTOR_SIZE
     fstype = guess_fstype(img, offset=bytes_offset)
     if fstype not in ('ext2', 'ext3', 'ext4'):
         raise RuntimeError('provisioning %s filesystem is not supported')
-    cmd = ['e2image', '-p', '-aro', str(bytes_offset), img, dst]
-    subprocess.check_call(cmd)
+    copy_stats = copy_image(img, dst, src_offset=bytes_offset,
+                            length=size * SECTOR_SIZE,
+                            wipe_length=(wipe_size or size) * SECTOR_SIZE,
+                            block_size=chunk_size or DEFAULT_BLOCK_SIZE,
+                            discard_granularity=chunk_size,
+                            fmt=probe_image(img).format)
+    if stats is not None:
+        stats.add(copy_stats)
     return fstype
 
 
-def optimize_fs(bdev, fstype):
+@timed('verify_source_fs')
+def verify_source_fs(img, offset=0):
+    """Check (read only) the source filesystem once, remember the result
+
+    Returns True if the filesystem at the given offset of the image is
+    known to be clean, so its copies need no forced checks.
+    """
+    info = probe_image(img)
+    if info.format != 'raw':
+        # e2fsck can't read qcow2 and compressed images
+        return False
+    parts = [p for p in info.partitions if p.start * SECTOR_SIZE == offset]
+    if not parts or info.filesystems.get(parts[0].number) is None:
+        return False
+    number = parts[0].number
+    if info.filesystems[number].type not in EXT_FSES:
+        return False
+    with acquired(_VERIFY_MUTEX, 'verify_lock_wait'):
+        if number in probe_image(img).clean_filesystems:
+            return True
+        cmd = ['e2fsck', '-f', '-n', '{0}?offset={1}'.format(img, offset)]
+        if subprocess.call(cmd) != 0:
+            print("{0}: filesystem at offset {1} is not clean".format(
+                img, offset))
+            return False
+        mark_fs_clean(img, number)
+    return True
+
+
+@timed('optimize_fs')
+def optimize_fs(bdev, fstype, source_clean=False,
+                rootfs_grow=ROOTFS_GROW_OFFLINE):
+    """Grow the filesystem to fill the partition, and check it
+
+    source_clean: the filesystem is a copy of a verified clean one, thus
+    the check before resizing is redundant. The directories are still
+    optimized (e2fsck -D), once per golden LV when using those.
+    rootfs_grow: 'offline' runs resize2fs now, 'online' leaves resizing
+    to the guest (cloud-init) on the first boot.
+    """
+    if rootfs_grow not in ROOTFS_GROW_POLICIES:
+        raise ValueError("invalid rootfs_grow policy: {0}".format(
+            rootfs_grow))
+    grow = rootfs_grow == ROOTFS_GROW_OFFLINE
     if fstype in ('ext4'):
         disable_ext4_journal(bdev)
-    if fstype in EXT_FSES:
+    if fstype not in EXT_FSES:
+        return
+    if source_clean:
+        if grow:
+            # resize2fs insists on a fresh check, skip it
+            resize2fs(bdev, '-f', '-p')
+    else:
         run_e2fsck(bdev, '-f', '-p')
-        resize2fs(bdev, '-p')
-        run_e2fsck(bdev, '-f', '-p', '-D')
-
-
-def copy_boot_loader(vdisk, img=None,
-                     first_partition_offset=None):
-    def run_dd(**kwargs):
-        cmd = ['dd', 'if=%s' % img, 'of=%s' % vdisk]
-        cmd.extend('{0}={1}'.format(k, v) for k, v in kwargs.items())
-        cmd.extend(['conv=fsync'])
-        subprocess.check_call(cmd)
-
-    bootarea_size = first_partition_offset - 1
-    run_dd(bs='446c', count=1)
-    run_dd(bs='512c', seek=1, skip=1, count=bootarea_size)
+        if grow:
+            resize2fs(bdev, '-p')
+    run_e2fsck(bdev, '-f', '-p', '-D')
 
 
+@timed('partition_vhd')
 def partition_vhd(vdisk,
                   root_start=None,
                   swap_size=None,
                   min_root_size=None,
-                  config_drive_size=None):
+                  config_drive_size=None,
+                  boot_area=None,
+                  align=1):
+    """Partition vdisk: rootfs, swap, config drive
+
+    boot_area: boot loader (MBR and the gap after it) to copy to vdisk.
+    The MBR and the gap up to the first partition are written at once.
+    align: partitions start at multiples of align sectors (thin pool chunk
+    size), so they don't share chunks
+    Returns the list of partitions.
+    """
     vdisk = get_dm_lv_name(vdisk)
-    disk_size = subprocess.check_output(['blockdev', '--getsz', vdisk])
-    disk_size = int(disk_size.strip())
-    min_disk_size = swap_size + min_root_size + root_start + config_drive_size
-    if disk_size < min_disk_size:
+    disk_size = device_size(vdisk) // SECTOR_SIZE
+    root_start = -(-root_start // align) * align
+    config_drive_start = (disk_size - config_drive_size) // align * align
+    swap_start = (config_drive_start - swap_size) // align * align
+    root_size = swap_start - root_start
+    if root_size < min_root_size:
+        min_disk_size = swap_size + min_root_size + root_start + \
+            config_drive_size
         raise RuntimeError("disk too small: {0}s < {1}s".format(disk_size,
                                                                 min_disk_size))
-    root_size = disk_size - root_start - swap_size - config_drive_size
-    swap_start = root_start + root_size
-    config_drive_start = swap_start + swap_size
-    zap_partition_table(vdisk)
-    sfdisk = subprocess.Popen(['sfdisk', '--force', '-u', 'S', vdisk],
-                              stdin=subprocess.PIPE,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE)
-    partition_table_tpl = """
-    {vdisk}1 : start= {root_start}, size= {root_size}, Id=83, bootable
-    {vdisk}2 : start= {swap_start}, size= {swap_size}, Id=82
-    {vdisk}3 : start= {config_drive_start}, size= {config_drive_size}, Id=83
-    {vdisk}4 : start= 0, size= 0, Id= 0
-    """
-    partition_table = partition_table_tpl.format(
-        vdisk=vdisk,
-        root_start=root_start,
-        root_size=root_size,
-        swap_size=swap_size,
-        swap_start=swap_start,
-        config_drive_start=config_drive_start,
-        config_drive_size=config_drive_size)
-
-    out, err = sfdisk.communicate(partition_table)
-    rc = sfdisk.poll()
-    if rc != 0:
-        raise RuntimeError("sfdisk: error %d, message: %s" % (rc, err))
+    boot_area_size = root_start * SECTOR_SIZE
+    boot_area = boot_area or b''
+    if len(boot_area) > boot_area_size:
+        raise ValueError("boot area overlaps the first partition")
+    # wipe out the stale boot loader and partition table (if any)
+    boot_area = boot_area.ljust(boot_area_size, b'\0')
+
+    partitions = [
+        Partition(number=1, start=root_start, size=root_size,
+                  type=0x83, bootable=True),
+        Partition(number=2, start=swap_start,
+                  size=config_drive_start - swap_start,
+                  type=0x82, bootable=False),
+        Partition(number=3, start=config_drive_start,
+                  size=disk_size - config_drive_start,
+                  type=0x83, bootable=False),
+    ]
+    write_boot_area(vdisk, partitions, boot_area=boot_area)
+    return partitions
 
 
 def guess_first_partition_size_offset(img):
-    with KPARTX_MUTEX:
-        out = subprocess.check_output(['sudo', 'kpartx', '-l', img])
-    # loop0p1 : 0 4192256 /dev/loop0 2048
-    # loop deleted : /dev/loop0
-    first_part_txt = out.split('\n')[0].strip()
-    # loop0p1 : 0 4192256 /dev/loop0 2048
-    part, _, start_s, end_s, bdev, offset_s = first_part_txt.split()
-    size = int(end_s) - int(start_s)
-    return size, int(offset_s)
+    first_part = probe_image(img).first_partition()
+    if first_part is None:
+        raise RuntimeError("{0}: no partitions found".format(img))
+    return first_part.size, first_part.start
 
 
 def get_dm_lv_name(lvpath):
@@ -219,22 +504,53 @@ def get_dm_lv_name(lvpath):
     return '/dev/mapper/{0}-{1}'.format(escape(vg), escape(lv))
 
 
+def _partition_mappings(vdisk):
+    """Names of device mapper devices mapping partitions of vdisk"""
+    base = os.path.basename(vdisk)
+    regex = re.compile('^{0}p?[0-9]+$'.format(re.escape(base)))
+    dm_dir = os.path.dirname(vdisk)
+    vdisk_node = os.path.basename(os.path.realpath(vdisk))
+
+    def maps_vdisk(name):
+        # skip LVs which happen to be named like partitions, i.e.
+        # vm-data2 when looking for partitions of vm-data
+        node = os.path.basename(os.path.realpath(os.path.join(dm_dir, name)))
+        slaves_dir = '/sys/block/{0}/slaves'.format(node)
+        return os.path.isdir(slaves_dir) and \
+            vdisk_node in os.listdir(slaves_dir)
+
+    return sorted(name for name in os.listdir(dm_dir)
+                  if regex.match(name) and maps_vdisk(name))
+
+
+@timed('activate_partitions')
 def activate_partitions(vdisk):
+    """Map partitions of vdisk as /dev/mapper/<vdisk>N linear targets
+
+    Unlike kpartx this needs no loop device, so several drives can be
+    processed concurrently.
+    """
     vdisk = get_dm_lv_name(vdisk)
-    with KPARTX_MUTEX:
-        subprocess.check_call(['sudo', 'kpartx', '-s', '-a', vdisk])
+    for part in read_partitions(vdisk):
+        name = '{0}{1}'.format(os.path.basename(vdisk), part.number)
+        privhelper.check_call('dmsetup_create_linear', name=name, dev=vdisk,
+                              start=part.start, size=part.size)
+    udev_settle()
     fixup_vdisk_ownership(vdisk)
 
 
-@with_retries(3)
+@timed('deactivate_partitions')
 def deactivate_partitions(vdisk, permissive=False):
     vdisk = get_dm_lv_name(vdisk)
-    try:
-        with KPARTX_MUTEX:
-            subprocess.check_call(['sudo', 'kpartx', '-d', vdisk])
-    except subprocess.CalledProcessError:
-        if not permissive:
-            raise
+    # udev might be still probing the partitions (blkid), and holding
+    # them open, wait for it to finish to avoid EBUSY on removal
+    udev_settle()
+    for name in _partition_mappings(vdisk):
+        try:
+            privhelper.check_call('dmsetup_remove', name=name)
+        except subprocess.CalledProcessError:
+            if not permissive:
+                raise
 
 
 def disable_ext4_journal(bdev):
@@ -265,6 +581,7 @@ def run_e2fsck(bdev, *args):
             raise
 
 
+@timed('mkswap')
 def run_mkswap(bdev, *args):
     cmd = ['mkswap']
     cmd.extend(args)
@@ -281,39 +598,72 @@ def verify_blockdev(vdisk):
                          format(vdisk, st_mode, stat.S_ISBLK))
 
 
-def verify_raw_image(img):
-    cmd = 'qemu-img info -f raw'.split()
-    cmd.append(img)
-    subprocess.check_call(cmd)
+def verify_source_image(img):
+    img_format = probe_image(img).format
+    if img_format not in SOURCE_FORMATS:
+        raise RuntimeError("{0}: unsupported image format {1}".format(
+            img, img_format))
 
 
+@timed('fixup_ownership')
 def fixup_vdisk_ownership(vdisk):
-    gid = os.getgid()
-    for bdev in glob.glob(vdisk + '*'):
-        subprocess.check_call(['sudo', 'chmod', '660', bdev])
-        subprocess.check_call(['sudo', 'chgrp', str(gid), bdev])
-
-
-def run_dd(src, dst, **kwargs):
-    cmd = ['dd', 'if=%s' % src, 'of=%s' % dst]
-    cmd.extend('{0}={1}'.format(k, v) for k, v in kwargs.items())
-    subprocess.check_call(cmd)
-
-
-def copy_config_drive(src, dst):
-    run_dd(src, dst, bs='512c', conv='fsync')
+    """Make the drive and its partitions writable (single request)"""
+    privhelper.check_call('fix_ownership',
+                          paths=sorted(glob.glob(vdisk + '*')),
+                          gid=os.getgid(), mode=0o660)
+
+
+@timed('copy_config_drive')
+def copy_config_drive(src, dst, chunk_size=None, stats=None):
+    """Write the config drive (an image file or FatImage) to dst"""
+    dst_size = device_size(dst)
+    if isinstance(src, FatImage):
+        if src.size > dst_size:
+            raise ValueError("{0}: config drive image does not fit".format(
+                             dst))
+        copy_stats = copy_buffer(src.data(), dst, wipe_length=dst_size,
+                                 block_size=chunk_size or DEFAULT_BLOCK_SIZE,
+                                 discard_granularity=chunk_size)
+    else:
+        copy_stats = copy_range(src, dst, wipe_length=dst_size,
+                                block_size=chunk_size or DEFAULT_BLOCK_SIZE,
+                                discard_granularity=chunk_size)
+    if stats is not None:
+        stats.add(copy_stats)
+
+
+@timed('customize_rootfs')
+def customize_rootfs(fsimage, fstype, cleanup_files=(), touch_files=(),
+                     inject_files=None):
+    """ remove per system files, and write the given ones (offline)
+
+    inject_files: list of dicts like cloud-init's write_files:
+    {'path': '/etc/foo', 'content': 'bar', 'permissions': '0644'}
+    """
+    if fstype not in EXT_FSES:
+        raise RuntimeError("customize_rootfs: only ext[234] filesystem "
+                           "supported")
+    tx = E2fsTransaction(fsimage)
+    for path in cleanup_files:
+        tx.rm(path)
+    for path in touch_files:
+        tx.write(path, b'')
+    for entry in inject_files or []:
+        mode = entry.get('permissions', '0644')
+        if not isinstance(mode, int):
+            mode = int(mode, 8)
+        tx.write(entry['path'], entry.get('content', ''), mode=mode)
+    tx.commit()
 
 
 def anonymize(fsimage, fstype, cleanup_files, touch_files):
     """ remove /etc/machine-id and similar per system files """
-    if fstype not in EXT_FSES:
-        raise RuntimeError("anonymize: only ext[234] filesystem supported")
-    for path in cleanup_files:
-        e2fs_rm(path, fsimage)
-    for path in touch_files:
-        e2fs_touch(path, fsimage, force=True)
+    customize_rootfs(fsimage, fstype,
+                     cleanup_files=cleanup_files,
+                     touch_files=touch_files)
 
 
+@timed('provision')
 def _provision_woe(vdisk):
     vdisk = get_dm_lv_name(vdisk)
     verify_blockdev(vdisk)
@@ -328,22 +678,26 @@ def provision_woe(vdisks,
                   optimize_rootfs=False,
                   anonimize_rootfs=False,
                   swap_size=SWAP_MB * 1024 * 2,
-                  swap_label=SWAP_LABEL):
+                  swap_label=SWAP_LABEL,
+                  inject_files=None,
+                  rootfs_grow=None):
     for vdisk in vdisks:
         _provision_woe(vdisk)
 
 
-def get_provision_method(distro):
+def get_provision_method(distro, golden=False):
     provision_methods = {
         'woe2008': provision_woe,
         'woe10': provision_woe,
     }
-    return provision_methods.get(distro, provision)
+    default_method = provision_golden if golden else provision
+    return provision_methods.get(distro, default_method)
 
 
 def main():
     parser = OptionParser()
-    parser.add_option('-i', dest='image', help='source image, must be raw')
+    parser.add_option('-i', dest='image',
+                      help='source image (raw, qcow2, xz, zstd)')
     parser.add_option('-c', dest='config_drive', help='config drive image')
     parser.add_option('-l', '--swap-label', dest='swap_label',
                       default=SWAP_LABEL,
@@ -351,15 +705,26 @@ def main():
     parser.add_option('-s', '--swap-size', dest='swap_size', type=int,
                       default=SWAP_MB,
                       help='swap size in MBs')
+    parser.add_option('--rootfs-grow', dest='rootfs_grow',
+                      default=ROOTFS_GROW_OFFLINE, type='choice',
+                      choices=ROOTFS_GROW_POLICIES,
+                      help='grow rootfs offline (now) or online (on boot)')
+    parser.add_option('-g', '--golden', dest='golden',
+                      default=False, action='store_true',
+                      help='make vdisks thin snapshots of the golden image')
     options, args = parser.parse_args()
     if (not options.image) or len(args) == 0:
         print("image and vdisk parameters are mandatory")
         sys.exit(1)
-    provision(args,
-              img=options.image,
-              config_drives=[options.config_drive],
-              swap_size=options.swap_size * 1024 * 2,
-              swap_label=options.swap_label)
+    provision_method = provision_golden if options.golden else provision
+    with privhelper.privileged_helper():
+        provision_method(args,
+                         img=options.image,
+                         config_drives=[options.config_drive],
+                         swap_size=options.swap_size * 1024 * 2,
+                         swap_label=options.swap_label,
+                         rootfs_grow=options.rootfs_grow)
+    get_tracer().print_summary()
     sys.exit(0)
 
 
@@ -1,6 +1,31 @@
 
+import errno
+import os
 import subprocess as _subprocess
 import sys
+import threading
+
+_COMMAND_COUNTS = {}
+_COMMAND_COUNTS_MUTEX = threading.Lock()
+_CHILDREN_CPU = threading.local()
+
+
+def count_command(name):
+    """Account an external command run by (or on behalf of) this process"""
+    with _COMMAND_COUNTS_MUTEX:
+        _COMMAND_COUNTS[name] = _COMMAND_COUNTS.get(name, 0) + 1
+
+
+def command_counts():
+    """{program: number of times it has been run}"""
+    with _COMMAND_COUNTS_MUTEX:
+        return dict(_COMMAND_COUNTS)
+
+
+def children_cpu_time():
+    """CPU time of external commands the calling thread has waited for"""
+    return getattr(_CHILDREN_CPU, 'total', 0.0)
+
 
 def _patch_py3_subprocess(subprocess):
     if sys.version_info.major >= 3:
@@ -35,7 +60,52 @@ def _patch_py3_subprocess(subprocess):
             subprocess.Popen = _Popen
     return subprocess
 
-subprocess = _patch_py3_subprocess(_subprocess)
+
+def _patch_count_commands(subprocess):
+    Popen = subprocess.Popen
+
+    class _CountingPopen(Popen):
+
+        def __init__(self, args, *posargs, **kwargs):
+            argv = args if isinstance(args, (list, tuple)) \
+                else str(args).split()
+            count_command(os.path.basename(argv[0]) if argv else '')
+            super(_CountingPopen, self).__init__(args, *posargs, **kwargs)
+
+        def _reap(self, flags):
+            # getrusage(RUSAGE_THREAD) leaves out children, and
+            # RUSAGE_CHILDREN is per process: take the command's own usage
+            while True:
+                try:
+                    pid, status, usage = os.wait4(self.pid, flags)
+                    break
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    if e.errno != errno.ECHILD:
+                        raise
+                    return
+            if pid == self.pid:
+                self._handle_exitstatus(status)
+                _CHILDREN_CPU.total = children_cpu_time() + \
+                    usage.ru_utime + usage.ru_stime
+
+        def poll(self):
+            if self.returncode is None:
+                self._reap(os.WNOHANG)
+            return super(_CountingPopen, self).poll()
+
+        def wait(self, *args, **kwargs):
+            # waiting with a timeout (python 3) is left to Popen
+            if self.returncode is None and not args and \
+                    kwargs.get('timeout') is None:
+                self._reap(0)
+            return super(_CountingPopen, self).wait(*args, **kwargs)
+
+    subprocess.Popen = _CountingPopen
+    return subprocess
+
+subprocess = _patch_count_commands(_patch_py3_subprocess(_subprocess))
 
 
 def raise_exception(extype, exvalue, backtrace):
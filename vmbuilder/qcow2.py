@@ -0,0 +1,136 @@
+from __future__ import absolute_import
+
+# Minimal read only qcow2 reader, good enough to find out the partition
+# table and filesystems of cloud images without converting them
+
+import struct
+import zlib
+
+QCOW2_MAGIC = b'QFI\xfb'
+QCOW2_HEADER_SIZE = 72
+QCOW2_V3_HEADER_SIZE = 104
+QCOW2_COMPRESSION_ZLIB = 0
+QCOW2_INCOMPAT_EXTERNAL_DATA = 0x4
+QCOW2_INCOMPAT_COMPRESSION = 0x8
+
+QCOW2_OFLAG_COMPRESSED = 1 << 62
+QCOW2_OFLAG_ZERO = 1
+QCOW2_OFFSET_MASK = 0x00fffffffffffe00
+L2_ENTRY_SIZE = 8
+
+
+class Qcow2Image(object):
+    """Guest visible content of a standalone qcow2 image
+
+    with Qcow2Image('disk.qcow2') as img:
+        mbr = img.read(0, 512)
+    """
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, 'rb')
+        try:
+            self._parse_header()
+        except Exception:
+            self._f.close()
+            raise
+        self._l2_cache = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._f.close()
+
+    def _pread(self, offset, length):
+        self._f.seek(offset)
+        return self._f.read(length)
+
+    def _parse_header(self):
+        hdr = self._pread(0, QCOW2_V3_HEADER_SIZE + 1)
+        if len(hdr) < QCOW2_HEADER_SIZE or hdr[:4] != QCOW2_MAGIC:
+            raise ValueError('{0}: not a qcow2 image'.format(self.path))
+        (version, backing_file_offset, _, self.cluster_bits, self.size,
+         crypt_method, self.l1_size, self.l1_table_offset) = \
+            struct.unpack_from('>IQIIQIIQ', hdr, 4)
+        if version not in (2, 3):
+            raise ValueError('{0}: unsupported qcow2 version {1}'.format(
+                self.path, version))
+        if backing_file_offset:
+            raise ValueError('{0}: images with backing files are not '
+                             'supported'.format(self.path))
+        if crypt_method:
+            raise ValueError('{0}: encrypted images are not supported'.
+                             format(self.path))
+        if version == 3:
+            incompat, = struct.unpack_from('>Q', hdr, 72)
+            header_length, = struct.unpack_from('>I', hdr, 100)
+            if incompat & QCOW2_INCOMPAT_EXTERNAL_DATA:
+                raise ValueError('{0}: external data files are not '
+                                 'supported'.format(self.path))
+            if incompat & QCOW2_INCOMPAT_COMPRESSION and \
+                    header_length > QCOW2_V3_HEADER_SIZE and \
+                    bytearray(hdr[QCOW2_V3_HEADER_SIZE:])[0] != \
+                    QCOW2_COMPRESSION_ZLIB:
+                raise ValueError('{0}: only zlib compression is supported'.
+                                 format(self.path))
+        self.version = version
+        self.cluster_size = 1 << self.cluster_bits
+        self.l2_entries = self.cluster_size // L2_ENTRY_SIZE
+        self._l1 = struct.unpack('>%dQ' % self.l1_size,
+                                 self._pread(self.l1_table_offset,
+                                             self.l1_size * L2_ENTRY_SIZE))
+
+    def _l2_table(self, l1_index):
+        if l1_index >= self.l1_size:
+            return None
+        l2_offset = self._l1[l1_index] & QCOW2_OFFSET_MASK
+        if not l2_offset:
+            return None
+        table = self._l2_cache.get(l2_offset)
+        if table is None:
+            table = struct.unpack('>%dQ' % self.l2_entries,
+                                  self._pread(l2_offset, self.cluster_size))
+            self._l2_cache[l2_offset] = table
+        return table
+
+    def _read_compressed(self, entry):
+        offset_bits = 62 - (self.cluster_bits - 8)
+        host_offset = entry & ((1 << offset_bits) - 1)
+        sectors = ((entry >> offset_bits) &
+                   ((1 << (self.cluster_bits - 8)) - 1)) + 1
+        data = self._pread(host_offset, sectors * 512 - (host_offset & 511))
+        # raw deflate stream, no zlib header
+        cluster = zlib.decompressobj(-12).decompress(data, self.cluster_size)
+        return cluster.ljust(self.cluster_size, b'\0')
+
+    def _read_cluster(self, index):
+        l2 = self._l2_table(index // self.l2_entries)
+        entry = l2[index % self.l2_entries] if l2 else 0
+        if entry & QCOW2_OFLAG_COMPRESSED:
+            return self._read_compressed(entry)
+        if self.version == 3 and entry & QCOW2_OFLAG_ZERO:
+            return None
+        host_offset = entry & QCOW2_OFFSET_MASK
+        if not host_offset:
+            return None
+        return self._pread(host_offset, self.cluster_size). \
+            ljust(self.cluster_size, b'\0')
+
+    def read(self, offset, length):
+        """Read guest data, unallocated clusters read as zeros"""
+        length = max(min(length, self.size - offset), 0)
+        chunks = []
+        while length > 0:
+            index, start = divmod(offset, self.cluster_size)
+            count = min(length, self.cluster_size - start)
+            cluster = self._read_cluster(index)
+            if cluster is None:
+                chunks.append(b'\0' * count)
+            else:
+                chunks.append(cluster[start:start + count])
+            offset += count
+            length -= count
+        return b''.join(chunks)
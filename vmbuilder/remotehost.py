@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# Purpose: run host local operations (LVM, provisioning drives) on the
+# hypervisor a VM is placed on: directly if libvirtd is local, via ssh
+# otherwise
+
+from __future__ import absolute_import
+
+import base64
+import hashlib
+import io
+import json
+import os
+import sys
+import tarfile
+import tempfile
+import threading
+try:
+    from urlparse import urlsplit, parse_qs
+except ImportError:
+    from urllib.parse import urlsplit, parse_qs
+
+from .driveutils import disk_stats, drive_is_ssd, physical_drives, vg_pvs
+from .fatimage import FatImage
+from .imageprobe import image_identity
+from .miscutils import mkdir_p
+from .privhelper import privileged_helper
+from .provision_vm import get_provision_method
+from .storageprobe import probe_thin_pool
+from .py3compat import subprocess
+from .thinpool import (
+    NoSuchVG,
+    create_thin_lv,
+    list_lvs,
+    query_thin_lv,
+    remove_lvs,
+)
+from .virtbackend import LIBVIRT_CONNECTION
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# python interpreter to run the package on remote hypervisors
+REMOTE_PYTHON_ENV_VAR = 'VMBUILDER_REMOTE_PYTHON'
+REMOTE_PYTHON = 'python'
+
+# relative to the home directory of the remote user
+REMOTE_CACHE_DIR = '.cache/vmbuilder'
+
+# requests to a host share a single ssh connection (the master exits
+# after being idle for CONTROL_PERSIST seconds)
+CONTROL_DIR = os.path.expanduser('~/.cache/vmbuilder/ssh')
+CONTROL_PERSIST = 60
+
+# the reply of the remote side follows this marker (commands run by the
+# operation might write to stdout too)
+REPLY_MARKER = 'vmbuilder-reply: '
+
+_HOSTS = {}
+_HOSTS_MUTEX = threading.Lock()
+
+
+class RemoteError(RuntimeError):
+    pass
+
+
+def _create_thin_lv(vg=None, thin_pool=None, name=None, size=None):
+    create_thin_lv(vg=vg, thin_pool=thin_pool, name=name, size=size)
+
+
+def _list_lvs(vg=None):
+    """Names of LVs in the VG, None if there's no such VG"""
+    try:
+        return list_lvs(vg=vg)
+    except NoSuchVG:
+        return None
+
+
+def _thin_pool_free(vg=None, thin_pool=None):
+    """Free space of the thin pool, MiB"""
+    params = query_thin_lv(vg=vg, lv=thin_pool)
+    return params['lv_size'] * (100.0 - params['data_percent']) / 100.0
+
+
+def _thin_pool_usage(vg=None, thin_pool=None):
+    """Size (MiB) and the data usage (percent) of the thin pool"""
+    params = query_thin_lv(vg=vg, lv=thin_pool)
+    return {'size_mb': params['lv_size'],
+            'data_percent': params['data_percent']}
+
+
+def _remove_lvs(devs=()):
+    remove_lvs(devs)
+
+
+def _vg_drives(vg=None):
+    """Whole drives the VG's PVs reside on: {drive: is it an SSD}"""
+    drives = set()
+    for pv in vg_pvs(vg):
+        drives.update(physical_drives(pv))
+    return dict((drive, drive_is_ssd(drive)) for drive in drives)
+
+
+def _disk_stats(devices=()):
+    return [disk_stats(dev) for dev in devices]
+
+
+def _probe_thin_pool(vg=None, thin_pool=None, max_level=None):
+    return probe_thin_pool(vg=vg, thin_pool=thin_pool, max_level=max_level)
+
+
+def _provision(distro=None, golden=False, vdisks=(), img=None,
+               config_drives=(), **kwargs):
+    """Provision drives with config drives passed as base64 encoded data"""
+    paths = []
+    try:
+        for data in config_drives:
+            fd, path = tempfile.mkstemp(prefix='vmbuilder-config-')
+            paths.append(path)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(base64.b64decode(data))
+        provision = get_provision_method(distro, golden=golden)
+        provision(vdisks, img=img, config_drives=paths, **kwargs)
+    finally:
+        for path in paths:
+            os.unlink(path)
+
+
+# allowed operations: name -> function (invoked with keyword arguments)
+HOST_OPERATIONS = {
+    'create_thin_lv': _create_thin_lv,
+    'disk_stats': _disk_stats,
+    'list_lvs': _list_lvs,
+    'probe_thin_pool': _probe_thin_pool,
+    'provision': _provision,
+    'remove_lvs': _remove_lvs,
+    'thin_pool_free': _thin_pool_free,
+    'thin_pool_usage': _thin_pool_usage,
+    'vg_drives': _vg_drives,
+}
+
+# operations which need no root (read sysfs), the others run their LVM,
+# device mapper, etc commands via the privileged helper
+UNPRIVILEGED_OPERATIONS = frozenset([
+    'disk_stats',
+])
+
+
+def ssh_target(uri):
+    """(user@host, port, keyfile) of the libvirt URI, None if libvirtd
+    is local (qemu:///system, test:///default, etc)"""
+    parts = urlsplit(uri)
+    if not parts.hostname:
+        return None
+    target = parts.hostname
+    if parts.username:
+        target = '{0}@{1}'.format(parts.username, target)
+    keyfile = parse_qs(parts.query).get('keyfile', [None])[0]
+    return target, parts.port, keyfile
+
+
+def _package_tarball():
+    """The package sources as a tarball, and their digest"""
+    digest = hashlib.sha256()
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w') as tar:
+        for root, dirs, files in os.walk(PACKAGE_DIR):
+            dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+            for name in sorted(files):
+                if name.endswith(('.pyc', '.pyo')):
+                    continue
+                path = os.path.join(root, name)
+                arcname = os.path.join('vmbuilder',
+                                       os.path.relpath(path, PACKAGE_DIR))
+                with open(path, 'rb') as f:
+                    digest.update(arcname.encode('utf-8'))
+                    digest.update(f.read())
+                tar.add(path, arcname=arcname)
+    return data.getvalue(), digest.hexdigest()[:16]
+
+
+class LocalHost(object):
+    """libvirtd runs on this host, operations are plain function calls"""
+    local = True
+
+    def __init__(self, uri=LIBVIRT_CONNECTION):
+        self.uri = uri
+
+    def run(self, op, **args):
+        return HOST_OPERATIONS[op](**args)
+
+    def provision_method(self, distro, golden=False):
+        return get_provision_method(distro, golden=golden)
+
+
+class SshHost(object):
+    """Remote hypervisor, operations run by the package copied there
+
+    Requires python with the package dependencies and passwordless sudo
+    (for vmbuilder-privhelper) on the remote side. Requests are sent over
+    a single (multiplexed) ssh connection.
+    """
+    local = False
+
+    def __init__(self, uri, target, port=None, keyfile=None):
+        self.uri = uri
+        self.target = target
+        self.port = port
+        self.keyfile = keyfile
+        self.python = os.environ.get(REMOTE_PYTHON_ENV_VAR, REMOTE_PYTHON)
+        self._mutex = threading.Lock()
+        self._home = None
+        self._package_dir = None
+        self._images = {}
+        self._image_locks = {}
+
+    def _ssh(self, command, stdin_data=None, stdin=None):
+        mkdir_p(CONTROL_DIR)
+        os.chmod(CONTROL_DIR, 0o700)
+        argv = ['ssh', '-o', 'BatchMode=yes',
+                '-o', 'ControlMaster=auto',
+                '-o', 'ControlPath={0}/%C'.format(CONTROL_DIR),
+                '-o', 'ControlPersist={0}'.format(CONTROL_PERSIST)]
+        if self.port:
+            argv.extend(['-p', str(self.port)])
+        if self.keyfile:
+            argv.extend(['-i', self.keyfile])
+        argv.extend([self.target, command])
+        proc = subprocess.Popen(argv, stdout=subprocess.PIPE,
+                                stdin=subprocess.PIPE if stdin is None
+                                else stdin)
+        out, _ = proc.communicate(stdin_data)
+        if not isinstance(out, str):
+            out = out.decode('utf-8')
+        if proc.returncode != 0:
+            raise RemoteError("{0}: '{1}' failed (exit code {2})".format(
+                self.target, command, proc.returncode))
+        return out
+
+    def _setup(self):
+        """Copy the package to the host (once per version)"""
+        with self._mutex:
+            if self._package_dir is not None:
+                return self._package_dir
+            tarball, version = _package_tarball()
+            package_dir = '$HOME/{0}/remote/{1}'.format(REMOTE_CACHE_DIR,
+                                                        version)
+            out = self._ssh('if [ ! -d "{0}" ]; then '
+                            'mkdir -p "{0}.$$" && tar -xf - -C "{0}.$$" && '
+                            'mv -T "{0}.$$" "{0}"; fi; echo "$HOME"'.
+                            format(package_dir), stdin_data=tarball)
+            self._home = out.strip().split('\n')[-1]
+            self._package_dir = package_dir.replace('$HOME', self._home)
+            return self._package_dir
+
+    def run(self, op, **args):
+        if op not in HOST_OPERATIONS:
+            raise ValueError("operation {0} is not allowed".format(op))
+        package_dir = self._setup()
+        request = json.dumps({'op': op, 'args': args})
+        out = self._ssh('cd "{0}" && {1} -m vmbuilder.remotehost'.format(
+                        package_dir, self.python),
+                        stdin_data=request.encode('utf-8'))
+        replies = [line[len(REPLY_MARKER):] for line in out.split('\n')
+                   if line.startswith(REPLY_MARKER)]
+        if not replies:
+            raise RemoteError("{0}: {1}: no reply".format(self.target, op))
+        reply = json.loads(replies[-1])
+        if 'error' in reply:
+            raise RemoteError("{0}: {1}: {2}".format(self.target, op,
+                                                     reply['error']))
+        return reply['result']
+
+    def put_image(self, path):
+        """Copy the (source) image to the host unless it's there already,
+        return the remote path"""
+        identity = image_identity(path)
+        key = json.dumps(identity, sort_keys=True, default=str)
+        with self._mutex:
+            lock = self._image_locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self._images:
+                self._setup()
+                digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+                remote_path = '{0}/{1}/images/{2}/{3}'.format(
+                    self._home, REMOTE_CACHE_DIR, digest[:16],
+                    os.path.basename(path))
+                present = self._ssh('test -f "{0}" && echo yes || true'.
+                                    format(remote_path)).strip() == 'yes'
+                if not present:
+                    print("copying {0} to {1}".format(path, self.target))
+                    with open(path, 'rb') as f:
+                        self._ssh('mkdir -p "$(dirname "{0}")" && '
+                                  'cat > "{0}.$$" && mv "{0}.$$" "{0}"'.
+                                  format(remote_path), stdin=f)
+                self._images[key] = remote_path
+            return self._images[key]
+
+    def provision_method(self, distro, golden=False):
+        """Function provisioning drives on the host, the same arguments
+        as provision_vm.provision"""
+        def provision(vdisks, img=None, config_drives=(), **kwargs):
+            encoded = []
+            for config_drive in config_drives:
+                if not isinstance(config_drive, FatImage):
+                    raise ValueError("{0}: only in memory config drives can "
+                                     "be used remotely".format(self.target))
+                encoded.append(base64.b64encode(config_drive.data()).
+                               decode('ascii'))
+            self.run('provision', distro=distro, golden=golden,
+                     vdisks=list(vdisks), img=self.put_image(img),
+                     config_drives=encoded, **kwargs)
+
+        return provision
+
+
+def get_host(uri=LIBVIRT_CONNECTION):
+    """The host (shared by all callers) libvirtd of the given URI runs on"""
+    with _HOSTS_MUTEX:
+        if uri not in _HOSTS:
+            target = ssh_target(uri)
+            if target is None:
+                _HOSTS[uri] = LocalHost(uri)
+            else:
+                _HOSTS[uri] = SshHost(uri, *target)
+        return _HOSTS[uri]
+
+
+def main():
+    """Serve a single request (read from stdin) on a remote hypervisor"""
+    request = json.loads(sys.stdin.read())
+    try:
+        if request['op'] not in HOST_OPERATIONS:
+            raise ValueError("operation {0} is not allowed".format(
+                             request['op']))
+        operation = HOST_OPERATIONS[request['op']]
+        if request['op'] in UNPRIVILEGED_OPERATIONS:
+            result = operation(**request['args'])
+        else:
+            with privileged_helper():
+                result = operation(**request['args'])
+        reply = {'result': result}
+    except Exception as e:
+        reply = {'error': '{0}: {1}'.format(type(e).__name__, e)}
+    # errors are reported in the reply
+    sys.stdout.write('\n' + REPLY_MARKER + json.dumps(reply) + '\n')
+    sys.stdout.flush()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,134 @@
+from __future__ import absolute_import
+
+# Live progress of a run, served by the cloud-init callback server as JSON
+# (/status) and in the Prometheus text format (/metrics)
+
+import threading
+import time
+
+from collections import OrderedDict
+from .py3compat import command_counts
+from .remotehost import get_host
+
+# seconds the usage of thin pools is cached for (querying it runs lvs)
+THIN_POOL_REFRESH = 10.0
+
+
+class RunStatus(object):
+    """Snapshot of the scheduler, the I/O throttler, thin pools, etc"""
+    def __init__(self, scheduler, io_throttler=None, thin_pools=()):
+        self._scheduler = scheduler
+        self._io_throttler = io_throttler
+        self._thin_pools = list(thin_pools)
+        self._started = time.time()
+        self._mutex = threading.Lock()
+        self._pool_usage = []
+        self._pool_usage_at = None
+
+    def _thin_pool_usage(self):
+        with self._mutex:
+            now = time.time()
+            if self._pool_usage_at is not None and \
+                    now - self._pool_usage_at < THIN_POOL_REFRESH:
+                return self._pool_usage
+            usage = []
+            for uri, vg, thin_pool in self._thin_pools:
+                entry = OrderedDict([('uri', uri), ('vg', vg),
+                                     ('thin_pool', thin_pool)])
+                try:
+                    entry.update(get_host(uri).run('thin_pool_usage', vg=vg,
+                                                   thin_pool=thin_pool))
+                except Exception as e:
+                    entry['error'] = str(e)
+                usage.append(entry)
+            self._pool_usage = usage
+            self._pool_usage_at = now
+            return usage
+
+    def snapshot(self):
+        status = OrderedDict()
+        status['elapsed'] = time.time() - self._started
+        status.update(self._scheduler.snapshot())
+        if self._io_throttler is not None:
+            status['io_throttler'] = self._io_throttler.occupancy()
+        status['thin_pools'] = self._thin_pool_usage()
+        status['commands'] = command_counts()
+        return status
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _sample(name, labels, value):
+    if labels:
+        name += '{' + ','.join('{0}="{1}"'.format(key, _escape(labels[key]))
+                               for key in sorted(labels)) + '}'
+    if isinstance(value, float):
+        return '{0} {1}'.format(name, repr(value))
+    return '{0} {1}'.format(name, int(value))
+
+
+def format_metrics(status):
+    """The status (see RunStatus.snapshot) in the Prometheus text format"""
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append('# HELP {0} {1}'.format(name, help_text))
+        lines.append('# TYPE {0} {1}'.format(name, kind))
+        for labels, value in samples:
+            lines.append(_sample(name, labels, value))
+
+    vms = status.get('vms', {})
+    metric('vmbuilder_elapsed_seconds', 'gauge', 'Time since the run began',
+           [({}, status['elapsed'])])
+    metric('vmbuilder_stages', 'gauge', 'VM build stages by state',
+           [({'state': state}, count)
+            for state, count in status.get('stages', {}).items()])
+    metric('vmbuilder_vm_stage', 'gauge', 'Current stage of the VM',
+           [({'vm': vm, 'stage': info['stage'], 'state': info['state']}, 1)
+            for vm, info in vms.items() if info['stage'] is not None])
+    metric('vmbuilder_vm_stage_seconds', 'gauge',
+           'Time the VM has spent waiting for/running the stage',
+           [({'vm': vm, 'stage': stage, 'phase': phase}, float(seconds))
+            for vm, info in vms.items()
+            for stage, times in info['stages'].items()
+            for phase, seconds in sorted(times.items())])
+    io = status.get('io_throttler')
+    if io is not None:
+        for key, name, help_text in (
+                ('held', 'vmbuilder_io_slots_held', 'I/O slots held'),
+                ('level', 'vmbuilder_io_concurrency_level',
+                 'I/O slots of the drive'),
+                ('waiting', 'vmbuilder_io_waiting_vms',
+                 'VMs yet to take a slot of the drive')):
+            metric(name, 'gauge', help_text,
+                   [({'uri': d['uri'], 'drive': d['drive']}, d[key])
+                    for d in io['drives']])
+        metric('vmbuilder_io_leases', 'gauge',
+               'I/O throttler leases (active, expired, released as idle)',
+               [({'state': state}, count)
+                for state, count in sorted(io['leases'].items())])
+    pools = [p for p in status.get('thin_pools', []) if 'error' not in p]
+    metric('vmbuilder_thin_pool_data_percent', 'gauge',
+           'Used data space of the thin pool',
+           [({'uri': p['uri'], 'vg': p['vg'], 'thin_pool': p['thin_pool']},
+             float(p['data_percent'])) for p in pools])
+    metric('vmbuilder_thin_pool_size_bytes', 'gauge', 'Size of the thin pool',
+           [({'uri': p['uri'], 'vg': p['vg'], 'thin_pool': p['thin_pool']},
+             int(p['size_mb'] * 2 ** 20)) for p in pools])
+    metric('vmbuilder_commands_total', 'counter', 'External commands run',
+           [({'command': command}, count)
+            for command, count in sorted(status.get('commands', {}).items())])
+    callback = status.get('callback')
+    if callback is not None:
+        metric('vmbuilder_callback_queue_depth', 'gauge',
+               'Phone home requests queued for processing',
+               [({}, callback['queue'])])
+        metric('vmbuilder_vms_ready', 'gauge', 'VMs which have phoned home',
+               [({}, callback['ready'])])
+        metric('vmbuilder_vms_waiting', 'gauge',
+               'VMs which have not phoned home yet',
+               [({}, callback['waiting'])])
+    return '\n'.join(lines) + '\n'
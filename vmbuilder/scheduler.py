@@ -0,0 +1,220 @@
+from __future__ import absolute_import
+
+# Run per VM stages (a DAG) on a bounded pool of threads, respecting
+# per resource concurrency limits
+
+import sys
+import threading
+import time
+import traceback
+
+from collections import OrderedDict, defaultdict
+from .py3compat import raise_exception
+from .timing import get_tracer, phase, vm_context
+
+DEFAULT_WORKERS = 16
+
+_PRECEDENCE = {'pending': 0, 'done': 1, 'ready': 2, 'running': 3}
+
+
+class Stage(object):
+    """A step of building a VM
+
+    resources: names of the resources used while the stage runs
+    gate: callable which tries to take a slot held after the stage ends
+    (i.e. the I/O throttler), returns False if the stage can't start yet
+    Stages without func are external: complete() marks them as done.
+    """
+    def __init__(self, name, func=None, resources=(), deps=(), gate=None,
+                 vm=None):
+        self.name = name
+        self.func = func
+        self.resources = tuple(resources)
+        self.gate = gate
+        self.vm = vm
+        self.dependents = []
+        self.pending = len(deps)
+        self.ready_at = None
+        self.started_at = None
+        self.finished_at = None
+        self.done = False
+        for dep in deps:
+            dep.dependents.append(self)
+
+
+class Scheduler(object):
+    """Run stages as soon as their dependencies are done and the resources
+    they need are available, on at most `workers` threads"""
+    def __init__(self, workers=DEFAULT_WORKERS, limits=None, tracer=None):
+        self.workers = workers
+        self._limits = dict(limits or {})
+        self._in_use = defaultdict(int)
+        self._cond = threading.Condition()
+        self._stages = []
+        self._ready = []
+        self._done = 0
+        self._error = None
+        self._tracer = tracer or get_tracer()
+
+    def set_limit(self, resource, limit):
+        with self._cond:
+            self._limits[resource] = limit
+
+    def add(self, name, func=None, resources=(), deps=(), gate=None,
+            vm=None):
+        stage = Stage(name, func=func, resources=resources, deps=deps,
+                      gate=gate, vm=vm)
+        with self._cond:
+            self._stages.append(stage)
+            if stage.pending == 0:
+                self._make_ready(stage)
+        return stage
+
+    def _make_ready(self, stage):
+        stage.ready_at = time.time()
+        if stage.func is not None:
+            self._ready.append(stage)
+        else:
+            # external stages are "running" until completed
+            stage.started_at = stage.ready_at
+
+    def _finish(self, stage):
+        stage.done = True
+        stage.finished_at = time.time()
+        self._done += 1
+        for dependent in stage.dependents:
+            dependent.pending -= 1
+            if dependent.pending == 0:
+                self._make_ready(dependent)
+        self._cond.notify_all()
+
+    def complete(self, stage):
+        """Mark an external stage (i.e. waiting for a callback) as done"""
+        with self._cond:
+            if not stage.done:
+                self._finish(stage)
+
+    def fail(self, stage, error):
+        """Fail an external stage (i.e. the VM crashed instead of calling
+        back), the run stops as if a stage raised the error"""
+        with self._cond:
+            if not stage.done and self._error is None:
+                self._error = (type(error), error, None)
+            self._cond.notify_all()
+
+    def wakeup(self, **kwargs):
+        """Re-check the stages waiting for gates (i.e. a slot was freed)"""
+        with self._cond:
+            self._cond.notify_all()
+
+    def _try_start(self, stage):
+        for resource in stage.resources:
+            limit = self._limits.get(resource)
+            if limit is not None and self._in_use[resource] >= limit:
+                return False
+        if stage.gate is not None and not stage.gate():
+            return False
+        for resource in stage.resources:
+            self._in_use[resource] += 1
+        return True
+
+    def _next_stage(self):
+        """The first ready stage which can start now (under the lock)"""
+        for n, stage in enumerate(self._ready):
+            if self._try_start(stage):
+                del self._ready[n]
+                stage.started_at = time.time()
+                return stage
+        return None
+
+    def snapshot(self):
+        """Progress of the run
+
+        Returns {'vms': {vm: {'stage', 'state', 'stages'}}, 'stages':
+        {'pending', 'ready', 'running', 'done', 'total'}}. The current
+        stage of a VM is the one running (or waiting for resources),
+        stages hold {name: {'wait': seconds, 'run': seconds}}.
+        """
+        now = time.time()
+        counts = OrderedDict((state, 0) for state in
+                             ('pending', 'ready', 'running', 'done'))
+        vms = OrderedDict()
+        with self._cond:
+            for stage in self._stages:
+                if stage.done:
+                    state = 'done'
+                elif stage.started_at is not None:
+                    state = 'running'
+                elif stage.ready_at is not None:
+                    state = 'ready'
+                else:
+                    state = 'pending'
+                counts[state] += 1
+                if stage.vm is None:
+                    continue
+                vm = vms.setdefault(stage.vm, {'stage': None,
+                                               'state': 'pending',
+                                               'stages': OrderedDict()})
+                if state == 'pending':
+                    continue
+                started = stage.started_at or now
+                vm['stages'][stage.name] = {
+                    'wait': started - stage.ready_at,
+                    'run': (stage.finished_at or now) - started
+                    if stage.started_at is not None else 0.0,
+                }
+                # a VM's stages are added in order: report the last one
+                # running, waiting, or done (in this order of preference)
+                if _PRECEDENCE[state] >= _PRECEDENCE[vm['state']]:
+                    vm['stage'], vm['state'] = stage.name, state
+        counts['total'] = len(self._stages)
+        return {'vms': vms, 'stages': counts}
+
+    def _run_stage(self, stage):
+        started = time.time()
+        self._tracer.record('{0}_wait'.format(stage.name), stage.ready_at,
+                            started - stage.ready_at, vm=stage.vm)
+        with vm_context(stage.vm):
+            with phase(stage.name):
+                stage.func()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._error is not None or \
+                            self._done == len(self._stages):
+                        self._cond.notify_all()
+                        return
+                    stage = self._next_stage()
+                    if stage is not None:
+                        break
+                    self._cond.wait()
+            try:
+                self._run_stage(stage)
+            except Exception:
+                traceback.print_exc()
+                with self._cond:
+                    if self._error is None:
+                        self._error = sys.exc_info()
+                    self._cond.notify_all()
+                return
+            finally:
+                with self._cond:
+                    for resource in stage.resources:
+                        self._in_use[resource] -= 1
+            self.complete(stage)
+
+    def run(self):
+        """Run all stages, re-raise the first error (if any)"""
+        threads = [threading.Thread(target=self._worker,
+                                    name='stage-worker-{0}'.format(n))
+                   for n in range(max(min(self.workers, len(self._stages)),
+                                      1))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self._error is not None:
+            raise_exception(*self._error)
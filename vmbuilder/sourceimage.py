@@ -0,0 +1,209 @@
+from __future__ import absolute_import
+
+# Read and copy raw, qcow2, and compressed (xz, zstd) raw source images
+# without converting them to intermediate raw files
+
+import os
+
+from .blockcopy import (
+    DEFAULT_BLOCK_SIZE,
+    CopyStats,
+    copy_range,
+    copy_stream,
+)
+from .driveutils import wipe_range
+from .py3compat import subprocess
+from .qcow2 import QCOW2_MAGIC, Qcow2Image
+
+XZ_MAGIC = b'\xfd7zXZ\x00'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+FORMAT_MAGIC = (
+    ('qcow2', QCOW2_MAGIC),
+    ('xz', XZ_MAGIC),
+    ('zstd', ZSTD_MAGIC),
+)
+
+DECOMPRESSORS = {
+    'xz': ['xz', '-dc', '-T0'],
+    'zstd': ['zstd', '-dcq'],
+}
+
+SOURCE_FORMATS = ('raw', 'qcow2') + tuple(sorted(DECOMPRESSORS))
+
+# keep the beginning of the decompressed stream (partition table)
+# so it can be read more than once
+HEAD_SIZE = 64 * 1024
+READ_SIZE = 4 * 1024 * 1024
+
+# parallel out of order writes of qemu-img convert
+QEMU_IMG_COROUTINES = 8
+
+
+def detect_format(img):
+    with open(img, 'rb') as f:
+        magic = f.read(max(len(m) for _, m in FORMAT_MAGIC))
+    for fmt, fmt_magic in FORMAT_MAGIC:
+        if magic.startswith(fmt_magic):
+            return fmt
+    return 'raw'
+
+
+class RawImage(object):
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, 'rb')
+        self.size = os.fstat(self._f.fileno()).st_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._f.close()
+
+    def read(self, offset, length):
+        self._f.seek(offset)
+        return self._f.read(length)
+
+
+class DecompressedImage(object):
+    """Content of a compressed raw image
+
+    The data is decompressed on the fly, so it can only be read
+    sequentially (except for the first HEAD_SIZE bytes).
+    """
+    size = None
+
+    def __init__(self, path, fmt):
+        self.path = path
+        self._proc = subprocess.Popen(DECOMPRESSORS[fmt] + [path],
+                                      stdout=subprocess.PIPE)
+        self._pos = 0
+        self._head = b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._proc.stdout.close()
+        if self._proc.poll() is None:
+            self._proc.terminate()
+        self._proc.wait()
+
+    def _advance(self, length):
+        chunks = []
+        while length > 0:
+            chunk = self._proc.stdout.read(min(length, READ_SIZE))
+            if not chunk:
+                break
+            if self._pos < HEAD_SIZE:
+                self._head += chunk[:HEAD_SIZE - self._pos]
+            self._pos += len(chunk)
+            length -= len(chunk)
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def read(self, offset, length):
+        if offset + length <= len(self._head):
+            return self._head[offset:offset + length]
+        if offset < self._pos:
+            raise ValueError("{0}: can't read compressed image backwards".
+                             format(self.path))
+        while self._pos < offset:
+            if not self._advance(min(offset - self._pos, READ_SIZE)):
+                return b''
+        return self._advance(length)
+
+
+def open_image(img, fmt=None):
+    """Open the source image for reading its (guest visible) content"""
+    fmt = fmt or detect_format(img)
+    if fmt == 'qcow2':
+        return Qcow2Image(img)
+    elif fmt in DECOMPRESSORS:
+        return DecompressedImage(img, fmt)
+    return RawImage(img)
+
+
+def read_image(img, offset, length, fmt=None):
+    with open_image(img, fmt=fmt) as src:
+        return src.read(offset, length)
+
+
+def _qemu_img_opts(img, offset, length):
+    # commas in option values must be doubled
+    return ','.join(['driver=raw',
+                     'offset={0}'.format(offset),
+                     'size={0}'.format(length),
+                     'file.driver=qcow2',
+                     'file.file.driver=file',
+                     'file.file.filename={0}'.format(img.replace(',', ',,'))])
+
+
+def _convert_qcow2(img, dst, src_offset, length, wipe_length,
+                   discard_granularity):
+    stats = CopyStats()
+    fd = os.open(dst, os.O_WRONLY)
+    try:
+        stats.discarded, stats.zeroed = wipe_range(
+            fd, 0, wipe_length, discard_granularity=discard_granularity)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    # dst reads as zeros now, so qemu-img skips zero clusters
+    cmd = ['qemu-img', 'convert', '-n', '--target-is-zero',
+           '-W', '-m', str(QEMU_IMG_COROUTINES),
+           '--image-opts', _qemu_img_opts(img, src_offset, length),
+           '-O', 'raw', dst]
+    subprocess.check_call(cmd)
+    return stats
+
+
+def _stop_decompressor(proc, cmd):
+    """Wait for the decompressor, terminate it if it's still running
+    (the rest of the image is not needed)"""
+    terminated = proc.poll() is None
+    if terminated:
+        proc.terminate()
+    proc.stdout.close()
+    proc.wait()
+    if proc.returncode != 0 and not terminated:
+        raise RuntimeError("{0} failed with exit code {1}".format(
+                           ' '.join(cmd), proc.returncode))
+
+
+def copy_image(img, dst, src_offset=0, length=None, wipe_length=None,
+               block_size=DEFAULT_BLOCK_SIZE, discard_granularity=None,
+               fmt=None):
+    """Copy the range of the source image to dst (a partition)
+
+    Holes and zero blocks (clusters) are skipped, dst is discarded instead.
+    qcow2 images are converted by qemu-img, compressed ones are
+    decompressed on the fly.
+    """
+    fmt = fmt or detect_format(img)
+    wipe_length = wipe_length or length
+    if fmt == 'qcow2':
+        return _convert_qcow2(img, dst, src_offset, length, wipe_length,
+                              discard_granularity)
+    elif fmt in DECOMPRESSORS:
+        cmd = DECOMPRESSORS[fmt] + [img]
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        try:
+            stats = copy_stream(proc.stdout, dst, skip=src_offset,
+                                length=length, wipe_length=wipe_length,
+                                block_size=block_size,
+                                discard_granularity=discard_granularity)
+        finally:
+            # a failed decompressor explains a short read too
+            _stop_decompressor(proc, cmd)
+        return stats
+    return copy_range(img, dst, src_offset=src_offset, length=length,
+                      wipe_length=wipe_length, block_size=block_size,
+                      discard_granularity=discard_granularity)
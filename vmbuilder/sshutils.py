@@ -1,6 +1,9 @@
 
 from __future__ import absolute_import
 
+import base64
+import hashlib
+import hmac
 import os
 import threading
 
@@ -44,6 +47,57 @@ def remove_ssh_known_host(name_or_ip, known_hosts_file=KNOWN_HOSTS_FILE):
                              '-R', name_or_ip])
 
 
+def _known_host_patterns(line):
+    """Host patterns of a known_hosts line (after @revoked, etc marker)"""
+    fields = line.split()
+    if fields[0].startswith('@'):
+        fields = fields[1:]
+    return fields[0].split(',') if fields else []
+
+
+def _host_matches(pattern, names):
+    if pattern.startswith('|1|'):
+        # hashed: |1|base64(salt)|base64(hmac-sha1(salt, name))
+        try:
+            salt, digest = [base64.b64decode(part)
+                            for part in pattern[3:].split('|', 1)]
+        except (TypeError, ValueError):
+            return False
+        return any(hmac.new(salt, name.encode('utf-8'),
+                            hashlib.sha1).digest() == digest
+                   for name in names)
+    return pattern in names
+
+
+def remove_known_hosts(names, known_hosts_file=KNOWN_HOSTS_FILE):
+    """Remove keys of all the given hosts (names or IPs, hashed entries
+    included) from known_hosts_file, rewriting the file once
+
+    Returns the number of entries removed.
+    """
+    names = set(name for name in names if name)
+    if not names:
+        return 0
+    with KNOWN_HOSTS_MUTEX:
+        try:
+            with open(known_hosts_file, 'r') as f:
+                lines = f.readlines()
+        except IOError:
+            return 0
+        kept = []
+        for line in lines:
+            if line.strip() and not line.lstrip().startswith('#'):
+                patterns = _known_host_patterns(line)
+                if any(_host_matches(p, names) for p in patterns):
+                    continue
+            kept.append(line)
+        removed = len(lines) - len(kept)
+        if removed:
+            with safe_save_file(known_hosts_file) as f:
+                f.writelines(kept)
+        return removed
+
+
 def update_known_hosts(ips=None, ssh_key=None,
                        known_hosts_file=KNOWN_HOSTS_FILE):
     """Update ssh key of the specified host from known_hosts_file
@@ -52,22 +106,23 @@ def update_known_hosts(ips=None, ssh_key=None,
     update_known_hosts(ips=ips, ssh_key='foobar')
     """
 
-    for ip, hostname in ips:
-        # wipe out the old keys (if any)
-        remove_ssh_known_host(hostname)
-        remove_ssh_known_host(guess_fqdn(ip=ip, hostname=hostname))
-        # Remove entries having the same IP just in a case. Note that
-        # addr might be None for several reasons (VM is down at the moment,
-        # network configuration is still in progress, etc)
-        if ip:
-            remove_ssh_known_host(ip)
-
-    if ssh_key:
-        entries = []
-        for ip, hostname in ips:
-            fqdn = guess_fqdn(ip=ip, hostname=hostname)
-            entries.append('{fqdn},{ip} {key}'.format(fqdn=fqdn, ip=ip, key=ssh_key))
-        with KNOWN_HOSTS_MUTEX:
+    # wipe out the old keys (if any). Remove entries having the same IP
+    # just in a case. Note that addr might be None for several reasons
+    # (VM is down at the moment, network configuration is still in
+    # progress, etc)
+    fqdns = [(ip, hostname, guess_fqdn(ip=ip, hostname=hostname))
+             for ip, hostname in ips]
+    names = []
+    for ip, hostname, fqdn in fqdns:
+        names.extend([hostname, fqdn, ip])
+
+    with KNOWN_HOSTS_MUTEX:
+        remove_known_hosts(names, known_hosts_file=known_hosts_file)
+        if ssh_key:
+            entries = []
+            for ip, hostname, fqdn in fqdns:
+                entries.append('{fqdn},{ip} {key}'.format(fqdn=fqdn, ip=ip,
+                                                          key=ssh_key))
             with open(known_hosts_file, 'a') as f:
                 for entry in entries:
                     f.write(entry + '\n')
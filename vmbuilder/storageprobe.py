@@ -0,0 +1,146 @@
+from __future__ import absolute_import
+
+# Measure how the storage behind a thin pool copes with concurrent
+# sequential writers and readers (which is what provisioning VMs does)
+
+import errno
+import io
+import mmap
+import os
+import threading
+import time
+
+from . import privhelper
+from .driveutils import disk_stats, physical_drives, vg_pvs
+from .thinpool import create_thin_lv, remove_lv
+
+PROBE_LV = 'vmbuilder-calibrate'
+PROBE_BLOCK_SIZE = 1024 * 1024
+# seconds spent writing (and then reading) at each concurrency level
+PROBE_SECONDS = 2.0
+# the part of the probe LV each writer cycles through, MiB
+PROBE_REGION_SIZE = 256
+
+
+def probe_levels(max_level):
+    """1, 2, 4, ..., max_level"""
+    levels = []
+    level = 1
+    while level < max_level:
+        levels.append(level)
+        level *= 2
+    levels.append(max_level)
+    return levels
+
+
+def _open(path, flags):
+    """Open the drive bypassing the page cache if possible"""
+    try:
+        return os.open(path, flags | getattr(os, 'O_DIRECT', 0))
+    except OSError as e:
+        if e.errno != errno.EINVAL:
+            raise
+        return os.open(path, flags)
+
+
+def _stream(path, offset, length, deadline, write, done, index, errors):
+    """Write (or read) the region block by block until the deadline"""
+    try:
+        # page aligned, as O_DIRECT requires
+        buf = mmap.mmap(-1, PROBE_BLOCK_SIZE)
+        buf.write(b'\xa5' * PROBE_BLOCK_SIZE)
+        f = io.FileIO(_open(path, os.O_WRONLY if write else os.O_RDONLY),
+                      'w' if write else 'r')
+        try:
+            count = 0
+            while time.time() < deadline:
+                f.seek(offset + count * PROBE_BLOCK_SIZE % length)
+                if write:
+                    f.write(buf)
+                else:
+                    f.readinto(buf)
+                count += 1
+            if write:
+                os.fsync(f.fileno())
+        finally:
+            f.close()
+        done[index] = count * PROBE_BLOCK_SIZE
+    except Exception as e:
+        errors.append(e)
+
+
+def _run_streams(path, extents, seconds, write):
+    """Run a writer (reader) per (offset, length) extent, return the
+    number of bytes transferred by each one"""
+    deadline = time.time() + seconds
+    done = [0] * len(extents)
+    errors = []
+    threads = [threading.Thread(target=_stream,
+                                args=(path, offset, length, deadline,
+                                      write, done, n, errors))
+               for n, (offset, length) in enumerate(extents)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return done
+
+
+def _stats_delta(devices, before, elapsed):
+    """(average latency in ms or None, the busiest device's utilization)"""
+    ios = ticks = 0
+    utilization = 0.0
+    for dev, old in zip(devices, before):
+        new = disk_stats(dev)
+        ios += new['read_ios'] + new['write_ios'] - \
+            old['read_ios'] - old['write_ios']
+        ticks += new['read_ticks'] + new['write_ticks'] - \
+            old['read_ticks'] - old['write_ticks']
+        utilization = max(utilization, (new['io_ticks'] - old['io_ticks']) /
+                          (elapsed * 1000.0))
+    return (float(ticks) / ios if ios else None), utilization
+
+
+def probe_thin_pool(vg=None, thin_pool=None, max_level=16,
+                    seconds=PROBE_SECONDS):
+    """Write and then read a fresh thin LV with 1, 2, 4, ... max_level
+    concurrent streams
+
+    Returns a list of {'level', 'mb_per_sec', 'latency_ms',
+    'utilization'} (one per level) as observed on the drives the VG's
+    PVs reside on.
+    """
+    devices = sorted(set(drive for pv in vg_pvs(vg)
+                         for drive in physical_drives(pv)))
+    path = '/dev/{0}/{1}'.format(vg, PROBE_LV)
+    region = PROBE_REGION_SIZE * 1024 * 1024
+    results = []
+    for level in probe_levels(max_level):
+        # unprovisioned chunks, as a new VM's drive has
+        create_thin_lv(vg=vg, thin_pool=thin_pool, name=PROBE_LV,
+                       size=PROBE_REGION_SIZE * level, force=True)
+        try:
+            privhelper.check_call('fix_ownership', paths=[path],
+                                  gid=os.getgid(), mode=0o660)
+            before = [disk_stats(dev) for dev in devices]
+            started = time.time()
+            written = _run_streams(path, [(n * region, region)
+                                          for n in range(level)],
+                                   seconds, write=True)
+            extents = [(n * region, max(min(size, region),
+                                        PROBE_BLOCK_SIZE))
+                       for n, size in enumerate(written)]
+            read = _run_streams(path, extents, seconds, write=False)
+            elapsed = time.time() - started
+            latency, utilization = _stats_delta(devices, before, elapsed)
+        finally:
+            remove_lv(vg=vg, lv=PROBE_LV)
+        results.append({
+            'level': level,
+            'mb_per_sec': (sum(written) + sum(read)) / elapsed / 2 ** 20,
+            'latency_ms': latency,
+            'utilization': utilization,
+        })
+    return results
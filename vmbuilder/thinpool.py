@@ -8,6 +8,7 @@ except ImportError:
 
 
 from collections import defaultdict
+from . import privhelper
 from .py3compat import subprocess
 
 
@@ -25,29 +26,42 @@ class NoSuchVG(exceptions.Exception):
 def remove_lv(lv=None, vg=None, dev=None):
     if dev is not None:
         vg, lv = _canonicalize_lv_path(dev)
-    cmd = ['sudo', 'lvremove', '-f', '{0}/{1}'.format(vg, lv)]
     try:
-        subprocess.check_call(cmd)
+        privhelper.check_call('lvremove', vg=vg, lv=lv)
     except subprocess.CalledProcessError as e:
         if e.returncode != LVM_NO_SUCH_LV:
             raise
 
 
+def remove_lvs(devs):
+    """Remove the given LVs (paths or (vg, lv) tuples) with one lvremove
+    per VG, missing LVs are ignored"""
+    by_vg = defaultdict(list)
+    for dev in devs:
+        vg, lv = dev if isinstance(dev, tuple) else _canonicalize_lv_path(dev)
+        if lv not in by_vg[vg]:
+            by_vg[vg].append(lv)
+    for vg, lvs in sorted(by_vg.items()):
+        try:
+            privhelper.check_call('lvremove_many', vg=vg, lvs=lvs)
+        except subprocess.CalledProcessError as e:
+            # lvremove removes the existing LVs even if some are missing
+            if e.returncode != LVM_NO_SUCH_LV:
+                raise
+
+
 def rename_lv(vg=None, old_lv=None, lv=None):
-    cmd = ['sudo', 'lvrename', '{0}/{1}'.format(vg, old_lv),
-           '{0}/{1}'.format(vg, lv)]
-    print("renaming LV: %s" % ' '.join(cmd))
-    subprocess.check_call(cmd)
+    print("renaming LV: {0}/{1} -> {0}/{2}".format(vg, old_lv, lv))
+    privhelper.check_call('lvrename', vg=vg, old_lv=old_lv, lv=lv)
 
 
 def query_thin_lv(vg=None, lv=None, thin_pool=None):
     fields = ['pool_lv', 'data_percent', 'lv_size', 'lv_uuid']
     separator = '|'
-    cmd = ['sudo', 'lvs', '--noheadings', '--nosuffix', '--units', 'm',
-           '--separator', separator, '-o', ','.join(fields),
-           '{0}/{1}'.format(vg, lv)]
     try:
-        raw_params = subprocess.check_output(cmd).strip().split(separator)
+        raw_params = privhelper.check_output(
+            'lvs', target='{0}/{1}'.format(vg, lv), fields=fields,
+            units='m', separator=separator).strip().split(separator)
     except subprocess.CalledProcessError as e:
         if e.returncode == LVM_NO_SUCH_LV:
             raise NoSuchLV('{0}/{1}'.format(vg, lv))
@@ -63,10 +77,24 @@ def query_thin_lv(vg=None, lv=None, thin_pool=None):
     return params
 
 
+def thin_pool_of(vg=None, lv=None):
+    """Thin pool of the LV, None if it's not a thin LV"""
+    out = privhelper.check_output('lvs', target='{0}/{1}'.format(vg, lv),
+                                  fields=['pool_lv'])
+    return out.strip() or None
+
+
+def thin_pool_chunk_size(vg=None, thin_pool=None):
+    """Allocation unit of the thin pool (in bytes)"""
+    out = privhelper.check_output('lvs',
+                                  target='{0}/{1}'.format(vg, thin_pool),
+                                  fields=['chunk_size'], units='b')
+    return int(out.strip())
+
+
 def _create_thin_lv(name=None, thin_pool=None, size=None, vg=None):
-    cmd = ['sudo', 'lvcreate', '-T', '{0}/{1}'.format(vg, thin_pool),
-           '-n', name, '-V', '{}M'.format(size)]
-    subprocess.check_call(cmd)
+    privhelper.check_call('lvcreate_thin', vg=vg, thin_pool=thin_pool,
+                          name=name, size=size)
 
 
 def thin_lv_exists(name=None, thin_pool=None, size=None, vg=None):
@@ -111,9 +139,25 @@ def create_thin_snapshot(name=None, vg=None, lv=None):
     if exists:
         print("removing old snapshot '{0}/{1}'".format(vg, lv))
         remove_lv(vg=vg, lv=name)
-    cmd = ['sudo', 'lvcreate', '-s', '-n', name, '{0}/{1}'.format(vg, lv)]
-    print("creating thin snapshot: %s" % ' '.join(cmd))
-    subprocess.check_call(cmd)
+    print("creating thin snapshot: {0}/{1} of {0}/{2}".format(vg, name, lv))
+    privhelper.check_call('lvcreate_snapshot', vg=vg, lv=lv, name=name)
+
+
+def activate_lv(vg=None, lv=None):
+    """Activate LV, including thin snapshots flagged to skip activation"""
+    privhelper.check_call('lvchange_activate', vg=vg, lv=lv)
+
+
+def list_lvs(vg=None):
+    """List names of all LVs in the given VG"""
+    try:
+        out = privhelper.check_output('lvs', target=vg, fields=['lv_name'])
+    except subprocess.CalledProcessError as e:
+        if e.returncode == LVM_NO_SUCH_LV:
+            raise NoSuchVG(vg)
+        else:
+            raise
+    return [l.strip() for l in out.strip().split('\n') if l.strip()]
 
 
 def revert_thin_snapshot(name=None, vg=None, lv=None, lv_path=None):
@@ -136,9 +180,8 @@ def vgs():
     """ List all VGs along with their physical volumes"""
     separator = ';'
     fields = ['vg_name', 'pv_name']
-    cmd = ['sudo', 'pvs', '--noheadings', '--separator', separator,
-           '-o', ','.join(fields)]
-    entries = subprocess.check_output(cmd).strip().split('\n')
+    entries = privhelper.check_output('pvs', fields=fields,
+                                      separator=separator).strip().split('\n')
     ret = defaultdict(list)
     for line in entries:
         values = line.strip().split(separator)
@@ -0,0 +1,169 @@
+from __future__ import absolute_import
+
+# Per VM, per phase wall clock and CPU timings of provisioning
+
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from .miscutils import mkdir_p
+from .py3compat import children_cpu_time
+
+# missing in python 2.7, the value is the same on all Linux arches
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1)
+
+_context = threading.local()
+
+
+def _thread_cpu_time():
+    """CPU time of the calling thread and of external commands it has
+    waited for"""
+    usage = resource.getrusage(RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime + children_cpu_time()
+
+
+def current_vm():
+    return getattr(_context, 'vm', None)
+
+
+def _phases():
+    if not hasattr(_context, 'phases'):
+        _context.phases = []
+    return _context.phases
+
+
+class Tracer(object):
+    """Collect timings, optionally write them as JSON lines"""
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._records = []
+        self._trace = None
+
+    def open(self, path):
+        """Start a new trace file"""
+        with self._mutex:
+            self._records = []
+            if self._trace:
+                self._trace.close()
+            mkdir_p(os.path.dirname(path))
+            self._trace = open(path, 'w')
+
+    def close(self):
+        with self._mutex:
+            if self._trace:
+                self._trace.close()
+                self._trace = None
+
+    def record(self, phase, start, wall, cpu=None, vm=None, parent=None):
+        entry = OrderedDict([
+            ('vm', vm),
+            ('phase', phase),
+            ('parent', parent),
+            ('start', round(start, 6)),
+            ('wall', round(wall, 6)),
+            ('cpu', round(cpu, 6) if cpu is not None else None),
+            ('thread', threading.current_thread().name),
+        ])
+        with self._mutex:
+            self._records.append(entry)
+            if self._trace:
+                self._trace.write(json.dumps(entry) + '\n')
+                self._trace.flush()
+
+    def records(self):
+        with self._mutex:
+            return list(self._records)
+
+    def summary(self):
+        """Format phase and VM totals as a table"""
+        phases = OrderedDict()
+        vms = OrderedDict()
+        for r in self.records():
+            stat = phases.setdefault(r['phase'], [0, 0.0, 0.0, 0.0])
+            stat[0] += 1
+            stat[1] += r['wall']
+            stat[2] = max(stat[2], r['wall'])
+            stat[3] += r['cpu'] or 0.0
+            if r['parent'] is None and r['vm'] is not None:
+                vms[r['vm']] = vms.get(r['vm'], 0.0) + r['wall']
+        fmt = '{0:<24} {1:>6} {2:>10} {3:>10} {4:>10}'
+        lines = [fmt.format('phase', 'calls', 'wall', 'max wall', 'cpu')]
+        for phase, (calls, wall, max_wall, cpu) in phases.items():
+            lines.append(fmt.format(phase, calls, '%.2f' % wall,
+                                    '%.2f' % max_wall, '%.2f' % cpu))
+        if vms:
+            lines.append('')
+            lines.append('{0:<24} {1:>10}'.format('vm', 'wall'))
+            for vm, wall in vms.items():
+                lines.append('{0:<24} {1:>10}'.format(vm, '%.2f' % wall))
+        return '\n'.join(lines)
+
+    def print_summary(self, out=sys.stdout):
+        out.write(self.summary() + '\n')
+        out.flush()
+
+
+_TRACER = Tracer()
+
+
+def get_tracer():
+    return _TRACER
+
+
+@contextmanager
+def vm_context(vm):
+    """Attribute phases run by the current thread to the given VM"""
+    saved = current_vm()
+    _context.vm = vm
+    try:
+        yield
+    finally:
+        _context.vm = saved
+
+
+@contextmanager
+def phase(name, vm=None, tracer=_TRACER):
+    """Time the enclosed block, nested phases record their parent"""
+    stack = _phases()
+    parent = stack[-1] if stack else None
+    stack.append(name)
+    start, cpu_start = time.time(), _thread_cpu_time()
+    try:
+        yield
+    finally:
+        wall = time.time() - start
+        cpu = _thread_cpu_time() - cpu_start
+        stack.pop()
+        tracer.record(name, start, wall, cpu=cpu,
+                      vm=vm or current_vm(), parent=parent)
+
+
+def timed(name):
+    """Decorator: time every call of the function as the given phase"""
+    def actual_decorator(f):
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return actual_decorator
+
+
+@contextmanager
+def acquired(lock, name):
+    """Hold the lock, time waiting for it as the given phase"""
+    with phase(name):
+        lock.acquire()
+    try:
+        yield
+    finally:
+        lock.release()
@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+# Purpose: talk to libvirtd via a shared libvirt-python connection,
+# fall back to running virsh if the bindings are not available
+
+from __future__ import absolute_import
+
+import optparse
+import os
+import re
+import threading
+from xml.etree import ElementTree
+
+try:
+    import libvirt
+except ImportError:
+    libvirt = None
+
+from .py3compat import subprocess
+
+LIBVIRT_CONNECTION = 'qemu:///system'
+
+# 'libvirt' or 'virsh', the default is libvirt if the bindings are available
+BACKEND_ENV_VAR = 'VMBUILDER_VIRT_BACKEND'
+
+# virDomainState values, named as virsh domstate does
+DOMAIN_STATES = {
+    0: 'no state',
+    1: 'running',
+    2: 'idle',
+    3: 'paused',
+    4: 'in shutdown',
+    5: 'shut off',
+    6: 'crashed',
+    7: 'pmsuspended',
+}
+
+# node memory stats (KiB) counted as available for new domains
+MEMORY_AVAILABLE = ('free', 'buffers', 'cached')
+
+# virDomainBlockStats fields (as virsh domblkstat names them)
+BLOCK_STATS = ('rd_req', 'rd_bytes', 'wr_req', 'wr_bytes')
+
+# virDomainEventType values, named as virsh event does
+LIFECYCLE_EVENTS = (
+    'Defined',
+    'Undefined',
+    'Started',
+    'Suspended',
+    'Resumed',
+    'Stopped',
+    'Shutdown',
+    'PMSuspended',
+    'Crashed',
+)
+
+# event 'lifecycle' for domain 'vm1': Started Booted
+# (older virsh versions don't quote the domain name)
+VIRSH_EVENT_RX = re.compile(
+    r"^event 'lifecycle' for domain '?(?P<name>.+?)'?: (?P<event>\w+)")
+
+_BACKENDS = {}
+_BACKENDS_MUTEX = threading.Lock()
+_EVENT_LOOP_MUTEX = threading.Lock()
+_event_loop_thread = None
+
+
+class NoSuchDomain(RuntimeError):
+    pass
+
+
+class NoSuchNetwork(RuntimeError):
+    pass
+
+
+class VirshBackend(object):
+    """Run virsh for every operation"""
+    def __init__(self, uri=LIBVIRT_CONNECTION):
+        self.uri = uri
+
+    def _virsh(self, *args, **kwargs):
+        cmd = ['virsh', '-c', self.uri]
+        cmd.extend(args)
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate(kwargs.get('stdin_data'))
+        if not isinstance(out, str):
+            out, err = out.decode('utf-8'), err.decode('utf-8')
+        if proc.returncode != 0:
+            if 'failed to get domain' in err:
+                raise NoSuchDomain(args[-1])
+            if 'failed to get network' in err:
+                raise NoSuchNetwork(args[-1])
+            raise RuntimeError('virsh {0} failed: {1}'.format(
+                ' '.join(args), err.strip()))
+        return out
+
+    def dom_state(self, name):
+        """State of the domain (as virsh domstate), None if there's none"""
+        try:
+            return self._virsh('domstate', name).strip()
+        except NoSuchDomain:
+            return None
+
+    def dom_xml(self, name):
+        return ElementTree.fromstring(self._virsh('dumpxml', name).strip())
+
+    def list_domains(self, inactive=True):
+        args = ['list', '--name']
+        if inactive:
+            args.append('--all')
+        out = self._virsh(*args)
+        return set(line.strip() for line in out.split('\n') if line.strip())
+
+    def define(self, raw_xml):
+        self._virsh('define', '/dev/stdin', stdin_data=raw_xml)
+
+    def start(self, name):
+        self._virsh('start', name)
+
+    def destroy(self, name):
+        self._virsh('destroy', name)
+
+    def undefine(self, name):
+        self._virsh('undefine', name)
+
+    def listen_lifecycle(self, callback):
+        """Invoke callback(domain_name, event) on lifecycle events of all
+        domains (in a dedicated thread), returns a function to stop"""
+        cmd = ['virsh', '-c', self.uri, 'event', '--all', '--loop',
+               '--event', 'lifecycle']
+        with open(os.devnull, 'w') as null:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                    stderr=null, universal_newlines=True)
+
+        def reader():
+            for line in iter(proc.stdout.readline, ''):
+                match = VIRSH_EVENT_RX.match(line.strip())
+                if match:
+                    callback(match.group('name'), match.group('event'))
+
+        thread = threading.Thread(target=reader, name='virsh-event')
+        thread.daemon = True
+        thread.start()
+
+        def stop():
+            if proc.poll() is None:
+                proc.terminate()
+            proc.wait()
+            thread.join()
+
+        return stop
+
+    def block_stats(self, name):
+        """I/O done by the domain: {'rd_req', 'rd_bytes', 'wr_req',
+        'wr_bytes'} summed over all its drives"""
+        # without a device domblkstat sums up all of them:
+        #  rd_req 1234
+        stats = {}
+        for line in self._virsh('domblkstat', name).split('\n'):
+            fields = line.split()
+            if len(fields) >= 2 and fields[-1].isdigit():
+                stats[fields[-2]] = int(fields[-1])
+        return dict((key, stats.get(key, 0)) for key in BLOCK_STATS)
+
+    def net_xml(self, net_name):
+        out = self._virsh('net-dumpxml', net_name)
+        return ElementTree.fromstring(out.strip())
+
+    def node_free_memory(self):
+        """Memory available for domains (free + buffers + cached), KiB"""
+        # free   :      1234567 KiB
+        stats = {}
+        for line in self._virsh('nodememstats').split('\n'):
+            if ':' in line:
+                key, value = line.split(':', 1)
+                stats[key.strip()] = int(value.split()[0])
+        return sum(stats.get(key, 0) for key in MEMORY_AVAILABLE)
+
+
+def _run_event_loop():
+    while True:
+        libvirt.virEventRunDefaultImpl()
+
+
+def _start_event_loop():
+    """Dispatch libvirt events (and keepalives), must be started before
+    opening connections"""
+    global _event_loop_thread
+    with _EVENT_LOOP_MUTEX:
+        if _event_loop_thread is not None:
+            return
+        libvirt.virEventRegisterDefaultImpl()
+        _event_loop_thread = threading.Thread(target=_run_event_loop,
+                                              name='libvirt-event-loop')
+        _event_loop_thread.daemon = True
+        _event_loop_thread.start()
+
+
+class LibvirtBackend(object):
+    """A single libvirt connection shared by all threads
+
+    Domain and network handles are looked up once and reused.
+    """
+    def __init__(self, uri=LIBVIRT_CONNECTION):
+        self.uri = uri
+        self._mutex = threading.Lock()
+        self._conn = None
+        self._domains = {}
+        self._networks = {}
+
+    def _connection(self):
+        """The connection, (re)opened if libvirtd has gone away"""
+        with self._mutex:
+            if self._conn is None or not self._conn.isAlive():
+                # don't print errors of failed lookups to stderr
+                libvirt.registerErrorHandler(lambda ctx, err: None, None)
+                _start_event_loop()
+                self._conn = libvirt.open(self.uri)
+                self._domains.clear()
+                self._networks.clear()
+            return self._conn
+
+    def _domain(self, name):
+        conn = self._connection()
+        with self._mutex:
+            dom = self._domains.get(name)
+        if dom is not None:
+            return dom
+        try:
+            dom = conn.lookupByName(name)
+        except libvirt.libvirtError as e:
+            if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+                raise NoSuchDomain(name)
+            raise
+        with self._mutex:
+            self._domains[name] = dom
+        return dom
+
+    def _forget_domain(self, name):
+        with self._mutex:
+            self._domains.pop(name, None)
+
+    def _call(self, name, method, *args):
+        """Invoke the domain method, look up the domain again if
+        the handle has gone stale (domain undefined by someone else)"""
+        try:
+            return getattr(self._domain(name), method)(*args)
+        except libvirt.libvirtError as e:
+            if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                raise
+            self._forget_domain(name)
+            return getattr(self._domain(name), method)(*args)
+
+    def dom_state(self, name):
+        try:
+            state, _ = self._call(name, 'state')
+        except NoSuchDomain:
+            return None
+        return DOMAIN_STATES.get(state, 'no state')
+
+    def dom_xml(self, name):
+        return ElementTree.fromstring(self._call(name, 'XMLDesc', 0))
+
+    def list_domains(self, inactive=True):
+        flags = 0 if inactive else libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE
+        domains = self._connection().listAllDomains(flags)
+        return set(dom.name() for dom in domains)
+
+    def define(self, raw_xml):
+        if not isinstance(raw_xml, str):
+            raw_xml = raw_xml.decode('utf-8')
+        dom = self._connection().defineXML(raw_xml)
+        with self._mutex:
+            self._domains[dom.name()] = dom
+
+    def start(self, name):
+        self._call(name, 'create')
+
+    def destroy(self, name):
+        self._call(name, 'destroy')
+
+    def undefine(self, name):
+        self._call(name, 'undefine')
+        self._forget_domain(name)
+
+    def listen_lifecycle(self, callback):
+        """Invoke callback(domain_name, event) on lifecycle events of all
+        domains (in the event loop thread), returns a function to stop"""
+        conn = self._connection()
+
+        def on_event(conn, dom, event, detail, opaque):
+            if 0 <= event < len(LIFECYCLE_EVENTS):
+                callback(dom.name(), LIFECYCLE_EVENTS[event])
+
+        callback_id = conn.domainEventRegisterAny(
+            None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, on_event, None)
+
+        def stop():
+            try:
+                conn.domainEventDeregisterAny(callback_id)
+            except libvirt.libvirtError:
+                # the connection has been closed already
+                pass
+
+        return stop
+
+    def block_stats(self, name):
+        # an empty path sums up all the domain's drives
+        values = self._call(name, 'blockStats', '')
+        return dict(zip(BLOCK_STATS, values))
+
+    def net_xml(self, net_name):
+        conn = self._connection()
+        with self._mutex:
+            net = self._networks.get(net_name)
+        if net is None:
+            try:
+                net = conn.networkLookupByName(net_name)
+            except libvirt.libvirtError as e:
+                if e.get_error_code() == libvirt.VIR_ERR_NO_NETWORK:
+                    raise NoSuchNetwork(net_name)
+                raise
+            with self._mutex:
+                self._networks[net_name] = net
+        return ElementTree.fromstring(net.XMLDesc(0))
+
+    def node_free_memory(self):
+        """Memory available for domains (free + buffers + cached), KiB"""
+        conn = self._connection()
+        try:
+            stats = conn.getMemoryStats(
+                libvirt.VIR_NODE_MEMORY_STATS_ALL_CELLS)
+        except libvirt.libvirtError:
+            # not supported by the driver (i.e. test://)
+            return conn.getFreeMemory() // 1024
+        return sum(stats.get(key, 0) for key in MEMORY_AVAILABLE)
+
+
+def backend_class():
+    name = os.environ.get(BACKEND_ENV_VAR)
+    if name is None:
+        return LibvirtBackend if libvirt is not None else VirshBackend
+    if name == 'libvirt' and libvirt is None:
+        raise RuntimeError("libvirt python bindings are not installed")
+    backends = {
+        'libvirt': LibvirtBackend,
+        'virsh': VirshBackend,
+    }
+    if name not in backends:
+        raise ValueError("unknown {0}: {1}".format(BACKEND_ENV_VAR, name))
+    return backends[name]
+
+
+def get_backend(uri=LIBVIRT_CONNECTION):
+    """The backend (shared by all callers) for the given URI"""
+    with _BACKENDS_MUTEX:
+        if uri not in _BACKENDS:
+            _BACKENDS[uri] = backend_class()(uri)
+        return _BACKENDS[uri]
+
+
+def main():
+    # domainevents depends on this module. Run as a script this module
+    # is __main__, so get the backend from the copy domainevents uses
+    from . import virtbackend
+    from .domainevents import lifecycle_events
+
+    parser = optparse.OptionParser(
+        description='exercise the backend, i.e. with libvirt test driver')
+    parser.add_option('-c', '--connect', dest='uri',
+                      default='test:///default',
+                      help='libvirt URI (default: %default)')
+    parser.add_option('-b', '--backend', dest='backend',
+                      help='libvirt or virsh (default: libvirt if available)')
+    options, args = parser.parse_args()
+    if options.backend:
+        os.environ[BACKEND_ENV_VAR] = options.backend
+    backend = virtbackend.get_backend(options.uri)
+    print('backend: {0}'.format(type(backend).__name__))
+    names = sorted(backend.list_domains())
+    print('domains: {0}'.format(', '.join(names)))
+    for name in names:
+        print('{0}: {1}'.format(name, backend.dom_state(name)))
+    if backend.dom_state('vmbuilder-no-such-vm') is not None:
+        raise RuntimeError("found a domain which doesn't exist")
+    if not names:
+        return
+    # test:///default state lives as long as the connection does,
+    # so the rest works with the libvirt backend only
+    dom_xml = backend.dom_xml(names[0])
+    dom_xml.find('name').text = 'vmbuilder-selftest'
+    dom_xml.remove(dom_xml.find('uuid'))
+    with lifecycle_events(options.uri) as events:
+        backend.define(ElementTree.tostring(dom_xml))
+        backend.start('vmbuilder-selftest')
+        events.wait_for_state('vmbuilder-selftest', 'running', timeout=10)
+        backend.destroy('vmbuilder-selftest')
+        events.wait_for_state('vmbuilder-selftest', 'shut off', timeout=10)
+        backend.undefine('vmbuilder-selftest')
+    if backend.dom_state('vmbuilder-selftest') is not None:
+        raise RuntimeError("domain is still defined after undefine")
+    print('define/start/destroy/undefine: OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -5,11 +5,20 @@ from __future__ import absolute_import
 import os
 from xml.etree import ElementTree
 
-from .py3compat import subprocess
-from .sshutils import update_known_hosts, KNOWN_HOSTS_FILE
-from .thinpool import remove_lv
-
-LIBVIRT_CONNECTION = 'qemu:///system'
+from .dnsutils import guess_fqdn
+from .domainevents import lifecycle_events
+from .scheduler import DEFAULT_WORKERS, Scheduler
+from .sshutils import (
+    KNOWN_HOSTS_FILE,
+    remove_known_hosts,
+    update_known_hosts,
+)
+from .remotehost import get_host
+from .timing import get_tracer
+from .virtbackend import LIBVIRT_CONNECTION, NoSuchDomain, get_backend
+
+# seconds
+DESTROY_TIMEOUT = 60
 
 
 def _get_device_mac(net_dev_xml):
@@ -75,10 +84,13 @@ def _get_leased_ip_by_mac(mac, leases_file_name):
     return None
 
 
-def _get_iface_ip(net_dev_xml, conn=LIBVIRT_CONNECTION):
+def _get_iface_ip(net_dev_xml, conn=LIBVIRT_CONNECTION, net_domain=None):
     mac = _get_device_mac(net_dev_xml)
     source_net = _get_source_network(net_dev_xml)
-    domain_name = get_libvirt_net_domain(source_net, conn=conn)
+    if net_domain is None:
+        domain_name = get_libvirt_net_domain(source_net, conn=conn)
+    else:
+        domain_name = net_domain(source_net)
     leases_file_name = _get_leases_file_name(source_net)
     ip = _get_leased_ip_by_mac(mac, leases_file_name)
     return (ip, domain_name)
@@ -91,11 +103,12 @@ def _make_fqdn(vm_name, domain_name=None):
         return vm_name
 
 
-def _get_vm_ips(dom_xml, conn=LIBVIRT_CONNECTION):
+def _get_vm_ips(dom_xml, conn=LIBVIRT_CONNECTION, net_domain=None):
     net_devices_xml = _enumerate_network_devices(dom_xml)
     vm_name = dom_xml.find('name').text
     for dev_xml in net_devices_xml:
-        ip, domain_name = _get_iface_ip(dev_xml, conn=conn)
+        ip, domain_name = _get_iface_ip(dev_xml, conn=conn,
+                                        net_domain=net_domain)
         yield (ip, _make_fqdn(vm_name, domain_name=domain_name))
 
 
@@ -112,7 +125,10 @@ def get_libvirt_net_domain(net_name, conn=LIBVIRT_CONNECTION):
     #      </dhcp>
     #   </ip>
     # </network>
-    net_xml = _net_dumpxml(net_name, conn)
+    return net_domain_from_xml(net_dumpxml(net_name, conn))
+
+
+def net_domain_from_xml(net_xml):
     try:
         domain_xml = net_xml.findall('domain')[0]
         return domain_xml.get('name')
@@ -126,7 +142,10 @@ def libvirt_net_host_ip(net_name, conn=LIBVIRT_CONNECTION):
     #   <bridge name='br-saceph-priv' stp='on' delay='0'/>
     #   <mac address='52:54:00:b2:7f:37'/>
     #   <ip address='10.253.0.1' netmask='255.255.255.0'>
-    net_xml = _net_dumpxml(net_name, conn)
+    return net_host_ip_from_xml(net_dumpxml(net_name, conn))
+
+
+def net_host_ip_from_xml(net_xml):
     ip_xml = net_xml.find('ip')
     if ip_xml is None:
         return None
@@ -139,7 +158,7 @@ def keep_existing_mac_addresses(new_vm_xml, conn=LIBVIRT_CONNECTION):
     name = new_vm_xml.find('name').text
     if not vm_exists(name, conn=conn):
         return
-    vm_xml = _virsh_dumpxml(name, conn=conn)
+    vm_xml = get_backend(conn).dom_xml(name)
     new_net_devices = _get_devices_by_source_net(new_vm_xml)
     for src_net, old_dev in _get_devices_by_source_net(vm_xml).items():
         if src_net in new_net_devices:
@@ -148,32 +167,32 @@ def keep_existing_mac_addresses(new_vm_xml, conn=LIBVIRT_CONNECTION):
             _set_device_mac(new_dev, mac)
 
 
-def get_vm_ips(name, conn=LIBVIRT_CONNECTION):
-    dom_xml = _virsh_dumpxml(name, conn=conn)
-    return _get_vm_ips(dom_xml, conn=conn)
+def get_vm_ips(name, conn=LIBVIRT_CONNECTION, net_domain=None):
+    dom_xml = get_backend(conn).dom_xml(name)
+    return _get_vm_ips(dom_xml, conn=conn, net_domain=net_domain)
 
 
 def get_vm_vhds(name, conn=LIBVIRT_CONNECTION):
-    dom_xml = _virsh_dumpxml(name, conn=conn)
+    dom_xml = get_backend(conn).dom_xml(name)
     return enumerate_block_virtual_drives(dom_xml)
 
 
 def get_vm_macs(vm_name, conn=LIBVIRT_CONNECTION):
     """Get VM mac addresses along with source network names"""
-    if not vm_exists(vm_name, conn):
+    try:
+        vm_xml = get_backend(conn).dom_xml(vm_name)
+    except NoSuchDomain:
         return {}
-    vm_xml = _virsh_dumpxml(vm_name, conn)
     return _get_vm_macs(vm_xml)
 
 
 def vm_exists(vm_name, conn=LIBVIRT_CONNECTION):
-    try:
-        cmd = ['virsh', '-c', conn, 'domstate', vm_name]
-        with open(os.devnull, 'w') as null:
-            subprocess.check_call(cmd, stdout=null, stderr=null)
-        return True
-    except subprocess.CalledProcessError:
-        return False
+    return get_backend(conn).dom_state(vm_name) is not None
+
+
+def list_vms(inactive=True, conn=LIBVIRT_CONNECTION):
+    """Names of the defined VMs (only the running ones if not inactive)"""
+    return get_backend(conn).list_domains(inactive=inactive)
 
 
 def define_vm(vm_xml=None, raw_vm_xml=None, conn=LIBVIRT_CONNECTION):
@@ -183,60 +202,133 @@ def define_vm(vm_xml=None, raw_vm_xml=None, conn=LIBVIRT_CONNECTION):
         vm_xml = ElementTree.fromstring(raw_vm_xml)
     vm_name = vm_xml.find('name').text
     destroy_vm(vm_name, conn=conn, undefine=True)
-    proc = subprocess.Popen(['virsh', '-c', conn, 'define', '/dev/stdin'],
-                            stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    out, err = proc.communicate(raw_vm_xml)
-    rc = proc.poll()
-    if rc != 0:
-        print("define_vm: error: %s" % str(err))
-        raise RuntimeError(err)
+    try:
+        get_backend(conn).define(raw_vm_xml)
+    except Exception as e:
+        print("define_vm: error: %s" % str(e))
+        raise
 
 
-def wait4state(name, state, conn=LIBVIRT_CONNECTION):
-    event_cmd = ['virsh', '-c', conn, 'event', '--event=lifecycle', name]
-    state_cmd = ['virsh', '-c', conn, 'domstate', name]
-    while subprocess.check_output(state_cmd).strip() != state:
-        subprocess.check_call(event_cmd)
+def wait4state(name, state, conn=LIBVIRT_CONNECTION, timeout=None):
+    """Wait for the domain state change (using the listener of the run
+    if there's one), raise WaitTimeout after timeout seconds"""
+    with lifecycle_events(conn) as events:
+        events.wait_for_state(name, state, timeout=timeout)
 
 
-def destroy_vm(name, undefine=False, purge=False, conn=LIBVIRT_CONNECTION):
-    try:
-        cmd = ['virsh', '-c', conn, 'domstate', name]
-        with open(os.devnull, 'w') as null:
-            state = subprocess.check_output(cmd, stderr=null).strip()
-    except subprocess.CalledProcessError:
+def destroy_vm(name, undefine=False, purge=False, conn=LIBVIRT_CONNECTION,
+               net_domain=None):
+    backend = get_backend(conn)
+    state = backend.dom_state(name)
+    if state is None:
         # OK, no such VM
         return
-    if state.strip() == 'running':
-        remove_vm_ssh_keys(vm_name=name, conn=conn)
-        subprocess.check_call(['virsh', '-c', conn, 'destroy', name])
+    if state != 'shut off':
+        # paused, crashed, etc domains are active too
+        if state == 'running':
+            remove_vm_ssh_keys(vm_name=name, conn=conn,
+                               net_domain=net_domain)
+        backend.destroy(name)
 
     if purge:
-        wait4state(name, 'shut off')
-        for vhd in get_vm_vhds(name, conn=conn):
-            remove_lv(dev=vhd)
+        wait4state(name, 'shut off', conn=conn, timeout=DESTROY_TIMEOUT)
+        get_host(conn).run('remove_lvs', devs=get_vm_vhds(name, conn=conn))
 
     if undefine:
-        subprocess.check_call(['virsh', '-c', conn, 'undefine', name])
+        backend.undefine(name)
+
+
+def destroy_vms(names, conn=LIBVIRT_CONNECTION, net_domain=None,
+                known_hosts_file=KNOWN_HOSTS_FILE, workers=DEFAULT_WORKERS,
+                limits=None, tracer=None):
+    """Destroy, purge and undefine many VMs at once
+
+    All domains are destroyed concurrently and waited for together, their
+    LVs are removed with one lvremove per VG, and known_hosts is rewritten
+    once. Returns the number of VMs, LVs, and known_hosts entries removed.
+    """
+    backend = get_backend(conn)
+    scheduler = Scheduler(workers=workers, limits=limits,
+                          tracer=tracer or get_tracer())
+    vhds = {}
+    hostnames = {}
+    removed_keys = []
+
+    def destroy(name):
+        state = backend.dom_state(name)
+        if state is None:
+            # OK, no such VM
+            return
+        dom_xml = backend.dom_xml(name)
+        vhds[name] = enumerate_block_virtual_drives(dom_xml)
+        if state == 'shut off':
+            return
+        if state == 'running':
+            hostnames[name] = [
+                host for ip, hostname in _get_vm_ips(dom_xml, conn=conn,
+                                                     net_domain=net_domain)
+                for host in (hostname, ip,
+                             guess_fqdn(ip=ip, hostname=hostname))]
+        backend.destroy(name)
+
+    def wait_shutoff(name):
+        if name in vhds:
+            wait4state(name, 'shut off', conn=conn, timeout=DESTROY_TIMEOUT)
+
+    def purge():
+        devs = [dev for name in names for dev in vhds.get(name, [])]
+        if devs:
+            get_host(conn).run('remove_lvs', devs=devs)
+
+    def undefine(name):
+        if name in vhds:
+            backend.undefine(name)
+
+    def forget_ssh_keys():
+        removed_keys.append(remove_known_hosts(
+            [host for name in names for host in hostnames.get(name, [])],
+            known_hosts_file=known_hosts_file))
+
+    destroying = [scheduler.add('destroy_vm', lambda name=name:
+                                destroy(name),
+                                resources=['libvirtd'], vm=name)
+                  for name in names]
+    waiting = [scheduler.add('wait_shutoff', lambda name=name:
+                             wait_shutoff(name),
+                             deps=[destroying[n]], vm=name)
+               for n, name in enumerate(names)]
+    purging = scheduler.add('remove_lvs', purge, deps=waiting)
+    for name in names:
+        scheduler.add('undefine_vm', lambda name=name: undefine(name),
+                      resources=['libvirtd'], deps=[purging], vm=name)
+    scheduler.add('forget_ssh_keys', forget_ssh_keys, deps=destroying)
+    with lifecycle_events(conn):
+        scheduler.run()
+    return {
+        'vms': len(vhds),
+        'lvs': sum(len(devs) for devs in vhds.values()),
+        'known_hosts': sum(removed_keys),
+    }
 
 
 def update_vm_ssh_keys(ips=None, vm_name=None, ssh_key=None,
                        known_hosts_file=KNOWN_HOSTS_FILE,
-                       conn=LIBVIRT_CONNECTION):
+                       conn=LIBVIRT_CONNECTION,
+                       net_domain=None):
     if ips is None:
-        ips = list(get_vm_ips(vm_name, conn=conn))
+        ips = list(get_vm_ips(vm_name, conn=conn, net_domain=net_domain))
     update_known_hosts(ips=ips, ssh_key=ssh_key,
                        known_hosts_file=known_hosts_file)
 
 
 def remove_vm_ssh_keys(ips=None, vm_name=None,
                        known_hosts_file=KNOWN_HOSTS_FILE,
-                       conn=LIBVIRT_CONNECTION):
+                       conn=LIBVIRT_CONNECTION,
+                       net_domain=None):
     update_vm_ssh_keys(ips=ips, vm_name=vm_name, ssh_key=None,
                        known_hosts_file=known_hosts_file,
-                       conn=conn)
+                       conn=conn,
+                       net_domain=net_domain)
 
 
 def destroy_undefine_vm(name, conn=LIBVIRT_CONNECTION):
@@ -244,15 +336,8 @@ def destroy_undefine_vm(name, conn=LIBVIRT_CONNECTION):
 
 
 def start_vm(name, conn=LIBVIRT_CONNECTION):
-    subprocess.check_call(['virsh', '-c', conn, 'start', name])
-
-
-def _net_dumpxml(net_name, conn=LIBVIRT_CONNECTION):
-    out = subprocess.check_output(['virsh', '-c', conn,
-                                   'net-dumpxml', net_name])
-    return ElementTree.fromstring(out.strip())
+    get_backend(conn).start(name)
 
 
-def _virsh_dumpxml(vm_name, conn=LIBVIRT_CONNECTION):
-    out = subprocess.check_output(['virsh', '-c', conn, 'dumpxml', vm_name])
-    return ElementTree.fromstring(out.strip())
+def net_dumpxml(net_name, conn=LIBVIRT_CONNECTION):
+    return get_backend(conn).net_xml(net_name)
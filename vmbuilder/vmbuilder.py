@@ -2,71 +2,130 @@
 
 from __future__ import absolute_import
 
-import copy
+import jinja2
 import optparse
 import os
-try:
-    import Queue
-except ImportError:
-    import queue as Queue
+import multiprocessing
+import time
 import uuid
 
 from collections import defaultdict
-from multiprocessing.pool import ThreadPool as ThreadPool
+from contextlib import contextmanager
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
+from .buildstate import STATE_FILE, BuildState, vm_fingerprint
+from .clustercontext import ClusterContext
+from .domainevents import lifecycle_events
+from .layered import LayeredDict
+from .fatimage import FatImage
 from .gen_cloud_conf import generate_cc
-from .iothrottler import IOThrottler
-from .make_vm import redefine_vm
-from .miscutils import (
-    forward_thread_exceptions,
-    refresh_sudo_credentials,
-    yaml_ordered_load,
-)
-
-from .provision_vm import get_provision_method
-from .py3compat import (
-    raise_exception,
-)
-from .sshutils import (
-    get_authorized_keys,
-    SshConfigGenerator,
+from .iothrottler import IOThrottler, calibrate as calibrate_storage
+from .make_vm import create_vm_lvs, make_vm_xml
+from .miscutils import yaml_ordered_load
+from .placement import load_hypervisors, place_vms
+from .privhelper import privileged_helper
+
+from .provision_vm import get_provision_method, provision_golden
+from .remotehost import get_host
+from .runstatus import RunStatus
+from .sshutils import SshConfigGenerator
+from .scheduler import DEFAULT_WORKERS, Scheduler
+from .timing import get_tracer
+from .virtutils import (
+    LIBVIRT_CONNECTION,
+    define_vm,
+    destroy_vm,
+    destroy_vms,
+    start_vm,
 )
-from .virtutils import destroy_vm, start_vm, libvirt_net_host_ip
 from .cloudinit_callback import (
     CloudInitWebCallback,
     InventoryGenerator,
 )
 
 
-WEB_CALLBACK_URL = 'http://{hypervisor_ip}:8080'
+LIBVIRTD_CONCURRENCY = 4
+# the highest concurrency level probed by --calibrate unless -j is given
+MAX_CALIBRATION_LEVEL = 16
+
+BUILTIN_MACHINE = {
+    'cpu_count': 1,
+    'base_ram': 1024,
+    'max_ram': 2048,
+    'swap_size': 2048,
+    'swap_label': 'MOREVM',
+    'vm_template': 'vm.xml',
+    'graphics': {},
+    'optimize_rootfs': True,
+    'anonimize_rootfs': True,
+    'golden_image': False,
+    'inject_files': [],
+    'rootfs_grow': 'offline',
+}
 
 
 def rebuild_vms(vm_dict,
                 cluster_def=None,
                 redefine=False,
                 delete=False,
-                parallel=0):
+                parallel=0,
+                workers=None,
+                force=False,
+                calibrate=False):
     if vm_dict is None:
         vm_dict = cluster_def['hosts']
     vm_list = [(vm, role) for role in vm_dict for vm in vm_dict[role]]
-    vm_count = len(vm_list)
+    hypervisors = load_hypervisors(cluster_def)
+    if hypervisors:
+        context = hypervisors[0].context
+    else:
+        context = ClusterContext(cluster_def)
+    contexts = dict((hv.name, hv.context) for hv in hypervisors)
+    state = BuildState('%s/%s' % (cluster_def['cluster_name'], STATE_FILE))
     if delete:
-        for vm, _ in vm_list:
-            destroy_vm(vm['name'], undefine=True, purge=True)
+        names = [vm['name'] for vm, _ in vm_list]
+        tracer = get_tracer()
+        removed = defaultdict(int)
+        try:
+            # VMs which are not there are skipped
+            for uri, ctx in [(hv.uri, hv.context) for hv in hypervisors] \
+                    or [(LIBVIRT_CONNECTION, context)]:
+                counts = destroy_vms(names, conn=uri,
+                                     net_domain=ctx.net_domain,
+                                     workers=workers or DEFAULT_WORKERS,
+                                     limits={'libvirtd':
+                                             LIBVIRTD_CONCURRENCY},
+                                     tracer=tracer)
+                for key, count in counts.items():
+                    removed[key] += count
+        finally:
+            tracer.print_summary()
+        state.forget(names)
+        print("removed {vms} VMs, {lvs} LVs, {known_hosts} known_hosts "
+              "entries".format(**removed))
         return
 
-    provisioned = Queue.Queue()
-    vms2wait = set([vm['name'] for vm, _ in vm_list])
-
-    new_vm_list = []
-
-    for vm, role in vm_list:
-        vm_def = copy.deepcopy(vm)
-        vm_def['role'] = role
-        vm_def = merge_vm_info(cluster_def, vm_def)
-        new_vm_list.append(vm_def)
-
-    vm_list = new_vm_list
+    vm_list = [merge_vm_info(cluster_def, LayeredDict({'role': role}, vm),
+                             context=context)
+               for vm, role in vm_list]
+    if calibrate:
+        calibrate_storage(storage_targets(vm_list, hypervisors),
+                          max_level=parallel or MAX_CALIBRATION_LEVEL)
+        return
+    if hypervisors:
+        vm_list = place_vms(vm_list, hypervisors,
+                            previous=state.placement())
+    # skip the VMs built from the same inputs (and still existing)
+    fingerprints = dict((vm['vm_name'], vm_fingerprint(vm))
+                        for vm in vm_list)
+    unchanged = {} if force else state.unchanged_vms(vm_list, fingerprints)
+    kept_vms = [vm for vm in vm_list if vm['vm_name'] in unchanged]
+    vm_list = [vm for vm in vm_list if vm['vm_name'] not in unchanged]
+    vm_count = len(vm_list)
+    state.forget([vm['vm_name'] for vm in vm_list])
     # VMs heavily use disk on first boot (dist-upgrade, install additional
     # packages, etc). Therefore one might want to limit the number of VMs
     # which do initial configuration step concurrently.
@@ -74,87 +133,317 @@ def rebuild_vms(vm_dict,
         parallel = vm_count
     io_throttler = IOThrottler(vm_list, max_concurrency_level=parallel)
 
-    tpool = ThreadPool(processes=len(vm_list))
-
     inventory = '%s/hosts' % cluster_def['cluster_name']
-    inventory_gen = InventoryGenerator(vm_list, filename=inventory)
+    inventory_gen = InventoryGenerator(vm_list + kept_vms,
+                                       filename=inventory)
     ssh_config = '%s/ssh_config' % cluster_def['cluster_name']
     ssh_conf_gen = SshConfigGenerator(path=ssh_config)
-
-    callback_worker = CloudInitWebCallback([web_callback_addr(cluster_def)],
+    for vm in kept_vms:
+        ready_info = dict(state.get(vm['vm_name'])['ready_info'])
+        inventory_gen.add(**ready_info)
+        ssh_conf_gen.add(**ready_info)
+
+    tracer = get_tracer()
+    tracer.open('%s/timings.jsonl' % cluster_def['cluster_name'])
+    started_at = {}
+    vm_by_instance_id = dict((str(vm['instance_id']), vm['vm_name'])
+                             for vm in vm_list)
+
+    scheduler = Scheduler(workers=workers or DEFAULT_WORKERS,
+                          limits=stage_limits(vm_list, io_throttler),
+                          tracer=tracer)
+    callback_stages = {}
+    io_resources = dict(((vm.get('libvirt_uri', LIBVIRT_CONNECTION), drive),
+                         host_resource(vm, 'io:' + drive))
+                        for vm in vm_list
+                        for drive in io_throttler.drives(vm['instance_id']))
+
+    def io_level_changed(uri, drive, level):
+        scheduler.set_limit(io_resources[(uri, drive)], level)
+        scheduler.wakeup()
+
+    io_throttler.add_hook(io_level_changed)
+    # expired leases let the next VMs in
+    io_throttler.add_release_hook(scheduler.wakeup)
+    run_status = RunStatus(scheduler, io_throttler,
+                           thin_pools=storage_targets(vm_list, []))
+
+    def record_cloud_init_wait(**kwargs):
+        vm_name = vm_by_instance_id.get(kwargs['instance_id'])
+        start = started_at.get(vm_name)
+        if start is not None:
+            tracer.record('cloud_init_wait', start, time.time() - start,
+                          vm=vm_name)
+
+    def vm_ready(**kwargs):
+        vm_name = vm_by_instance_id.get(kwargs['instance_id'])
+        if vm_name in callback_stages:
+            scheduler.complete(callback_stages[vm_name])
+
+    booted = set()
+
+    def vm_lifecycle_event(vm_name, event):
+        # VMs which stop or crash before calling back never will
+        if vm_name not in callback_stages:
+            return
+        if event == 'Started':
+            booted.add(vm_name)
+        elif event in ('Stopped', 'Crashed') and vm_name in booted:
+            scheduler.fail(callback_stages[vm_name], RuntimeError(
+                "vm {0}: {1} before calling back".format(vm_name,
+                                                         event.lower())))
+
+    def record_vm_built(hostname, ip, **kwargs):
+        vm_name = vm_by_instance_id.get(kwargs['instance_id'])
+        if vm_name in fingerprints:
+            state.record(vm_name, fingerprints[vm_name],
+                         dict(kwargs, hostname=hostname, ip=ip),
+                         hypervisor=hypervisor_of.get(vm_name))
+
+    hypervisor_of = dict((vm['vm_name'], vm.get('hypervisor'))
+                         for vm in vm_list)
+    callback_addr = callback_listen_addr(vm_list, context.web_callback_addr)
+    callback_worker = CloudInitWebCallback([callback_addr],
                                            vms2wait=dict((vm['vm_name'], vm['role'])
                                                          for vm in vm_list),
-                                           vm_ready_hooks=[io_throttler.release],
+                                           vm_ready_hooks=[record_cloud_init_wait,
+                                                           io_throttler.release,
+                                                           vm_ready],
                                            async_hooks=[inventory_gen.update,
-                                                        ssh_conf_gen.update])
+                                                        ssh_conf_gen.update,
+                                                        record_vm_built],
+                                           status=run_status.snapshot)
 
-    # runs in the provisioning thread
-    @forward_thread_exceptions(provisioned)
-    def _rebuild_vm(vm):
-        vm_def = copy.deepcopy(vm)
-        vm_def['drives']['config_image'] = generate_cc(vm_def)
+    def add_vm_stages(vm_def):
         vm_name = vm_def['vm_name']
-        io_throttler.acquire(vm['instance_id'])
+        vg = vm_def['drives']['os']['vg']
+        vdisk = '/dev/{vg}/{vm}-os'.format(vg=vg, vm=vm_name)
+        uri = vm_def.get('libvirt_uri', LIBVIRT_CONNECTION)
+        vm_context = contexts.get(vm_def.get('hypervisor'), context)
+        rendered = {}
+        # the OS drive is made as a snapshot of the golden LV
+        golden_snapshot = get_provision_method(
+            vm_def['distro'], golden=vm_def['golden_image']) is \
+            provision_golden
+
+        def render():
+            rendered.update(config_image=generate_cc(vm_def, in_memory=True),
+                            inject_files=render_inject_files(vm_def))
+
+        def define():
+            domain_def = vm_def
+            config_image = rendered['config_image']
+            if not isinstance(config_image, FatImage):
+                # attached to the VM as a file (autounattend floppy)
+                drives = vm_def['drives'].new_child(config_image=config_image)
+                domain_def = vm_def.new_child(drives=drives)
+            define_vm(vm_xml=make_vm_xml(domain_def,
+                                         template=vm_def['vm_template'],
+                                         conn=uri),
+                      conn=uri)
+
+        def create_lvs():
+            drives = vm_def['drives']
+            if golden_snapshot:
+                drives = dict((group, drive) for group, drive in drives.items()
+                              if group != 'os')
+            create_vm_lvs(vm_name=vm_name,
+                          role=vm_def['role'],
+                          drives=drives,
+                          conn=uri)
+
+        def destroy():
+            destroy_vm(vm_name, net_domain=vm_context.net_domain, conn=uri)
+
+        def provision_disk():
+            host = get_host(uri)
+            if host.local:
+                provision = get_provision_method(
+                    vm_def['distro'], golden=vm_def['golden_image'])
+            else:
+                provision = host.provision_method(
+                    vm_def['distro'], golden=vm_def['golden_image'])
+            extra_args = {}
+            if golden_snapshot:
+                extra_args.update(
+                    thin_pool=vm_def['drives']['os']['thin_pool'],
+                    size=vm_def['drives']['os']['disk_size'])
+            provision([vdisk],
+                      img=vm_def['drives']['install_image'],
+                      config_drives=[rendered['config_image']],
+                      optimize_rootfs=vm_def['optimize_rootfs'],
+                      anonimize_rootfs=vm_def['anonimize_rootfs'],
+                      swap_size=vm_def['swap_size'] * 1024 * 2,
+                      swap_label=vm_def['swap_label'],
+                      inject_files=rendered['inject_files'],
+                      rootfs_grow=vm_def['rootfs_grow'],
+                      **extra_args)
+
+        def start():
+            started_at[vm_name] = time.time()
+            start_vm(vm_name, conn=uri)
+            io_throttler.vm_started(vm_def['instance_id'])
+
+        add = scheduler.add
+        libvirtd = host_resource(vm_def, 'libvirtd')
+        rendering = add('render', render, resources=['cpu'], vm=vm_name)
+        before_provision = [rendering]
         if redefine:
-            redefine_vm(vm_def,
-                        template=vm_def['vm_template'])
-        vdisk = '/dev/{vg}/{vm}-os'.format(vg=vm_def['drives']['os']['vg'],
-                                           vm=vm_name)
-        destroy_vm(vm_name)
-
-        provision = get_provision_method(vm_def['distro'])
-
-        provision([vdisk],
-                  img=vm_def['drives']['install_image'],
-                  config_drives=[vm_def['drives']['config_image']],
-                  optimize_rootfs=vm_def['optimize_rootfs'],
-                  anonimize_rootfs=vm_def['anonimize_rootfs'],
-                  swap_size=vm_def['swap_size'] * 1024 * 2,
-                  swap_label=vm_def['swap_label'])
-        provisioned.put(vm_name)
-
-    refresh_sudo_credentials()
-    callback_worker.start()
-    tpool.map_async(_rebuild_vm, vm_list)
-
-    started = set()
-    extype, exvalue, bt = None, None, None
-    while started != vms2wait:
-        vm_name = provisioned.get()
-        if isinstance(vm_name, tuple):
-            # error happend while provisioning the VM
-            callback_worker.stop()
-            extype, exvalue, bt = vm_name
-            break
-        start_vm(vm_name)
-        started.add(vm_name)
-
-    tpool.close()
-    tpool.join()
-    callback_worker.join()
-    if extype is not None:
-        raise_exception(extype, exvalue, bt)
-
-
-def merge_vm_info(cluster_def, vm_def):
-
-    builtin_machine = {
-        'cpu_count': 1,
-        'base_ram': 1024,
-        'max_ram': 2048,
-        'swap_size': 2048,
-        'swap_label': 'MOREVM',
-        'vm_template': 'vm.xml',
-        'graphics': {},
-        'instance_id': uuid.uuid4(),
-        'optimize_rootfs': True,
-        'anonimize_rootfs': True,
+            defining = add('define_vm', define, resources=[libvirtd],
+                           deps=[rendering], vm=vm_name)
+            # define_vm destroys the old domain which might keep the LVs
+            # open, so don't touch them before
+            before_provision.append(add('create_lvs', create_lvs,
+                                        resources=[host_resource(
+                                            vm_def, 'lvm:' + vg)],
+                                        deps=[defining], vm=vm_name))
+        else:
+            defining = rendering
+        before_provision.append(add('destroy_vm', destroy,
+                                    resources=[libvirtd],
+                                    deps=[defining], vm=vm_name))
+        # the I/O throttler slots are held until the VM phones home
+        provisioning = add('provision_disk', provision_disk,
+                           resources=[host_resource(vm_def, 'io:' + drive)
+                                      for drive in io_throttler.drives(
+                                          vm_def['instance_id'])],
+                           deps=before_provision,
+                           gate=lambda: io_throttler.try_acquire(
+                               vm_def['instance_id']),
+                           vm=vm_name)
+        starting = add('start_vm', start, resources=[libvirtd],
+                       deps=[provisioning], vm=vm_name)
+        callback_stages[vm_name] = add('await_callback', deps=[starting],
+                                       vm=vm_name)
+
+    for vm in vm_list:
+        add_vm_stages(vm)
+
+    for vm in kept_vms:
+        vm_name = vm['vm_name']
+        if not unchanged[vm_name]:
+            uri = vm.get('libvirt_uri', LIBVIRT_CONNECTION)
+            scheduler.add('start_vm', lambda name=vm_name, uri=uri:
+                          start_vm(name, conn=uri),
+                          resources=[host_resource(vm, 'libvirtd')],
+                          vm=vm_name)
+        print("vm {0} unchanged, ready".format(vm_name))
+    if kept_vms:
+        inventory_gen.write()
+        ssh_conf_gen.write()
+
+    if vm_list:
+        callback_worker.start()
+    try:
+        uris = set(vm.get('libvirt_uri', LIBVIRT_CONNECTION)
+                   for vm in vm_list + kept_vms) or [LIBVIRT_CONNECTION]
+        io_throttler.start()
+        with lifecycle_hooks(uris, vm_lifecycle_event):
+            scheduler.run()
+    except:
+        # error happend while provisioning the VM
+        callback_worker.stop()
+        raise
+    finally:
+        io_throttler.stop()
+        if vm_list:
+            callback_worker.join()
+        tracer.close()
+        tracer.print_summary()
+        leases = io_throttler.lease_summary()
+        if leases:
+            print(leases)
+
+
+def storage_targets(vm_list, hypervisors):
+    """(libvirt URI, vg, thin_pool) the VMs' LVs might use"""
+    targets = set()
+    for vm in vm_list:
+        uri = vm.get('libvirt_uri', LIBVIRT_CONNECTION)
+        for drive in vm['drives'].values():
+            if not isinstance(drive, Mapping) or \
+                    not ('vg' in drive or 'storage_class' in drive):
+                continue
+            if not hypervisors:
+                targets.add((uri, drive['vg'], drive['thin_pool']))
+            for hv in hypervisors:
+                pool = hv.thin_pool(drive)
+                if pool is not None:
+                    targets.add((hv.uri,) + pool)
+    return sorted(targets)
+
+
+def host_resource(vm_def, resource):
+    """Name of the resource of the hypervisor the VM is placed on"""
+    if 'hypervisor' not in vm_def:
+        return resource
+    return '{0}@{1}'.format(resource, vm_def['hypervisor'])
+
+
+def stage_limits(vm_list, io_throttler):
+    """Concurrency limits of resources used by VM build stages"""
+    limits = {
+        'cpu': multiprocessing.cpu_count(),
+        'libvirtd': LIBVIRTD_CONCURRENCY,
     }
+    for vm in vm_list:
+        vg = vm['drives']['os']['vg']
+        uri = vm.get('libvirt_uri', LIBVIRT_CONNECTION)
+        limits[host_resource(vm, 'libvirtd')] = LIBVIRTD_CONCURRENCY
+        for drive in io_throttler.drives(vm['instance_id']):
+            limits[host_resource(vm, 'io:' + drive)] = \
+                io_throttler.concurrency_level(drive, uri=uri)
+        # lvcreate/lvremove serialize on the VG metadata lock anyway
+        limits[host_resource(vm, 'lvm:' + vg)] = 1
+    return limits
+
+
+def callback_listen_addr(vm_list, default):
+    """Address the cloud-init callback listens at: the one all VMs call
+    back to, or any address if VMs on several hypervisors use different
+    ones (on the same port)"""
+    addrs = set(vm['web_callback_addr'] for vm in vm_list)
+    if len(addrs) <= 1:
+        return addrs.pop() if addrs else default
+    ports = set(addr.rsplit(':', 1)[-1] for addr in addrs)
+    if len(ports) != 1:
+        raise ValueError("VMs call back to different ports: {0}".format(
+                         ', '.join(sorted(addrs))))
+    return '0.0.0.0:{0}'.format(ports.pop())
+
+
+@contextmanager
+def lifecycle_hooks(uris, hook):
+    """Listen to lifecycle events of domains of all the given libvirt
+    URIs within the block"""
+    uris = list(uris)
+    if not uris:
+        yield
+        return
+    with lifecycle_events(uris[0]) as events:
+        events.add_hook(hook)
+        with lifecycle_hooks(uris[1:], hook):
+            yield
 
-    new_vm_def = copy.deepcopy(builtin_machine)
-    new_vm_def.update(copy.deepcopy(cluster_def['machine']))
-    new_vm_def.update(copy.deepcopy(vm_def))
-    new_vm_def['vm_name'] = new_vm_def['name']
+
+def merge_vm_info(cluster_def, vm_def, context=None):
+    """Layer the VM (host) definition over the machine and builtin ones
+
+    The cluster wide layers are shared by all VMs (not copied), the top
+    layer holds values computed for this VM.
+    """
+    if context is None:
+        context = ClusterContext(cluster_def)
+
+    machine = cluster_def['machine']
+    overrides = {
+        'vm_name': vm_def['name'],
+    }
+    per_vm_defaults = {
+        'instance_id': uuid.uuid4(),
+    }
+    new_vm_def = LayeredDict(overrides, context.vm_facts(), vm_def, machine,
+                             per_vm_defaults, BUILTIN_MACHINE)
 
     required_params = (
         'distro',
@@ -163,15 +452,11 @@ def merge_vm_info(cluster_def, vm_def):
     )
 
     for var in required_params:
-        new_vm_def[var] = vm_def.get(var, cluster_def[var])
+        overrides[var] = vm_def.get(var, cluster_def[var])
 
     def _param(name):
         return vm_def.get(name, cluster_def[name])
 
-    def copy_optional_param(dst, var):
-        if var in vm_def:
-            dst[var] = vm_def[var]
-
     def runs_windows(vm_def):
         return vm_def['distro'].startswith('woe')
 
@@ -180,61 +465,49 @@ def merge_vm_info(cluster_def, vm_def):
 
     if runs_windows(new_vm_def):
         # Windows VMs need CD drive(s) and a floppy
-        new_vm_def['vm_template'] = 'vm_woe.xml'
-
-    drives = copy.deepcopy(cluster_def['machine']['drives'])
-    drives.update(vm_def.get('drives', {}))
-    if 'drivers' in drives:
-        drivers_iso = drives['drivers']['path']
-        drives['drivers'] = os.path.expanduser(drivers_iso)
+        overrides['vm_template'] = 'vm_woe.xml'
 
     extra_drives = {
         'install_image': os.path.expanduser(_param('source_image')['path']),
     }
-    # copy_optional_param(extra_drives, 'config_image')
-    drives.update(extra_drives)
-    new_vm_def.update(drives=drives)
+    drives = LayeredDict(extra_drives, vm_def.get('drives', {}),
+                         machine['drives'])
+    if 'drivers' in drives:
+        drivers_iso = drives['drivers']['path']
+        extra_drives['drivers'] = os.path.expanduser(drivers_iso)
+    overrides['drives'] = drives
 
     def guess_nic_model(vm_def):
-        if 'model' in iface:
-            return iface['model']
-        else:
-            return 'virtio' if has_libvirt_drivers(vm_def) else 'e1000'
+        return 'virtio' if has_libvirt_drivers(vm_def) else 'e1000'
 
-    interfaces = copy.deepcopy(cluster_def['machine']['interfaces'])
-    interfaces.update(vm_def.get('interfaces', {}))
-    for _, iface in interfaces.items():
+    interfaces = LayeredDict(vm_def.get('interfaces', {}),
+                             machine['interfaces'])
+    nic_models = {}
+    for name, iface in interfaces.items():
         if 'model' not in iface:
-            iface['model'] = guess_nic_model(new_vm_def)
-    new_vm_def.update(interfaces=interfaces)
-
-    auth_data = {
-        'ssh_authorized_keys': get_authorized_keys(),
-        'whoami': os.environ['USER'],
-    }
-    new_vm_def.update(auth_data)
-
-    interfaces = cluster_def['machine']['interfaces']
-    bridge_ip = libvirt_net_host_ip(interfaces['default']['source_net'])
-    new_vm_def.update(hypervisor_ip=bridge_ip)
-
-    http_proxy_tpl = cluster_def.get('net_conf', {}).get('http_proxy')
-    http_proxy = http_proxy_tpl.format(hypervisor_ip=bridge_ip) \
-       if http_proxy_tpl else None
-    new_vm_def.update(http_proxy=http_proxy)
-
-    web_callback_url = cluster_def.get('net_conf', {}).\
-        get('web_callback_url', WEB_CALLBACK_URL)
-    web_callback_url = web_callback_url.format(hypervisor_ip=bridge_ip)
-    web_callback_addr = web_callback_url.split('http://', 1)[1]
-    new_vm_def.update(web_callback_url=web_callback_url,
-                      web_callback_addr=web_callback_addr)
+            nic_models[name] = LayeredDict(
+                {'model': guess_nic_model(new_vm_def)}, iface)
+    overrides['interfaces'] = LayeredDict(nic_models, interfaces)
     return new_vm_def
 
 
-def web_callback_addr(cluster_def):
-    stub = {'name': 'dummy', 'role': 'dummy'}
-    return merge_vm_info(cluster_def, stub)['web_callback_addr']
+def render_inject_files(vm_def):
+    """Render contents of files written into VM's rootfs when provisioning
+
+    inject_files:
+      - path: /etc/apt/apt.conf.d/10_proxy
+        permissions: '0644'
+        content: |
+          Acquire::http::proxy "{{ http_proxy }}";
+    """
+    rendered = []
+    for entry in vm_def['inject_files']:
+        entry = dict(entry)
+        content = entry.get('content', '')
+        template = jinja2.Template(content, keep_trailing_newline=True)
+        entry['content'] = template.render(vm_def)
+        rendered.append(entry)
+    return rendered
 
 
 def main():
@@ -249,7 +522,19 @@ def main():
                       help='remove specified VMs and reclaim their disk space')
     parser.add_option('-j', '--parallel', dest='parallel',
                       type=int, default=0,
-                      help='concurrency level (default: depends on backing storage)')
+                      help='max concurrency level per VG (default: the '
+                      'number of VMs)')
+    parser.add_option('-f', '--force', dest='force',
+                      default=False, action='store_true',
+                      help='rebuild all VMs, even the unchanged ones')
+    parser.add_option('-w', '--workers', dest='workers',
+                      type=int, default=DEFAULT_WORKERS,
+                      help='max number of threads building VMs '
+                      '(default: %default)')
+    parser.add_option('--calibrate', dest='calibrate',
+                      default=False, action='store_true',
+                      help='probe the storage of VMs and save the '
+                      'concurrency levels to start from')
     options, args = parser.parse_args()
 
     if not options.paramsfile:
@@ -267,11 +552,16 @@ def main():
             vm_dict[role].append(name)
         vm_dict = dict(vm_dict)
 
-    rebuild_vms(vm_dict,
-                cluster_def=cluster_def,
-                redefine=options.redefine,
-                delete=options.delete,
-                parallel=options.parallel)
+    # one sudo for all privileged operations
+    with privileged_helper():
+        rebuild_vms(vm_dict,
+                    cluster_def=cluster_def,
+                    redefine=options.redefine,
+                    delete=options.delete,
+                    parallel=options.parallel,
+                    workers=options.workers,
+                    force=options.force,
+                    calibrate=options.calibrate)
 
 
 if __name__ == '__main__':